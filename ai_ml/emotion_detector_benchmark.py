@@ -0,0 +1,263 @@
+#Benchmark of emotion_detector_funasr_whisperx_plotly.py and funasr_emotions_simple_quick.py on synthetic media, offline:
+#the media files are generated by ffmpeg, the transcripts (TSV, SRT, JSON) are synthetic, the emotion model is a deterministic stub, and so is MediaInfo (from ffprobe),
+#so neither funasr, whisperx nor pymediainfo is needed, and what is measured is our own code: the chunking, the TSV and SRT parsing, the emotion results handling and the HTML reports.
+#Run it at growing segment counts, e.g. --segments 100 1000 5000, to catch the steps that slow down faster than the segment count grows.
+#Each run is added to a JSON history file, and compared with the previous run of the same settings.
+#Example: python emotion_detector_benchmark.py --segments 100 1000 5000 --chunk_max_segments 1000
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import datetime
+import platform
+import contextlib
+import subprocess
+from pathlib import Path
+
+
+benchmark_dir = Path(__file__).resolve().parent
+default_history_path = Path(os.getenv("EMOTION_DETECTOR_CACHE", str(Path.home() / ".cache" / "emotion_detector"))) / "benchmark_history.json"
+
+#The labels of the emotion2vec models, in their order:
+emotion2vec_labels = ['生气/angry', '厌恶/disgusted', '恐惧/fearful', '开心/happy', '中立/neutral', '其他/other', '难过/sad', '吃惊/surprised', '<unk>']
+
+
+def stub_emotion_result(key, seed_text):
+    """A deterministic emotion2vec-like result: the scores come from a hash of the input, so the same input always gets the same emotions."""
+    digest = hashlib.sha256(seed_text.encode("utf-8")).digest()
+    weights = [digest[i] + 1 for i in range(len(emotion2vec_labels))]
+    return {"key": key, "labels": list(emotion2vec_labels), "scores": [weight / sum(weights) for weight in weights]}
+
+
+class StubEmotionModel:
+    """Stands in for funasr AutoModel: no model files, no torch, the same call signature as used by the scripts."""
+
+    def __init__(self, *model_args, **model_kwargs):
+        self.model_kwargs = model_kwargs
+
+    def generate(self, input, batch_size=1, **generate_kwargs):
+        if isinstance(input, (str, Path)) and str(input).endswith(".scp"):
+            with open(input, 'r', encoding='utf-8') as scp_file:
+                input = [line.rstrip('\n').split('\t', 1)[1] for line in scp_file if '\t' in line]
+        results = []
+        for index, item in enumerate(input):
+            # A waveform slice (numpy) is identified by its length and first samples, a chunk file by its name:
+            seed_text = str(item) if isinstance(item, (str, Path)) else f"{len(item)}:{item[:8].tolist()}"
+            results.append(stub_emotion_result(f"segment_{index:03d}", seed_text))
+        return results
+
+
+class StubMediaInfo:
+    """Stands in for pymediainfo MediaInfo: the duration of the media, in milliseconds, from ffprobe, which comes with the ffmpeg the benchmark needs anyway."""
+
+    def __init__(self, duration_ms):
+        self.tracks = [type("StubTrack", (), {"duration": duration_ms})()]
+
+    @classmethod
+    def parse(cls, media_path, *parse_args, **parse_kwargs):
+        command = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", str(media_path)]
+        duration_seconds = subprocess.run(command, capture_output=True, text=True, check=True).stdout.strip()
+        return cls(round(float(duration_seconds) * 1000))
+
+
+def generate_synthetic_media(media_path, duration_seconds, video):
+    """Generates a test tone (and, for a video, the ffmpeg test pattern) of the given length, with a keyframe every 2 seconds."""
+    command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=16000:duration={duration_seconds}"]
+    if video:
+        command += ["-f", "lavfi", "-i", f"testsrc=size=320x240:rate=25:duration={duration_seconds}",
+                    "-c:v", "libx264", "-preset", "ultrafast", "-g", "50", "-pix_fmt", "yuv420p"]
+    command += ["-c:a", "aac", "-b:a", "64k", "-shortest", str(media_path)]
+    subprocess.run(command, check=True)
+
+
+def synthetic_segments(duration_seconds, segment_count):
+    """Evenly spread sentences, with a short gap after each: (start_ms, end_ms, text)."""
+    slot_ms = duration_seconds * 1000 / segment_count
+    return [(int(i * slot_ms), int((i + 0.9) * slot_ms), f"Synthetic sentence number {i + 1}, for the benchmark.") for i in range(segment_count)]
+
+
+def srt_timestamp(ms):
+    hours, ms = divmod(ms, 3600000)
+    minutes, ms = divmod(ms, 60000)
+    seconds, ms = divmod(ms, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{ms:03d}"
+
+
+def write_synthetic_transcripts(output_dir, stem, stage_suffix, segments):
+    """The files that the whisperx writers would have written for the pass: the TSV, the SRT and the JSON (with the language code)."""
+    with open(output_dir / f"{stem}_{stage_suffix}.tsv", 'w', encoding='utf-8') as tsv_file:
+        tsv_file.write("start\tend\ttext\n")
+        for start_ms, end_ms, text in segments:
+            tsv_file.write(f"{start_ms}\t{end_ms}\t{text}\n")
+    with open(output_dir / f"{stem}_{stage_suffix}.srt", 'w', encoding='utf-8') as srt_file:
+        for index, (start_ms, end_ms, text) in enumerate(segments, start=1):
+            srt_file.write(f"{index}\n{srt_timestamp(start_ms)} --> {srt_timestamp(end_ms)}\n{text}\n\n")
+    with open(output_dir / f"{stem}_{stage_suffix}.json", 'w', encoding='utf-8') as json_file:
+        json.dump({"language": "en", "segments": [{"start": start_ms / 1000, "end": end_ms / 1000, "text": text} for start_ms, end_ms, text in segments]}, json_file)
+
+
+def timed_step(step_times, step_name, step_function, *step_args):
+    """Runs the step and records its wall time."""
+    step_start_time = time.perf_counter()
+    result = step_function(*step_args)
+    step_times[step_name] = round(time.perf_counter() - step_start_time, 4)
+    return result
+
+
+def benchmark_detector(media_path, segments, chunking, options):
+    """The paths of emotion_detector_funasr_whisperx_plotly.py, on one synthetic media file: parsing, chunking, emotions (stub) and the report."""
+    import emotion_detector_funasr_whisperx_plotly as detector
+    detector.AutoModel = StubEmotionModel
+    detector.MediaInfo = StubMediaInfo
+    stage_suffix = "transcription"
+
+    detector_argv = [str(media_path), "--no_cache", "--no_open", "--emotion_source", "chunks" if chunking else "waveform", "--chunk_mode", options.chunk_mode,
+                     "--export_workers", str(options.export_workers)]
+    detector.configure_media(detector.parse_options(detector.build_argument_parser(), detector_argv))
+    write_synthetic_transcripts(detector.output_dir, detector.stem, stage_suffix, segments)
+    tsv_path = detector.output_dir / f"{detector.stem}_{stage_suffix}.tsv"
+    srt_path = detector.output_dir / f"{detector.stem}_{stage_suffix}.srt"
+
+    step_times = {}
+    timed_step(step_times, "detector/decode", detector.get_decoded_audio)
+    timed_step(step_times, "detector/read_tsv", detector.read_tsv_file, tsv_path)
+    timed_step(step_times, "detector/read_srt", detector.read_srt_file, srt_path)
+    timed_step(step_times, "detector/segment_boundaries", detector.read_segment_boundaries, stage_suffix)
+    if chunking:
+        timed_step(step_times, "detector/chunk", detector.extract_media_segments, stage_suffix)
+    timed_step(step_times, "detector/emotions", detector.detect_segment_emotions, stage_suffix)
+    timed_step(step_times, "detector/report", detector.display_result_temp_html, stage_suffix, "en", detector.funasr_model_name)
+    return step_times
+
+
+def benchmark_simple_quick(media_path, segments, chunking):
+    """The paths of funasr_emotions_simple_quick.py: chunking by ffmpeg, the emotion results (stub) to JSON, and the report."""
+    import funasr_emotions_simple_quick as simple_quick
+    output_dir = media_path.parent / (media_path.stem + "_simple_quick")
+    output_dir.mkdir(exist_ok=True)
+    sentences_data = [{"start": start_ms / 1000, "end": end_ms / 1000, "text": text} for start_ms, end_ms, text in segments]
+
+    step_times = {}
+    if chunking:
+        chunks = timed_step(step_times, "simple_quick/chunk", simple_quick.chunk_audio, media_path, sentences_data, output_dir, media_path.stem)
+    else:
+        chunks = [output_dir / f"{media_path.stem}_segment_{i:03d}.mp3" for i in range(len(sentences_data))]
+    rec_result = StubEmotionModel().generate(input=chunks)
+    emotion_results = timed_step(step_times, "simple_quick/collect", simple_quick.collect_emotion_results, rec_result, sentences_data)
+    timed_step(step_times, "simple_quick/flatten", simple_quick.flatten_emotion_results, emotion_results)
+    timed_step(step_times, "simple_quick/report", simple_quick.write_html_report, emotion_results, media_path, output_dir / (media_path.stem + "_emotions.html"))
+    return step_times
+
+
+def run_size(work_dir, segment_count, options):
+    """One benchmark size: a fresh folder, a synthetic media file, and the steps of both scripts. Returns the step times."""
+    size_dir = work_dir / f"segments_{segment_count}"
+    if size_dir.exists():
+        shutil.rmtree(size_dir)  # No tracker, checkpoints or chunks left from an earlier run
+    size_dir.mkdir(parents=True)
+    duration_seconds = options.duration or round(segment_count * options.seconds_per_segment, 3)
+    media_path = size_dir / f"synthetic_{segment_count}{'.mp4' if options.video else '.m4a'}"
+    segments = synthetic_segments(duration_seconds, segment_count)
+    chunking = not options.skip_chunking and segment_count <= options.chunk_max_segments
+
+    print(f"Benchmark size: \033[94m{segment_count}\033[0m segments, {duration_seconds} seconds of {'video' if options.video else 'audio'}, chunking: {chunking}")
+    step_times = {}
+    timed_step(step_times, "generate_media", generate_synthetic_media, media_path, duration_seconds, options.video)
+
+    # The scripts print a lot per segment, which is not what we measure here:
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if options.verbose else devnull):
+        step_times.update(benchmark_detector(media_path, segments, chunking, options))
+        step_times.update(benchmark_simple_quick(media_path, segments, chunking))
+    return {"segments": segment_count, "duration_seconds": duration_seconds, "chunking": chunking, "steps": step_times}
+
+
+def scaling_warnings(size_results, growth_tolerance):
+    """The steps whose time per segment grows by more than the tolerance from the smallest to the largest size: the O(n²) suspects."""
+    warnings = []
+    smallest, largest = size_results[0], size_results[-1]
+    if largest["segments"] <= smallest["segments"]:
+        return warnings
+    for step_name, largest_seconds in largest["steps"].items():
+        smallest_seconds = smallest["steps"].get(step_name)
+        if step_name == "generate_media" or not smallest_seconds or smallest_seconds < 0.005:
+            continue
+        growth = (largest_seconds / largest["segments"]) / (smallest_seconds / smallest["segments"])
+        if growth > growth_tolerance:
+            warnings.append(f"{step_name}: the time per segment grows {growth:.1f}x from {smallest['segments']} to {largest['segments']} segments")
+    return warnings
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=benchmark_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def print_size_table(size_results, previous_run):
+    """The step times of each size, with the ratio to the previous run of the same settings, if any."""
+    previous_sizes = {size["segments"]: size for size in previous_run["sizes"]} if previous_run else {}
+    for size in size_results:
+        print()
+        print(f"\033[92m{size['segments']} segments\033[0m ({size['duration_seconds']} s of media):")
+        for step_name, seconds in size["steps"].items():
+            previous_seconds = previous_sizes.get(size["segments"], {}).get("steps", {}).get(step_name)
+            comparison = f"  ({seconds / previous_seconds:.2f}x of the previous run)" if previous_seconds else ""
+            print(f"{step_name:<32} {seconds:>10.4f} s {seconds / size['segments'] * 1000:>10.3f} ms/segment{comparison}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the emotion detector scripts, on synthetic media with a stub emotion model")
+    parser.add_argument("--segments", type=int, nargs="+", default=[100, 1000, 5000], help="The segment counts to run, smallest first (default: 100 1000 5000)")
+    parser.add_argument("--seconds_per_segment", type=float, default=2.0, help="The synthetic media length per segment (default: 2.0)")
+    parser.add_argument("--duration", type=float, default=0, help="A fixed synthetic media length in seconds, for all the sizes, instead of --seconds_per_segment")
+    parser.add_argument("--video", action="store_true", help="Generate video (the ffmpeg test pattern) instead of audio only (default: False)")
+    parser.add_argument("--skip_chunking", action="store_true", help="Do not benchmark the chunk export (default: False)")
+    parser.add_argument("--chunk_max_segments", type=int, default=1000, help="The chunk export is benchmarked up to this segment count only, as it takes long (default: 1000)")
+    parser.add_argument("--chunk_mode", choices=["moviepy", "smartcut"], default="moviepy", help="The --chunk_mode of the detector (default: moviepy)")
+    parser.add_argument("--export_workers", type=int, default=1, help="The --export_workers of the detector (default: 1)")
+    parser.add_argument("--growth_tolerance", type=float, default=2.0, help="How much the time per segment may grow from the smallest to the largest size, before a step is reported (default: 2.0)")
+    parser.add_argument("--work_dir", type=str, default=str(Path(os.getenv("TMPDIR", "/tmp")) / "emotion_detector_benchmark"), help="Where the synthetic media and the results go")
+    parser.add_argument("--history", type=str, default=str(default_history_path), help=f"The JSON history of the benchmark runs (default: {default_history_path})")
+    parser.add_argument("--verbose", action="store_true", help="Show what the scripts print (default: False)")
+    options = parser.parse_args()
+
+    sys.path.insert(0, str(benchmark_dir))
+    work_dir = Path(options.work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    size_results = [run_size(work_dir, segment_count, options) for segment_count in sorted(options.segments)]
+    settings = {key: value for key, value in vars(options).items() if key not in ("work_dir", "history", "verbose")}
+
+    history_path = Path(options.history)
+    history = json.loads(history_path.read_text(encoding="utf-8")) if history_path.exists() else {"runs": []}
+    previous_run = next((run for run in reversed(history["runs"]) if run["settings"] == settings), None)
+
+    print_size_table(size_results, previous_run)
+    warnings = scaling_warnings(size_results, options.growth_tolerance)
+    print()
+    for warning in warnings:
+        print(f"\033[91mScaling warning:\033[0m {warning}")
+    if not warnings:
+        print(f"\033[92mNo step grows faster than {options.growth_tolerance}x per segment across the sizes.\033[0m")
+
+    history["runs"].append({
+        "run_started_at": datetime.datetime.now().isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPUs",
+        "settings": settings,
+        "sizes": size_results,
+        "scaling_warnings": warnings,
+    })
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    history_path.write_text(json.dumps(history, ensure_ascii=False, indent=4), encoding="utf-8")
+    print(f"Benchmark run added to: {history_path}")
+    return 1 if warnings else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+#The thin client of: emotion_detector_funasr_whisperx_plotly.py --serve
+#It takes the same command line as emotion_detector_funasr_whisperx_plotly.py, sends it as a job to the daemon, which has the libraries imported and the models loaded already,
+#and prints the progress of the job as it comes. If no daemon is running, it runs emotion_detector_funasr_whisperx_plotly.py itself, as before.
+#Only the standard library here, so that it starts at once.
+import os
+import sys
+import json
+import socket
+import subprocess
+from pathlib import Path
+
+
+default_daemon_socket_path = Path(os.getenv("EMOTION_DETECTOR_SOCKET", str(Path.home() / ".cache" / "emotion_detector" / "daemon.sock")))
+detector_script_path = Path(__file__).resolve().parent / "emotion_detector_funasr_whisperx_plotly.py"
+
+
+def job_argv(argv):
+    """The command line of the job, with the media path made absolute, as the daemon runs in another working folder."""
+    job_arguments = []
+    for argument in argv:
+        if not argument.startswith("-") and not argument.startswith("http") and os.path.exists(argument):
+            argument = str(Path(argument).resolve())
+        job_arguments.append(argument)
+    return job_arguments
+
+
+def send_job(socket_path, argv):
+    """Sends the job to the daemon and prints its progress. Returns the exit code: 0 if the job is done."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(str(socket_path))
+        client.sendall((json.dumps({"argv": job_argv(argv)}) + "\n").encode("utf-8"))
+        with client.makefile("r", encoding="utf-8") as events:
+            for line in events:
+                event = json.loads(line)
+                if event["event"] == "progress":
+                    print(event["line"], flush=True)
+                elif event["event"] == "queued":
+                    print(f"\033[94mJob queued in the daemon, position: {event['position']}\033[0m")
+                elif event["event"] == "started":
+                    print(f"\033[94mThe daemon has started the job: {event['media_path']}\033[0m")
+                elif event["event"] == "done":
+                    print(f"\033[92mDone.\033[0m The results are in: {event['output_dir']}")
+                    for report_path in event["reports"]:
+                        print(f"Report: {report_path}")
+                    return 0
+                else:
+                    print(f"\033[91m{event['event']}: {event['message']}\033[0m", file=sys.stderr)
+                    return 1
+    print("\033[91mThe daemon closed the connection before the job was done.\033[0m", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    socket_path = default_daemon_socket_path
+    argv = sys.argv[1:]
+    if "--socket" in argv:
+        socket_path = Path(argv[argv.index("--socket") + 1])
+
+    if socket_path.exists() and "--help" not in argv and "-h" not in argv:
+        try:
+            sys.exit(send_job(socket_path, argv))
+        except (ConnectionRefusedError, FileNotFoundError):
+            print(f"No daemon is listening on: {socket_path}, so running the detector here. Start the daemon with: {detector_script_path.name} --serve")
+
+    # No daemon: the usual single run
+    sys.exit(subprocess.call([sys.executable, str(detector_script_path)] + argv))
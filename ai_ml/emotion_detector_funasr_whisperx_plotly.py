@@ -1,6 +1,6 @@
 #First global variables:
 tool_name_and_version = "Emotion Detector for Media Files. Current Version: 5.4.7 | Author: ManamaMa"
-#Note to self : the extraction for the HTML rendering of the chunks in 'def extract_media_segments' may need fixing: use the SRT files, not the TSV files or check if .bak is same as the new TSV file.
+#Note to self : the extraction for the HTML rendering of the chunks in 'def extract_media_segments' may need fixing: use the SRT files, not the TSV files.
 
 #Select the whisperx_model size here - "medium" runs relatively fast, but crashes Android. "small" does not crash Android, but may be too small. "large" or "large-v3" is best, but the slowest  
 #whisperx_model_size="medium"
@@ -9,7 +9,9 @@ device = "cpu"
 batch_size = 2  # Adjust based on available resources
 compute_type = "float32"  # Adjust based on available resources
 disable_update=False # Disable update of the funasr models. But then they must be downloaded at least once, so set to : False at start. 
-funasr_model_name="iic/emotion2vec_plus_large"
+funasr_model_name="iic/emotion2vec_base_finetuned"  # The model actually loaded, see --emotion_model. Alternatives: iic/emotion2vec_plus_seed, iic/emotion2vec_plus_base, iic/emotion2vec_plus_large
+emotion_batch_size = 8  # How many segments are passed to the emotion model at once
+emotion_checkpoint_every = 50  # After how many segments the emotions detected so far are saved, for a restarted run to resume from there
 
 #Divisor for the share of the CPU cores to use, e.g. "2" meanas that 4 of the 8 CPU cores shall be available 
 num_cores_divisor=2
@@ -51,7 +53,9 @@ def install_packages(packages):
     for package in packages:
         try:
             # Check if the package is already installed
-            __import__(package.split("==")[0])  # Split to handle versioning
+            # Found without importing it, as the imports of all these take seconds; they are imported on their first use, see LazyImport
+            if importlib.util.find_spec(package.split("==")[0]) is None:  # Split to handle versioning
+                raise ImportError(package)
         except ImportError:
             # If not installed, install the package
             print(f"Installing {package}...")
@@ -106,6 +110,7 @@ import json
 # Start measuring time
 start_time = time.time()
 import importlib.metadata
+import importlib.util
 import subprocess
 
 import argparse
@@ -144,22 +149,87 @@ def rainbow_text(text):
     print()  # New line after the text
 
 
-print("Here we start ...")
-rainbow_text(tool_name_and_version)
-print("We shall be using WhisperX for speech recognition and diarization (detection of the speakers), FunASR for emotion detection, Plotly for visualizing the results.")
-# Install required packages
-install_packages(required_packages)
+# Not again in the spawned worker processes (of the chunk export and of --batch), which import this file:
+if __name__ == "__main__":
+    print("Here we start ...")
+    rainbow_text(tool_name_and_version)
+    print("We shall be using WhisperX for speech recognition and diarization (detection of the speakers), FunASR for emotion detection, Plotly for visualizing the results.")
+    # Install required packages
+    install_packages(required_packages)
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import csv
-import shutil
 from pathlib import Path
 
 from urllib.parse import quote
-from pymediainfo import MediaInfo
 
 import mimetypes
-from whisperx.diarize import DiarizationPipeline
+import concurrent.futures
+import multiprocessing
+import hashlib
+import threading
+import bisect
+import contextlib
+import gc
+import tempfile
+import io
+import queue
+import socket
+import socketserver
+import traceback
+import copy
+import glob
+import atexit
+import resource
+
+
+#The slow libraries are imported on their first use only, so that e.g. --help, or a rerun with all the steps done already, starts at once. See also: --profile_startup
+lazy_import_seconds = {}  # How long each import took, by the module name
+
+
+class LazyImport:
+    """Stands in for a module, or for a name from a module, and imports it on the first attribute access or call."""
+
+    def __init__(self, module_name, attribute=None):
+        self.module_name = module_name
+        self.attribute = attribute
+        self.target = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.target is None:
+            with self.lock:
+                if self.target is None:
+                    import_start_time = time.time()
+                    module = importlib.import_module(self.module_name)
+                    lazy_import_seconds[self.module_name] = lazy_import_seconds.get(self.module_name, 0.0) + time.time() - import_start_time
+                    self.target = getattr(module, self.attribute) if self.attribute else module
+        return self.target
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __call__(self, *call_args, **call_kwargs):
+        return self.load()(*call_args, **call_kwargs)
+
+
+#Changed imports with MoviePy update > 2.0: from moviepy import VideoFileClip, AudioFileClip
+lazy_imports = {
+    "VideoFileClip": LazyImport("moviepy", "VideoFileClip"),
+    "AudioFileClip": LazyImport("moviepy", "AudioFileClip"),
+    "MediaInfo": LazyImport("pymediainfo", "MediaInfo"),
+    "go": LazyImport("plotly.graph_objects"),
+    "px": LazyImport("plotly.express"),
+    "srt": LazyImport("srt"),
+    "pd": LazyImport("pandas"),
+    "whisperx": LazyImport("whisperx"),
+    "DiarizationPipeline": LazyImport("whisperx.diarize", "DiarizationPipeline"),
+    "AutoModel": LazyImport("funasr", "AutoModel"),
+    "modelscope": LazyImport("modelscope"),  # For emotions model downloading, needed once
+    "playsound": LazyImport("playsound", "playsound"),
+}
+globals().update(lazy_imports)
+import webbrowser  # Standard library, quick
 
 
  
@@ -192,6 +262,532 @@ def write_results(result, options, stage_suffix):
     print(f"Debug info: we have created:  {srt_filename}, {tsv_filename}, {json_filename}")
 
 
+
+#The decoded audio layer: whisperx (transcription, alignment), pyannote (diarization) and emotion2vec all want 16 kHz mono float32, so we decode the source media only once, to a raw PCM file in the output folder, and memory-map it.
+#Each stage then gets a zero-copy view of it, instead of spawning ffmpeg (via whisperx.load_audio) and keeping yet another copy of the whole file in RAM.
+decoded_audio_sample_rate = 16000
+decoded_audio_views = {}  # Memory-mapped views already opened in this process, keyed by the media path
+
+
+def decoded_audio_paths(media_path, output_dir):
+    """Returns the paths of the raw PCM cache and of its metadata file."""
+    pcm_path = output_dir / (media_path.stem + "_audio_16k_mono_f32.pcm")
+    meta_path = output_dir / (media_path.stem + "_audio_16k_mono_f32.json")
+    return pcm_path, meta_path
+
+
+def media_source_signature(media_path):
+    """What the files derived from the media are validated against: if the source file changes, they are made anew."""
+    source_stat = media_path.stat()
+    return {"source": str(media_path.resolve()), "size": source_stat.st_size, "mtime_ns": source_stat.st_mtime_ns}
+
+
+def read_json_or_empty(json_path):
+    """Reads a small JSON (metadata) file, returning {} if it is missing or broken."""
+    try:
+        with open(json_path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def decode_media_to_pcm(media_path, pcm_path, ffmpeg_threads):
+    """Decodes the media file to 16 kHz mono float32 PCM, streamed by ffmpeg straight to the file, so never held in RAM."""
+    temp_pcm_path = pcm_path.with_name(pcm_path.name + ".part")
+    ffmpeg_command = [
+        "ffmpeg",
+        "-nostdin",
+        "-threads", str(ffmpeg_threads),
+        "-i", str(media_path),
+        "-f", "f32le",             # Raw float32, little endian: exactly the numpy float32 layout
+        "-ac", "1",
+        "-acodec", "pcm_f32le",
+        "-ar", str(decoded_audio_sample_rate),
+        "-loglevel", "error",
+        "-y",
+        str(temp_pcm_path)
+    ]
+    try:
+        subprocess.run(ffmpeg_command, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to decode the audio of {media_path}: {e.stderr}") from e
+    # Only a complete file gets the final name, so a killed run never leaves a truncated cache behind:
+    os.replace(temp_pcm_path, pcm_path)
+
+
+def load_decoded_audio(media_path, output_dir, ffmpeg_threads, measure=None):
+    """Returns a read-only (copy-on-write) memory-mapped float32 view of the decoded audio, decoding the media first if the cache is missing or stale.
+    The decoding runs with ffmpeg_threads, measured by measure (e.g. measure_stage) if given."""
+    import numpy as np
+
+    cache_key = str(media_path)
+    if cache_key in decoded_audio_views:
+        return decoded_audio_views[cache_key]
+
+    pcm_path, meta_path = decoded_audio_paths(media_path, output_dir)
+    source_signature = {**media_source_signature(media_path), "sample_rate": decoded_audio_sample_rate, "dtype": "float32"}
+
+    cached_meta = read_json_or_empty(meta_path)
+
+    cache_is_valid = (
+        pcm_path.exists()
+        and all(cached_meta.get(key) == value for key, value in source_signature.items())
+        and cached_meta.get("num_samples", -1) * 4 == pcm_path.stat().st_size
+    )
+
+    if cache_is_valid:
+        print(f"Reusing the decoded audio cache: \033[94m{pcm_path}\033[0m")
+    else:
+        print(f"Decoding the audio once to 16 kHz mono float32 (shared by all the stages): \033[94m{pcm_path}\033[0m")
+        decode_start_time = time.time()
+        output_dir.mkdir(exist_ok=True)
+        with measure("decode/ffmpeg") if measure else contextlib.nullcontext():
+            decode_media_to_pcm(media_path, pcm_path, ffmpeg_threads)
+        num_samples = pcm_path.stat().st_size // 4
+        with open(meta_path, 'w') as f:
+            json.dump({**source_signature, "num_samples": num_samples}, f, indent=4)
+        print(f"Decoded {num_samples / decoded_audio_sample_rate:.2f} seconds of audio in \033[94m{time.time() - decode_start_time:.2f}\033[0m seconds.")
+
+    if pcm_path.stat().st_size == 0:
+        audio = np.zeros(0, dtype=np.float32)  # np.memmap cannot map an empty file
+    else:
+        # mode='c' is copy-on-write: pages are shared with the OS file cache, yet torch.from_numpy does not complain about a read-only array
+        audio = np.memmap(pcm_path, dtype=np.float32, mode='c')
+
+    decoded_audio_views[cache_key] = audio
+    return audio
+
+
+def get_decoded_audio():
+    """The decoded audio of the media file being processed now, see load_decoded_audio."""
+    return load_decoded_audio(media_path, output_dir, thread_budget.ffmpeg_threads, measure_stage)
+
+
+def audio_segment_view(audio, start_ms, end_ms):
+    """Slices the [start_ms, end_ms) part out of the decoded audio, as a view, not a copy."""
+    start_sample = max(0, int(start_ms * decoded_audio_sample_rate // 1000))
+    end_sample = min(len(audio), int(end_ms * decoded_audio_sample_rate // 1000))
+    return audio[start_sample:max(start_sample, end_sample)]
+
+
+#The artifact cache: the transcription, alignment, diarization and emotion results, keyed by the hash of the decoded audio content plus the model and the options,
+#so that the same recording renamed, moved or downloaded again from another URL is not processed again. Its size is bounded, the least recently used results go first.
+artifact_cache_dir = Path(os.getenv("EMOTION_DETECTOR_CACHE", str(Path.home() / ".cache" / "emotion_detector"))) / "artifacts"
+artifact_cache = None  # Created on the first use, see get_artifact_cache
+
+
+class ArtifactCache:
+    """A size-bounded directory of JSON results, one file per content key, evicted in the least recently used order (by the file modification times)."""
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key_path(self, kind, key_parts):
+        key_hash = hashlib.sha256(json.dumps(key_parts, sort_keys=True, default=str).encode()).hexdigest()
+        return self.cache_dir / f"{kind}_{key_hash}.json"
+
+    def get(self, kind, key_parts):
+        artifact_path = self.key_path(kind, key_parts)
+        with self.lock:
+            try:
+                with open(artifact_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                return None
+            os.utime(artifact_path)  # Marks it as recently used
+        return data
+
+    def put(self, kind, key_parts, data):
+        artifact_path = self.key_path(kind, key_parts)
+        data = json.loads(json.dumps(data, default=float))  # numpy scalars, e.g. the alignment scores, as plain floats
+        with self.lock:
+            write_json_atomically(artifact_path, data)
+            self.evict()
+        return data
+
+    def evict(self):
+        artifacts = sorted(self.cache_dir.glob("*.json"), key=lambda path: path.stat().st_mtime)
+        total_bytes = sum(path.stat().st_size for path in artifacts)
+        while artifacts and total_bytes > self.max_bytes:
+            oldest = artifacts.pop(0)
+            total_bytes -= oldest.stat().st_size
+            oldest.unlink()
+            print(f"Artifact cache over {self.max_bytes // (1024 * 1024)} MB, evicted the least recently used: {oldest.name}")
+
+
+def get_artifact_cache():
+    """The artifact cache of this process, or None if disabled by --no_cache."""
+    global artifact_cache
+    if args.no_cache:
+        return None
+    if artifact_cache is None:
+        artifact_cache = ArtifactCache(artifact_cache_dir, args.cache_max_mb * 1024 * 1024)
+    return artifact_cache
+
+
+def cached_artifact(kind, key_parts, compute):
+    """Returns the cached result for the key, or computes it and caches it."""
+    cache = get_artifact_cache()
+    if cache is None:
+        return compute()
+    data = cache.get(kind, key_parts)
+    if data is not None:
+        print(f"\033[92mArtifact cache hit:\033[0m the {kind} of this audio, with the same model and options, is reused from: {cache.key_path(kind, key_parts)}")
+        return data
+    return cache.put(kind, key_parts, compute())
+
+
+def audio_content_hash():
+    """The SHA-256 of the decoded audio samples: the same recording gets the same hash, whatever its file name or location. Computed once, then kept in the decoded audio metadata."""
+    get_decoded_audio()  # Makes sure that the decoded audio cache is there and valid
+    pcm_path, meta_path = decoded_audio_paths(media_path, output_dir)
+    with tracker_lock:
+        decoded_meta = read_json_or_empty(meta_path)
+        if "audio_sha256" not in decoded_meta:
+            audio_hash = hashlib.sha256()
+            with open(pcm_path, 'rb') as pcm_file:
+                for block in iter(lambda: pcm_file.read(8 * 1024 * 1024), b''):
+                    audio_hash.update(block)
+            decoded_meta["audio_sha256"] = audio_hash.hexdigest()
+            write_json_atomically(meta_path, decoded_meta)
+    return decoded_meta["audio_sha256"]
+
+
+#The models of the pipeline (whisper, the alignment model, pyannote and emotion2vec), loaded once and kept resident within a RAM budget, see --model_ram_budget_mb.
+#The RAM taken by a model is measured as the growth of the process RSS when it is loaded; these are the rough sizes (float32, in MB) used before that:
+model_ram_estimate_mb = {"tiny": 400, "base": 600, "small": 1200, "medium": 3000, "large": 6000, "large-v2": 6000, "large-v3": 6000, "align": 1200, "pyannote": 800, "emotion2vec": 1500,
+                         "iic/emotion2vec_base_finetuned": 700, "iic/emotion2vec_plus_seed": 700, "iic/emotion2vec_plus_base": 700, "iic/emotion2vec_plus_large": 1500}
+model_registry = None  # Created on the first use, see get_model_registry
+
+
+def process_rss_bytes(field="VmRSS"):
+    """The resident memory of this process, from /proc (Linux, Android), or 0 where it is not available. The field "VmHWM" is its peak so far."""
+    try:
+        with open("/proc/self/status", 'r') as status_file:
+            for line in status_file:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def system_memory_bytes(field="MemTotal"):
+    """A field of /proc/meminfo in bytes, e.g. MemTotal or MemAvailable, or 0 where it is not available."""
+    try:
+        with open("/proc/meminfo", 'r') as meminfo_file:
+            for line in meminfo_file:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class ModelRegistry:
+    """Loads the models lazily, keeps them loaded for reuse and, when a new one would not fit in the RAM budget, unloads the least recently used ones first.
+
+    Models are taken with the `use` context manager: a model in use (e.g. by a parallel pipeline node) is never unloaded under it."""
+
+    def __init__(self, ram_budget_bytes):
+        self.ram_budget_bytes = ram_budget_bytes
+        self.models = {}  # key: [model, ram_bytes, users], in the least recently used first order
+        self.lock = threading.RLock()
+        # One for all the keys: two models loaded in parallel would both be let in by make_room against the same free RAM, and each measured with the RSS of the other
+        self.loading_lock = threading.Lock()
+
+    def resident_bytes(self):
+        return sum(ram_bytes for _, ram_bytes, _ in self.models.values())
+
+    def make_room(self, needed_bytes):
+        """Unloads the least recently used models that are not in use, until the needed bytes fit in the budget."""
+        with self.lock:
+            for key in list(self.models):
+                if self.resident_bytes() + needed_bytes <= self.ram_budget_bytes:
+                    break
+                _, ram_bytes, users = self.models[key]
+                if users == 0:
+                    del self.models[key]
+                    print(f"\033[93mModel registry:\033[0m unloading {key} ({ram_bytes // (1024 * 1024)} MB) to stay within the RAM budget of {self.ram_budget_bytes // (1024 * 1024)} MB")
+            if self.resident_bytes() + needed_bytes > self.ram_budget_bytes:
+                print(f"\033[93mModel registry:\033[0m the models in use already take {self.resident_bytes() // (1024 * 1024)} MB, over the budget of {self.ram_budget_bytes // (1024 * 1024)} MB with the next one")
+        gc.collect()
+
+    def take_loaded(self, key):
+        """The model, if it is loaded already, counted as in use, or else None."""
+        with self.lock:
+            if key not in self.models:
+                return None
+            self.models[key] = self.models.pop(key)  # Now the most recently used
+            self.models[key][2] += 1
+            print(f"\033[92mModel registry:\033[0m reusing the loaded model {key}")
+            return self.models[key][0]
+
+    def acquire(self, key, loader, estimate_mb):
+        model = self.take_loaded(key)
+        if model is not None:
+            return model  # Without waiting for a model being loaded meanwhile
+        with self.loading_lock:
+            model = self.take_loaded(key)  # Loaded by another thread while this one waited
+            if model is not None:
+                return model
+            self.make_room(estimate_mb * 1024 * 1024)
+            rss_before = process_rss_bytes()
+            model = loader()
+            # The weights may be memory mapped and paged in only on the first use, so the estimate is the floor:
+            ram_bytes = max(process_rss_bytes() - rss_before, estimate_mb * 1024 * 1024)
+            with self.lock:
+                self.models[key] = [model, ram_bytes, 1]
+            print(f"Model registry: loaded {key}, about {ram_bytes // (1024 * 1024)} MB, {self.resident_bytes() // (1024 * 1024)} MB resident in all")
+            return model
+
+    def release(self, key):
+        with self.lock:
+            if key in self.models:
+                self.models[key][2] -= 1
+
+    @contextlib.contextmanager
+    def use(self, key, loader, estimate_mb):
+        """Yields the model for the key, loading it with the loader if needed."""
+        model = self.acquire(key, loader, estimate_mb)
+        try:
+            yield model
+        finally:
+            del model
+            self.release(key)
+
+
+def get_model_registry():
+    """The model registry of this process, its budget set by --model_ram_budget_mb, or by default half of the RAM of the machine."""
+    global model_registry
+    if model_registry is None:
+        ram_budget_mb = args.model_ram_budget_mb or (system_memory_bytes() // 2 // (1024 * 1024)) or 4096
+        model_registry = ModelRegistry(ram_budget_mb * 1024 * 1024)
+    return model_registry
+
+
+#The run planner, see --auto_plan. The rough CPU costs, as the real-time factor (seconds of processing per second of audio) with 4 threads and float32;
+#int8 takes about 60% of that time and 40% of the RAM for whisper (ctranslate2). emotion_model_matrix.py measures them on a given machine.
+whisper_real_time_factor = {"tiny": 0.06, "base": 0.1, "small": 0.3, "medium": 0.8, "large-v2": 1.6, "large-v3": 1.6}
+emotion_real_time_factor = {"iic/emotion2vec_plus_large": 0.12, "iic/emotion2vec_plus_base": 0.05, "iic/emotion2vec_plus_seed": 0.05, "iic/emotion2vec_base_finetuned": 0.05}
+step_real_time_factor = {"align": 0.1, "diarize": 0.15}
+whisper_batch_item_mb = {"tiny": 60, "base": 80, "small": 150, "medium": 250, "large-v2": 400, "large-v3": 400}  # The extra RAM of each segment in a whisper batch
+emotion_batch_item_mb = 40
+planner_reference_threads = 4
+planner_whisper_sizes = ["large-v3", "medium", "small", "base", "tiny"]  # The better ones first
+planner_emotion_models = ["iic/emotion2vec_plus_large", "iic/emotion2vec_plus_base", "iic/emotion2vec_plus_seed", "iic/emotion2vec_base_finetuned"]
+
+
+def estimate_run(job_args, whisper_size, whisper_compute_type, emotion_model, whisper_batch, emotion_batch, threads):
+    """The estimated peak RAM (MB) of the models and their batches, and the real-time factor of the whole run, for one choice of the models and batch sizes.
+
+    The pyannote diarization runs alongside the transcription; the registry may unload whisper before the alignment and emotion models are loaded."""
+    int8 = whisper_compute_type.startswith("int8")
+    thread_scale = (planner_reference_threads / max(1, threads)) ** 0.8
+    whisper_mb = model_ram_estimate_mb.get(whisper_size, 3000) * (0.4 if int8 else 1.0) + whisper_batch * whisper_batch_item_mb.get(whisper_size, 250)
+    later_mb = (0 if job_args.no_align else model_ram_estimate_mb["align"]) + model_ram_estimate_mb.get(emotion_model, model_ram_estimate_mb["emotion2vec"]) + emotion_batch * emotion_batch_item_mb
+    peak_mb = max(whisper_mb, later_mb) + (0 if job_args.no_diarize else model_ram_estimate_mb["pyannote"])
+
+    whisper_rtf = whisper_real_time_factor.get(whisper_size, 0.8) * (0.6 if int8 else 1.0) * thread_scale
+    diarize_rtf = 0.0 if job_args.no_diarize else step_real_time_factor["diarize"] * thread_scale
+    align_rtf = 0.0 if job_args.no_align else step_real_time_factor["align"] * thread_scale
+    emotion_rtf = emotion_real_time_factor.get(emotion_model, 0.05) * thread_scale
+    return peak_mb, max(whisper_rtf, diarize_rtf) + align_rtf + emotion_rtf
+
+
+def plan_run(job_args):
+    """--auto_plan: picks the whisper size and compute type, the emotion2vec model and the batch sizes that fit in the free RAM and, with --deadline_minutes, in the time,
+    the better models first. Only the options left at their defaults are changed, in job_args. Prints the plan, with its estimated real-time factor. Returns the plan."""
+    explicit = set(default_settings) & job_args.given_options
+
+    # What the models may take: the free RAM, plus the models this process holds already and may unload, less a fifth as the headroom
+    free_mb = system_memory_bytes("MemAvailable") // (1024 * 1024) or system_memory_bytes() // 2 // (1024 * 1024) or 4096
+    if model_registry is not None:
+        free_mb += model_registry.resident_bytes() // (1024 * 1024)
+    usable_mb = free_mb * 0.8
+    if job_args.model_ram_budget_mb:
+        usable_mb = min(usable_mb, job_args.model_ram_budget_mb)
+    duration_seconds = media_duration_seconds() or 0.0
+    deadline_seconds = job_args.deadline_minutes * 60
+    threads = thread_budget.whisper_threads
+
+    whisper_sizes = [job_args.model] if "model" in explicit else planner_whisper_sizes
+    compute_types = [job_args.compute_type] if "compute_type" in explicit else ["float32", "int8"]
+    emotion_models = [job_args.emotion_model] if "emotion_model" in explicit else planner_emotion_models
+    whisper_batches = [job_args.batch_size] if "batch_size" in explicit else [8, 4, 2, 1]
+    emotion_batches = [job_args.emotion_batch_size] if "emotion_batch_size" in explicit else [32, 16, 8, 4, 1]
+
+    candidates = []
+    for whisper_size in whisper_sizes:
+        for whisper_compute_type in compute_types:
+            for emotion_model in emotion_models:
+                # The biggest batches that fit, as they keep the cores busier:
+                for whisper_batch, emotion_batch in [(w, e) for w in whisper_batches for e in emotion_batches]:
+                    peak_mb, real_time_factor = estimate_run(job_args, whisper_size, whisper_compute_type, emotion_model, whisper_batch, emotion_batch, threads)
+                    if peak_mb <= usable_mb:
+                        break
+                candidates.append({"model": whisper_size, "compute_type": whisper_compute_type, "emotion_model": emotion_model, "batch_size": whisper_batch,
+                                   "emotion_batch_size": emotion_batch, "peak_mb": round(peak_mb), "real_time_factor": round(real_time_factor, 3)})
+
+    fitting = [plan for plan in candidates if plan["peak_mb"] <= usable_mb]
+    in_time = [plan for plan in fitting if not deadline_seconds or plan["real_time_factor"] * duration_seconds <= deadline_seconds]
+    if in_time:
+        plan = in_time[0]
+    elif fitting:
+        plan = min(fitting, key=lambda plan: plan["real_time_factor"])
+        print(f"\033[93mRun plan:\033[0m no choice of the models is estimated to finish within {job_args.deadline_minutes} minutes, so taking the fastest one.")
+    else:
+        plan = min(candidates, key=lambda plan: (plan["peak_mb"], plan["real_time_factor"]))
+        print(f"\033[93mRun plan:\033[0m no choice of the models is estimated to fit in the {usable_mb:.0f} MB of RAM free, so taking the smallest one; it may run out of memory.")
+
+    for name in default_settings:
+        setattr(job_args, name, plan[name])
+    plan.update({"usable_ram_mb": round(usable_mb), "threads": threads, "media_duration_seconds": duration_seconds, "deadline_minutes": job_args.deadline_minutes})
+    print(f"\033[92mRun plan:\033[0m whisper \033[94m{plan['model']}\033[0m ({plan['compute_type']}, batch {plan['batch_size']}), \033[94m{plan['emotion_model']}\033[0m (batch {plan['emotion_batch_size']}), "
+          f"{threads} threads per step; about {plan['peak_mb']} MB of RAM at the peak, out of {plan['usable_ram_mb']} MB usable.")
+    print(f"Estimated real-time factor: \033[94m{plan['real_time_factor']:.2f}\033[0m, so about {plan['real_time_factor'] * duration_seconds / 60:.1f} minutes for the {duration_seconds / 60:.1f} minutes of media"
+          + (f", within the deadline of {job_args.deadline_minutes} minutes." if deadline_seconds else ".") + (f" Kept as given: {', '.join(sorted(explicit))}." if explicit else ""))
+    return plan
+
+
+#Batch size autotuning, see --autotune: a few batch sizes are tried on the first segments (for whisper, on the first two minutes of the audio), from the smallest one up
+#while the throughput grows and as many as redo at most half of the work of the run, and the fastest one whose peak RSS stays within the memory limit is kept. It is remembered per machine and model in autotune.json, next to the artifact cache, so that the later runs
+#skip the probe, and recorded in metrics.json. In all the runs, the batch size is halved when the memory runs short in the middle of the run.
+autotune_path = artifact_cache_dir.parent / "autotune.json"
+autotune_batch_sizes = {"whisper": [1, 2, 4, 8], "emotion": [1, 4, 8, 16, 32]}
+autotune_probe_seconds = 120  # Of the audio, for the whisper probe; whisperx batches its voice chunks of up to 30 seconds
+autotune_probe_segments = 32  # For the emotion probe
+autotune_probe_max_share = 0.5  # Of the work of the run: the most that the probe may redo, as only the results of its last batch size are kept
+low_memory_fraction = 0.05  # Of the RAM of the machine: the batch size is halved when less than that is free
+
+
+def hardware_signature():
+    """The CPU model, the cores and the RAM of this machine, as the batch sizes tuned here are only good for it."""
+    cpu_model = os.uname().machine
+    try:
+        with open("/proc/cpuinfo", 'r') as cpuinfo_file:
+            cpu_model = next((line.split(":", 1)[1].strip() for line in cpuinfo_file if line.startswith("model name")), cpu_model)
+    except OSError:
+        pass
+    return f"{cpu_model}, {available_cpu_count()} cores, {round(system_memory_bytes() / 1024 ** 3)} GB"
+
+
+def is_out_of_memory(error):
+    """Whether the error is the model running out of RAM: a MemoryError, or the RuntimeError of the torch CPU allocator or of ctranslate2."""
+    message = str(error).lower()
+    return isinstance(error, MemoryError) or (isinstance(error, RuntimeError) and any(text in message for text in ("can't allocate memory", "out of memory", "bad_alloc")))
+
+
+class BatchSizeTuner:
+    """The batch size of one model: the one remembered from an earlier probe, the probed one or the option, halved when the memory runs short. Records it in the run metrics."""
+
+    def __init__(self, kind, model_parts, default_batch_size):
+        self.kind = kind
+        self.key = json.dumps([kind, hardware_signature(), *model_parts])
+        self.batch_size = default_batch_size
+        self.source = "option"
+        self.probe_results = []
+        self.backoffs = 0
+        remembered = read_json_or_empty(autotune_path).get(self.key) if args.autotune else None
+        if remembered:
+            self.batch_size, self.source = remembered["batch_size"], "remembered"
+            print(f"Batch size autotuning: the {kind} batch size of \033[94m{self.batch_size}\033[0m was tuned on this machine before, see: {autotune_path}")
+        self.record()
+
+    def needs_probe(self):
+        return args.autotune and self.source == "option"
+
+    def probe(self, run_batch, probe_inputs, items, max_batch_size, total_items):
+        """Runs run_batch(probe_inputs, batch_size) with each batch size up to max_batch_size, as long as the peak RSS stays within the limit and the throughput grows,
+        and keeps the fastest one. The items are what the throughput is counted in: seconds of audio, or segments; total_items are those of the whole run, as the probe
+        tries only as many batch sizes as redo at most autotune_probe_max_share of its work. Returns the results of the last run that did not run out of memory, or None."""
+        free_bytes = system_memory_bytes("MemAvailable")
+        memory_limit_bytes = process_rss_bytes() + free_bytes * 0.8 if free_bytes else float("inf")
+        candidates = sorted({size for size in autotune_batch_sizes[self.kind] if size <= max(1, max_batch_size)} | {1})
+        # The results of one probe run are kept, the others are work done again:
+        max_runs = 1 + int(total_items * autotune_probe_max_share // items) if items else 0
+        if max_runs < 2:
+            # Not remembered either, so that the probe runs on a longer media
+            self.source = "too_short_to_probe"
+            print(f"Batch size autotuning: the run is too short to tune the {self.kind} batch size on it, so it stays at {self.batch_size}")
+            self.record()
+            return None
+        candidates = candidates[:max_runs]
+        probe_output, best = None, None
+        print(f"\033[92mBatch size autotuning:\033[0m trying the {self.kind} batch sizes {candidates} on the first {items:g} {'seconds of the audio' if self.kind == 'whisper' else 'segments'}...")
+        for size in candidates:
+            out_of_memory = False
+            with pipeline_metrics.measure(f"autotune:{self.kind}/batch_{size}") as probe_metrics:
+                try:
+                    probe_output = run_batch(probe_inputs, size)
+                except Exception as e:
+                    if not is_out_of_memory(e) or size == candidates[0]:
+                        raise
+                    out_of_memory = True
+            fits = not out_of_memory and probe_metrics["peak_rss_mb"] * 1024 * 1024 <= memory_limit_bytes
+            throughput = items / probe_metrics["wall_seconds"] if probe_metrics["wall_seconds"] else 0.0
+            self.probe_results.append({"batch_size": size, "items_per_second": round(throughput, 3), "peak_rss_mb": probe_metrics["peak_rss_mb"], "fits": fits})
+            if out_of_memory:
+                print(f"Batch size {size}: \033[93mran out of memory\033[0m")
+            else:
+                print(f"Batch size {size}: {throughput:.2f} per second, peak RSS {probe_metrics['peak_rss_mb']:.0f} MB" + ("" if fits else ", \033[93mover the memory limit\033[0m"))
+            if not fits:
+                break  # The bigger ones take more memory still
+            if best is not None and throughput <= best[1]:
+                break  # The bigger ones are rarely faster again
+            best = (size, throughput)
+
+        if best is None:
+            # Even the smallest batch went over the memory limit: run with it, but do not remember it, so that the probe runs again when there is more RAM free
+            self.batch_size, self.source = candidates[0], "fallback"
+            print(f"\033[93mBatch size autotuning:\033[0m no {self.kind} batch size fits within the memory limit of {memory_limit_bytes / (1024 * 1024):.0f} MB, so using the smallest one: {self.batch_size}")
+            self.record()
+            return probe_output
+        self.batch_size, self.source = best[0], "probe"
+        self.remember()
+        print(f"\033[92mBatch size autotuning:\033[0m the {self.kind} batch size is \033[94m{self.batch_size}\033[0m")
+        return probe_output
+
+    def run(self, run_batch, inputs):
+        """Returns run_batch(inputs, batch_size), halving the batch size and trying again when the memory runs short."""
+        while True:
+            try:
+                return run_batch(inputs, self.batch_size)
+            except Exception as e:
+                if not is_out_of_memory(e) or self.batch_size == 1:
+                    raise
+                self.back_off(f"{type(e).__name__}: {e}")
+
+    def check_memory(self):
+        """Halves the batch size before the next batch if the free RAM is low already."""
+        free_bytes, total_bytes = system_memory_bytes("MemAvailable"), system_memory_bytes()
+        if self.batch_size > 1 and total_bytes and free_bytes < total_bytes * low_memory_fraction:
+            self.back_off(f"only {free_bytes // (1024 * 1024)} MB of RAM free")
+
+    def back_off(self, reason):
+        self.batch_size = max(1, self.batch_size // 2)
+        self.backoffs += 1
+        gc.collect()
+        print(f"\033[93mBatch size autotuning:\033[0m {reason}, so the {self.kind} batch size is now {self.batch_size}")
+        if self.source in ("probe", "remembered"):
+            self.remember()
+        self.record()
+
+    def remember(self):
+        with tracker_lock:
+            remembered = read_json_or_empty(autotune_path)
+            remembered[self.key] = {"batch_size": self.batch_size, "probe": self.probe_results, "tuned_at": datetime.datetime.now().isoformat()}
+            autotune_path.parent.mkdir(parents=True, exist_ok=True)
+            write_json_atomically(autotune_path, remembered)
+        self.record()
+
+    def record(self):
+        pipeline_metrics.autotune[self.kind] = {"batch_size": self.batch_size, "source": self.source, "probe": self.probe_results, "backoffs": self.backoffs}
+
+
 def whisperx_transcribe(args):
     # Access additional arguments using kwargs if needed
     #global media_path, output_dir
@@ -259,50 +855,68 @@ def whisperx_transcribe(args):
         #"segment_resolution": "chunk",  # Set to "sentence" or "chunk"
     }
 
-    # Check if the language argument is provided
-    if args.language != "":
-        # User provided --language as an argument
-        language_code = args.language  # Get the specified language code
-        print(f"Language code passed on as argument: {language_code}. We shall pass it on to whisperx transcribe.")
+    def load_whisper_model():
+        # Check if the language argument is provided
+        if args.language != "":
+            # User provided --language as an argument
+            language_code = args.language  # Get the specified language code
+            print(f"Language code passed on as argument: {language_code}. We shall pass it on to whisperx transcribe.")
+    
+            # Load the WhisperX model with the specified language
+            model = whisperx.load_model(
+                whisperx_model_size,
+                device,
+                compute_type=compute_type,
+                language=language_code,
+                threads=faster_whisper_threads,
+                #This one is for newer whisperx versions only:
+                asr_options=asr_options
         
-        # Load the WhisperX model with the specified language
-        model = whisperx.load_model(
-            whisperx_model_size,
-            device,
-            compute_type=compute_type,
-            language=language_code,
-            threads=faster_whisper_threads,
-            #This one is for newer whisperx versions only:
-            asr_options=asr_options
-            
-        )
-    else:
-        # User did not provide the --language argument 
-        #print("No language code passed on as argument. Autodetecting language...")
+            )
+        else:
+            # User did not provide the --language argument 
+            #print("No language code passed on as argument. Autodetecting language...")
+    
+            # Load the WhisperX model without specifying a language (autodetect the language) 
+            model = whisperx.load_model(
+                whisperx_model_size,
+                device,
+                compute_type=compute_type,
+                threads=faster_whisper_threads,
+                #This one is for newer whisperx versions only:
+                asr_options=asr_options
         
-        # Load the WhisperX model without specifying a language (autodetect the language) 
-        model = whisperx.load_model(
-            whisperx_model_size,
-            device,
-            compute_type=compute_type,
-            threads=faster_whisper_threads,
-            #This one is for newer whisperx versions only:
-            asr_options=asr_options
-            
-        )
-    #For the older version use this without specifying these asr_options: 
-    #model = whisperx.load_model(whisperx_model_size, device, compute_type=compute_type, language=language_code, asr_options=asr_options)
+            )
+        return model
+
+    def run_transcription():
+        #For the older version use this without specifying these asr_options: 
+        #model = whisperx.load_model(whisperx_model_size, device, compute_type=compute_type, language=language_code, asr_options=asr_options)
 
  
 
     
     
     
-    audio = whisperx.load_audio(media_path)
+        audio = get_decoded_audio()  # The shared 16 kHz decoded audio, instead of: whisperx.load_audio(media_path)
 
-    #Full: result = model.transcribe(audio, batch_size=batch_size, chunk_size=chunk_size, print_progress=print_progress)
+        #Full: result = model.transcribe(audio, batch_size=batch_size, chunk_size=chunk_size, print_progress=print_progress)
 
-    result = model.transcribe(audio, batch_size=batch_size, print_progress=True)
+        # The model stays loaded in the model registry for the next media, unless it needs the RAM for another model:
+        whisper_model_key = ("whisper", whisperx_model_size, compute_type, args.language, faster_whisper_threads)
+        tuner = BatchSizeTuner("whisper", [whisperx_model_size, compute_type, faster_whisper_threads], batch_size)
+        with get_model_registry().use(whisper_model_key, load_whisper_model, model_ram_estimate_mb.get(whisperx_model_size, 3000)) as model:
+            transcribe_batches = lambda audio_input, size: model.transcribe(audio_input, batch_size=size, print_progress=True)
+            if tuner.needs_probe():
+                probe_audio = audio[:autotune_probe_seconds * decoded_audio_sample_rate]
+                tuner.probe(transcribe_batches, probe_audio, len(probe_audio) / decoded_audio_sample_rate, -(-len(probe_audio) // (30 * decoded_audio_sample_rate)), len(audio) / decoded_audio_sample_rate)
+            result = tuner.run(transcribe_batches, audio)
+        return result
+
+    # The same audio, transcribed with the same model and options before (maybe under another file name), is read from the artifact cache.
+    # The batch size is not in the key: it changes the speed, not the transcript, and --autotune may change it only once the model runs.
+    transcription_cache_key = {"audio": audio_content_hash(), "model": whisperx_model_size, "compute_type": compute_type, "language": args.language, "asr_options": asr_options}
+    result = cached_artifact("transcription", transcription_cache_key, run_transcription)
 
     print("Transcription Result:", result)
     
@@ -346,21 +960,28 @@ def whisperx_align(args, language_code):
         
         
 
-    # Load audio file directly from media_path
-    audio = whisperx.load_audio(media_path)  # Use media_path directly
+    transcription_segments = result["segments"]
+
+    def run_alignment():
+        # The shared decoded audio, no second ffmpeg decoding of media_path:
+        audio = get_decoded_audio()
 
 
     
  
  
-    # Load the alignment model and perform alignment
-    model_a, metadata = whisperx.load_align_model(language_code=language_code, device=device)
+        # Load the alignment model (or reuse it from the model registry) and perform alignment
+        load_align_model = lambda: whisperx.load_align_model(language_code=language_code, device=device)
+        with get_model_registry().use(("align", language_code), load_align_model, model_ram_estimate_mb["align"]) as (model_a, metadata):
     
-    
-    #Full:                 result = align(result["segments"], align_model, align_metadata, input_audio, device, interpolate_method=interpolate_method, return_char_alignments=return_char_alignments, print_progress=print_progress)
+            #Full:                 result = align(result["segments"], align_model, align_metadata, input_audio, device, interpolate_method=interpolate_method, return_char_alignments=return_char_alignments, print_progress=print_progress)
+
+            result = whisperx.align(transcription_segments, model_a, metadata, audio, device,
+                                     return_char_alignments=False, print_progress=True)
+        return result
 
-    result = whisperx.align(result["segments"], model_a, metadata, audio, device,
-                             return_char_alignments=False, print_progress=True)
+    alignment_cache_key = {"audio": audio_content_hash(), "segments": hashlib.sha256(json.dumps(transcription_segments, sort_keys=True, default=float).encode()).hexdigest(), "language": language_code}
+    result = cached_artifact("alignment", alignment_cache_key, run_alignment)
                              
         
 
@@ -386,7 +1007,43 @@ def whisperx_align(args, language_code):
 
 
 
-def whisperx_diarize(args, language_code):  
+def diarize_segments_path():
+    """The JSON file with the speaker turns found by pyannote, before they are assigned to the words."""
+    return output_dir / f"{stem}_diarize_segments.json"
+
+
+def whisperx_diarize_audio():
+    """Runs the pyannote speaker diarization on the decoded audio alone, so it does not need to wait for the transcription. Saves and returns the speaker turns."""
+    print(f"We are starting the speaker diarization (pyannote) of the audio, min speakers: \033[94m{min_speakers}\033[0m, max speakers: \033[94m{max_speakers}\033[0m")
+
+    def run_diarization():
+        #Old:     diarize_model = whisperx.DiarizationPipeline(use_auth_token=YOUR_HF_TOKEN, device=device)
+        load_diarize_model = lambda: DiarizationPipeline(use_auth_token=YOUR_HF_TOKEN, device=device)
+
+        # add min/max number of speakers if known. One model call only: it used to be run twice, once without these limits, with the second result thrown away
+        audio = get_decoded_audio()
+        with get_model_registry().use(("pyannote",), load_diarize_model, model_ram_estimate_mb["pyannote"]) as diarize_model:
+            diarize_segments = diarize_model(audio, min_speakers=min_speakers, max_speakers=max_speakers)
+        # whisperx.assign_word_speakers needs these three columns only
+        return diarize_segments[['start', 'end', 'speaker']].to_dict(orient='records')
+
+    diarization_cache_key = {"audio": audio_content_hash(), "min_speakers": min_speakers, "max_speakers": max_speakers}
+    diarize_records = cached_artifact("diarization", diarization_cache_key, run_diarization)
+
+    # Saved, so that a restarted run does not need to diarize again
+    write_json_atomically(diarize_segments_path(), diarize_records)
+    return pd.DataFrame(diarize_records, columns=['start', 'end', 'speaker'])
+
+
+def load_diarize_segments():
+    """Reads back the speaker turns saved by whisperx_diarize_audio, or returns None if there are none yet."""
+    if not diarize_segments_path().exists():
+        return None
+    with open(diarize_segments_path(), 'r') as f:
+        return pd.DataFrame(json.load(f), columns=['start', 'end', 'speaker'])
+
+
+def whisperx_diarize(args, language_code, diarize_segments=None):  
     # Construct filename for alignment results
     alignment_result_file = output_dir / f"{stem}_alignment.json"  # Update this if using a different suffix
     print (f"For the diarization step we are using this alignment_result_file: \033[94m{alignment_result_file}\033[0m") 
@@ -401,24 +1058,11 @@ def whisperx_diarize(args, language_code):
         print("Error: Could not decode JSON from the alignment result file.")
         return  # Exit if there's an error in decoding    # Initialize diarization model with authentication token
 
-    #Old:     diarize_model = whisperx.DiarizationPipeline(use_auth_token=YOUR_HF_TOKEN, device=device)
-    diarize_model = whisperx.diarize.DiarizationPipeline(use_auth_token=YOUR_HF_TOKEN, device=device)
-
-
-    # add min/max number of speakers if known
-    audio = whisperx.load_audio(media_path)
-    diarize_segments = diarize_model(audio)
-
-    print(f"Min speakers: \033[94m{min_speakers}\033[0m") 
-    print(f"Max speakers: \033[94m{max_speakers}\033[0m") 
- 
-    
-    #Use global args 
-    #min_speakers=3
-    #max_speakers=3
-    
-    
-    diarize_model(audio, min_speakers=min_speakers, max_speakers=max_speakers)
+    # The speaker turns found by the diarization of the audio, which may have run already, in parallel with the transcription and alignment:
+    if diarize_segments is None:
+        diarize_segments = load_diarize_segments()
+    if diarize_segments is None:
+        diarize_segments = whisperx_diarize_audio()
 
     result = whisperx.assign_word_speakers(diarize_segments, result)
     
@@ -541,7 +1185,8 @@ def whisperx_diarize(args, language_code):
         xaxis_rangeslider_visible=False
     )
 
-    fig.show()
+    if not args.no_open:
+        fig.show()
 
 
 def convert_ms_to_ffmpeg_format(ms):
@@ -552,6 +1197,283 @@ def convert_ms_to_ffmpeg_format(ms):
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
     
 
+def fix_short_tsv_segments(tsv_path_local):
+    """Reads the TSV file and returns its rows (header included), with the segments shorter than 500 ms stretched up to the start of the next segment."""
+    updated_tsv_data = []
+    with open(tsv_path_local, 'r') as tsv_file:
+        lines = list(csv.reader(tsv_file, delimiter='\t'))
+        header = lines[0]  # Save header if needed
+        updated_tsv_data.append(header)  # Include header in updated data
+
+        for i in range(1, len(lines)):
+            start_ms = int(lines[i][0])
+            end_ms = int(lines[i][1])
+            duration_ms = end_ms - start_ms
+            
+            if duration_ms < 500:
+                print(f"\033[91m{duration_ms}\033[0m - Duration (ms) in the\033[91m TSV file segment {i}:\033[0m - Start Time (ms): {start_ms}, End Time (ms): {end_ms}, which is too short, so:") 
+
+                
+                if i + 1 < len(lines):
+                    new_end_ms = int(lines[i + 1][0])   # Get start time of next segment 
+                    new_duration_ms = new_end_ms - start_ms  # Calculate new duration
+                    
+                    print(f"\033[94m{new_duration_ms}\033[0m - is the new value of Duration that we have fixed the original duration to.")  
+                    updated_tsv_data.append([start_ms, new_end_ms, lines[i][2]])  # Update with new end time
+                  
+
+                else:
+                    print(f"The last segment remains unchanged: {lines[i]}")
+                    updated_tsv_data.append(lines[i])  # Last segment remains unchanged
+            else:
+                updated_tsv_data.append(lines[i])  # Append segments with acceptable durations
+
+    return updated_tsv_data
+
+
+def open_media_clip(media_path):
+    """Opens the media as a MoviePy VideoFileClip or, if it has no video stream, as an AudioFileClip. Returns the clip and whether it is a video."""
+    #Changed imports with MoviePy update > 2.0. Imported here, as the export worker processes need these too:
+    try:
+        clip = VideoFileClip(str(media_path)).with_memoize(True) # Sets whether the clip should keep the last frame read in memory, see https://zulko.github.io/moviepy/reference/reference/moviepy.Clip.Clip.html#moviepy.Clip.Clip.with_memoize
+        return clip, True  # If it loads as a VideoFileClip, it's a video
+    except:
+        return AudioFileClip(str(media_path)), False  # Fallback to audio-only clip
+
+
+#The preview proxy: the report shows the segments in 300 px high players only, so with --preview_proxy the source is transcoded once, at a low resolution and with a fast preset,
+#and the segment previews of all the stages are cut from that proxy, not from the full resolution source.
+preview_proxy_path = None  # Set once the proxy is ready (or found valid) in this run
+
+
+def media_is_video(media_path):
+    """Whether the media file has a video stream, as far as its MIME type tells."""
+    mime_type, _ = mimetypes.guess_type(media_path)
+    return bool(mime_type and mime_type.startswith('video'))
+
+
+def ensure_preview_proxy():
+    """Transcodes the video once to the low resolution proxy, reused by all the later stages and runs while the source does not change. Returns its path."""
+    global preview_proxy_path
+    if preview_proxy_path is not None:
+        return preview_proxy_path
+
+    proxy_path = output_dir / (stem + f"_preview_proxy_{args.proxy_height}p.mp4")
+    meta_path = proxy_path.with_suffix(".json")
+    source_signature = {**media_source_signature(media_path), "height": args.proxy_height}
+
+    if proxy_path.exists() and read_json_or_empty(meta_path) == source_signature:
+        print(f"Reusing the preview proxy: \033[94m{proxy_path}\033[0m")
+    else:
+        print(f"Transcoding the source once to a {args.proxy_height}p preview proxy, for all the segment previews: \033[94m{proxy_path}\033[0m")
+        proxy_start_time = time.time()
+        temp_proxy_path = proxy_path.with_name("partial_" + proxy_path.name)
+        ffmpeg_command = [
+            "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+            "-i", str(media_path),
+            "-map", "0:v:0", "-map", "0:a:0?",
+            "-vf", f"scale=-2:'min(ih,{args.proxy_height})'",  # Only ever downscale
+            "-c:v", "libx264", "-preset", "veryfast", "-crf", "28", "-threads", str(thread_budget.export_threads),
+            "-g", "48",                      # Short GOPs: quick seeking in the players, and mostly copied GOPs in the smart-cut mode
+            "-c:a", "aac", "-b:a", "192k",   # The audio stays good, as in the chunks mode it is what the emotion model hears
+            "-movflags", "+faststart",
+            str(temp_proxy_path)
+        ]
+        try:
+            subprocess.run(ffmpeg_command, check=True, capture_output=True, text=True)
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(f"Failed to transcode the preview proxy of {media_path}: {e.stderr}") from e
+        os.replace(temp_proxy_path, proxy_path)
+        with open(meta_path, 'w') as f:
+            json.dump(source_signature, f, indent=4)
+        print(f"Preview proxy transcoded in \033[94m{time.time() - proxy_start_time:.2f}\033[0m seconds.")
+
+    preview_proxy_path = proxy_path
+    return preview_proxy_path
+
+
+def preview_source_path():
+    """The media file the segment previews are cut from: the low resolution proxy, if enabled and the media is a video, or else the source itself."""
+    if args.preview_proxy and media_is_video(media_path):
+        return ensure_preview_proxy()
+    return media_path
+
+
+#Smart-cut: only the partial GOPs at the two edges of a segment are re-encoded, the whole GOPs in between are stream-copied.
+#The audio is always re-encoded for the whole segment (cheap), which avoids the A/V misalignment of the plain '-c copy' cut, see the ffmpeg block commented out in extract_media_segments.
+smartcut_containers = {".mp4", ".m4v", ".mov", ".mkv"}
+smartcut_video_encoders = {"h264": ("libx264", "h264_mp4toannexb"), "hevc": ("libx265", "hevc_mp4toannexb")}
+
+
+def probe_smartcut_info(media_path):
+    """Probes the first video stream and its keyframe positions, once. Returns None if the container or the codec does not allow the smart-cut."""
+    if Path(media_path).suffix.lower() not in smartcut_containers:
+        return None
+    try:
+        stream_probe = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=codec_name,pix_fmt", "-of", "json", str(media_path)],
+            check=True, capture_output=True, text=True)
+        streams = json.loads(stream_probe.stdout).get("streams", [])
+        if not streams or streams[0].get("codec_name") not in smartcut_video_encoders:
+            return None
+        audio_probe = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=index", "-of", "csv=p=0", str(media_path)],
+            check=True, capture_output=True, text=True)
+        # Packets only, no decoding, so it is fast even for long videos:
+        packet_probe = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", str(media_path)],
+            check=True, capture_output=True, text=True)
+    except (subprocess.CalledProcessError, FileNotFoundError, json.JSONDecodeError) as e:
+        print(f"\033[91mCould not probe the keyframes, so no smart-cut: {e}\033[0m")
+        return None
+
+    keyframe_times = []
+    for line in packet_probe.stdout.splitlines():
+        fields = line.split(",")
+        if len(fields) >= 2 and "K" in fields[1] and fields[0] not in ("", "N/A"):
+            keyframe_times.append(float(fields[0]))
+    if not keyframe_times:
+        return None
+
+    return {
+        "codec_name": streams[0]["codec_name"],
+        "pix_fmt": streams[0].get("pix_fmt") or "yuv420p",
+        "has_audio": bool(audio_probe.stdout.strip()),
+        "keyframe_times": sorted(keyframe_times),
+    }
+
+
+def export_segment_smartcut(media_path_str, smartcut_info, start_time_sec, end_time_sec, segment_output_file, encoder_threads):
+    """Cuts one segment frame-accurately, stream-copying the whole GOPs inside it. Returns False if there is no whole GOP to copy, so a full re-encode is needed."""
+    keyframe_times = smartcut_info["keyframe_times"]
+    first_keyframe = bisect.bisect_left(keyframe_times, start_time_sec)
+    last_keyframe = bisect.bisect_right(keyframe_times, end_time_sec) - 1
+    if first_keyframe >= len(keyframe_times) or last_keyframe <= first_keyframe:
+        return False
+    copy_start, copy_end = keyframe_times[first_keyframe], keyframe_times[last_keyframe]
+
+    video_encoder, annexb_filter = smartcut_video_encoders[smartcut_info["codec_name"]]
+    ffmpeg_base = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y"]
+
+    with tempfile.TemporaryDirectory(dir=Path(segment_output_file).parent) as temp_dir:
+        # MPEG-TS parts carry their own codec parameters in-band, so the re-encoded edges and the copied middle can be concatenated:
+        parts = []
+        edges = [(start_time_sec, copy_start, "head"), (copy_end, end_time_sec, "tail")]
+        for part_start, part_end, part_name in [edges[0], (copy_start, copy_end, "middle"), edges[1]]:
+            if part_end - part_start < 0.001:
+                continue
+            part_path = os.path.join(temp_dir, part_name + ".ts")
+            if part_name == "middle":
+                video_options = ["-c:v", "copy", "-bsf:v", annexb_filter]
+            else:
+                video_options = ["-c:v", video_encoder, "-pix_fmt", smartcut_info["pix_fmt"], "-preset", "fast", "-crf", "18", "-threads", str(encoder_threads)]
+            subprocess.run(ffmpeg_base + ["-ss", f"{part_start:.6f}", "-i", media_path_str, "-t", f"{part_end - part_start:.6f}",
+                                          "-map", "0:v:0", "-an"] + video_options + ["-avoid_negative_ts", "make_zero", part_path],
+                           check=True, capture_output=True, text=True)
+            parts.append(part_path)
+
+        concat_list_path = os.path.join(temp_dir, "parts.txt")
+        with open(concat_list_path, "w") as concat_list:
+            for part_path in parts:
+                concat_list.write(f"file '{part_path}'\n")
+
+        mux_command = ffmpeg_base + ["-f", "concat", "-safe", "0", "-i", concat_list_path]
+        if smartcut_info["has_audio"]:
+            audio_path = os.path.join(temp_dir, "audio.m4a")
+            subprocess.run(ffmpeg_base + ["-ss", f"{start_time_sec:.6f}", "-i", media_path_str, "-t", f"{end_time_sec - start_time_sec:.6f}",
+                                          "-map", "0:a:0", "-vn", "-c:a", "aac", audio_path],
+                           check=True, capture_output=True, text=True)
+            mux_command += ["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0"]
+        mux_command += ["-c", "copy", "-movflags", "+faststart", segment_output_file]
+        subprocess.run(mux_command, check=True, capture_output=True, text=True)
+    return True
+
+
+def export_segments(media_path_str, segments, tsv_line_count, encoder_threads, logger, clip=None, is_video=True, smartcut_info=None, on_segment_done=None):
+    """Exports the given (segment number, start, end, output file) segments, one by one. Returns (segment number, output file, export time, method) for each."""
+    export_results = []
+    opened_clip_here = False
+    for line_count, start_time_sec, end_time_sec, segment_output_file in segments:
+        # Calculate duration, as sometimes the end time was before the start time: 
+        duration = end_time_sec - start_time_sec
+
+        # Debugging output for timestamps
+        print()
+        print(f"Segment {line_count} out of {tsv_line_count}: Duration (sec): \033[94m{duration:.3f}\033[0m, Start Time (sec): {start_time_sec:.3f}, End Time (sec): {end_time_sec:.3f} - processing it...")
+
+        # Start timer for exporting
+        export_start_time = time.time()
+        export_method = "reencode"
+        # Written under a temporary name first: a file with the final name is always complete, which is what a restarted run relies on
+        temp_output_file = os.path.join(os.path.dirname(segment_output_file), "partial_" + os.path.basename(segment_output_file))
+
+        if smartcut_info is not None:
+            try:
+                if export_segment_smartcut(media_path_str, smartcut_info, start_time_sec, end_time_sec, temp_output_file, encoder_threads):
+                    export_method = "smartcut"
+            except subprocess.CalledProcessError as e:
+                print(f"\033[91mSmart-cut of segment {line_count} failed, so we re-encode it fully instead:\033[0m {e.stderr}")
+
+        if export_method == "reencode":
+            if clip is None:
+                # Opened only now, as smart-cut segments do not need a MoviePy reader at all
+                clip, is_video = open_media_clip(media_path_str)
+                opened_clip_here = True
+
+            # Extract the subclip
+            segment_clip = clip.subclipped(start_time_sec, end_time_sec)
+
+            # Write the segment to a file directly
+            if is_video:
+                #This preview theoretically works, but : `AttributeError: 'FFPLAY_AudioPreviewer' object has no attribute 'logfile'`, so we skip it
+                #segment_clip.preview(fps=20)
+                segment_clip.write_videofile(
+                    temp_output_file,
+                    audio=True,
+                    threads=encoder_threads,
+                    logger=logger,
+                    #codec=video_codec,
+                    #audio_codec=audio_codec
+                )
+            else:
+                segment_clip.write_audiofile(
+                    temp_output_file,
+                    codec='aac',
+                    logger=logger
+                )
+
+        os.replace(temp_output_file, segment_output_file)
+        export_time = time.time() - export_start_time  # Calculate export time
+        export_results.append((line_count, segment_output_file, export_time, export_method))
+        if on_segment_done is not None:
+            on_segment_done(export_results[-1:])
+
+        print(f"Segment \033[94m{line_count:03d} out of {tsv_line_count} \033[0m, saved ({export_method}) in (sec): \033[94m{export_time:.2f}.\033[0m to file: {segment_output_file}")  # Blue  # Print path and time
+
+    if opened_clip_here:
+        clip.close()
+    return export_results
+
+
+def export_segment_shard(media_path_str, segments, tsv_line_count, encoder_threads, smartcut_info):
+    """Process pool worker: exports its shard of the segments, opening its own reader of the media file."""
+    # No progress bars: they would garble each other, coming from several processes at once
+    return export_segments(media_path_str, segments, tsv_line_count, encoder_threads, None, smartcut_info=smartcut_info)
+
+
+def print_export_summary(export_results, total_time, export_workers):
+    """Prints the per-segment timing summary of the export."""
+    if not export_results:
+        return
+    export_times = [result[2] for result in export_results]
+    slowest_line_count, _, slowest_time, _ = max(export_results, key=lambda result: result[2])
+    smartcut_count = sum(1 for result in export_results if result[3] == "smartcut")
+    resumed_count = sum(1 for result in export_results if result[3] == "resumed")
+    print(f"Export summary: \033[94m{len(export_times)}\033[0m segments ({smartcut_count} smart-cut, {len(export_times) - smartcut_count - resumed_count} re-encoded, {resumed_count} from an earlier run), {export_workers} worker(s); per segment (sec): mean {sum(export_times) / len(export_times):.2f}, min {min(export_times):.2f}, max {slowest_time:.2f} (segment {slowest_line_count:03d}).")
+    if total_time > 0:
+        print(f"Sum of the segment export times: {sum(export_times):.2f} sec, wall time: {total_time:.2f} sec, so a parallel speedup of: \033[94m{sum(export_times) / total_time:.2f}x\033[0m")
+
+
 def extract_media_segments(stage_suffix):
     """Extract audio segments from the video based on timestamps from a TSV file."""
 
@@ -584,19 +1506,26 @@ def extract_media_segments(stage_suffix):
     # Validate media file path
     if not media_path.exists():
         raise FileNotFoundError(f"Media file not found: {media_path}")
+
+    # The full resolution source, or its low resolution proxy, see --preview_proxy
+    source_path = preview_source_path()
     #try:
 
     #MoviePy below. Relatively fast: 3 seconds per segment, on average. Speed does not degrade as we go on. It takes time but produces very well aligned audio and video chunks, which simple ffmpeg fails to do.  
 
-    # Attempt to load as a VideoFileClip, fallback to AudioFileClip
-    try:
-        clip = VideoFileClip(str(media_path)).with_memoize(True) # Sets whether the clip should keep the last frame read in memory, see https://zulko.github.io/moviepy/reference/reference/moviepy.Clip.Clip.html#moviepy.Clip.Clip.with_memoize
-        is_video = True  # If it loads as a VideoFileClip, it's a video
-        print(f"Loading as media type: Video")
-    except:
-        clip = AudioFileClip(str(media_path))
-        is_video = False  # Fallback to audio-only clip
-        print(f"Loading as media type: Audio")
+    smartcut_info = None
+    if args.chunk_mode == "smartcut":
+        smartcut_info = probe_smartcut_info(source_path)
+        if smartcut_info is None:
+            print("\033[91mThe smart-cut needs an H.264 or HEVC video in an MP4, MOV or MKV container, so we fall back to the full re-encode.\033[0m")
+        else:
+            print(f"Smart-cut mode: found \033[94m{len(smartcut_info['keyframe_times'])}\033[0m keyframes, the whole GOPs between them shall be copied, not re-encoded.")
+
+    clip, is_video = None, True
+    if smartcut_info is None:
+        # Attempt to load as a VideoFileClip, fallback to AudioFileClip
+        clip, is_video = open_media_clip(source_path)
+        print(f"Loading as media type: {'Video' if is_video else 'Audio'}")
 
 
     
@@ -626,119 +1555,67 @@ def extract_media_segments(stage_suffix):
     with open(media_chunks_scp_path, 'w') as media_chunks_scp:
 
 
-        # Backup the original TSV file
-        tsv_backup_path = str(tsv_path_local) + '.bak'  # Convert to string for concatenation
-        shutil.copyfile(tsv_path_local, tsv_backup_path)
-
-        # Read and process the TSV file
-        updated_tsv_data = []
-        with open(tsv_path_local, 'r') as tsv_file:
-            lines = list(csv.reader(tsv_file, delimiter='\t'))
-            header = lines[0]  # Save header if needed
-            updated_tsv_data.append(header)  # Include header in updated data
-
-            for i in range(1, len(lines)):
-                start_ms = int(lines[i][0])
-                end_ms = int(lines[i][1])
-                duration_ms = end_ms - start_ms
-                
-                if duration_ms < 500:
-                    print(f"\033[91m{duration_ms}\033[0m - Duration (ms) in the\033[91m TSV file segment {i}:\033[0m - Start Time (ms): {start_ms}, End Time (ms): {end_ms}, which is too short, so:") 
-
-                    
-                    if i + 1 < len(lines):
-                        new_end_ms = int(lines[i + 1][0])   # Get start time of next segment 
-                        new_duration_ms = new_end_ms - start_ms  # Calculate new duration
-                        
-                        print(f"\033[94m{new_duration_ms}\033[0m - is the new value of Duration that we have fixed the original duration to.")  
-                        updated_tsv_data.append([start_ms, new_end_ms, lines[i][2]])  # Update with new end time
-                      
-
-                    else:
-                        print(f"The last segment remains unchanged: {lines[i]}")
-                        updated_tsv_data.append(lines[i])  # Last segment remains unchanged
-                else:
-                    updated_tsv_data.append(lines[i])  # Append segments with acceptable durations
-
-                        
-                        
-        # Write updated data back to a new TSV file or overwrite original if preferred
-        with open(tsv_path_local, 'w', newline='') as tsv_file:
-            writer = csv.writer(tsv_file, delimiter='\t')
-            writer.writerows(updated_tsv_data)
-
-        #"""
-        #Manual way to chunk TSV file, via loop: 
-
-        # Read the TSV file for timestamps
-        line_count = 0
-        with open(tsv_path_local, 'r') as tsv_file:
-            next(tsv_file)  # Skip the header
-            
-            for line in csv.reader(tsv_file, delimiter='\t'):
-                start_ms = int(line[0])
-                end_ms = int(line[1])
-                line_count += 1  # Increment the line counter for each processed line
-                
-                # Convert milliseconds to seconds for FFmpeg
-                start_time_sec = start_ms / 1000.0
-                end_time_sec = end_ms / 1000.0
-                #'''
-                       # Calculate duration, as sometimes the end time was before the start time: 
-                duration = end_time_sec - start_time_sec
-                
-                # Debugging output for timestamps
-                print()
-                print(f"Segment {line_count} out of {tsv_line_count}: Duration (sec): \033[94m{duration:.3f}\033[0m, Start Time (sec): {start_time_sec:.3f}, End Time (sec): {end_time_sec:.3f} - processing it...")
-                #'''
-                
-                # Create an output file name for the segment
-                #segment_output_file = output_dir / f"{stem}_{stage_suffix}_segment_{line_count:03d}{media_path.suffix}"
-                #Naah, let us save and recode all media to mp4:
-                segment_output_file = output_dir / f"{stem}_{stage_suffix}_segment_{line_count:03d}.mp4"
-
-                # Start timer for exporting
-                export_start_time = time.time()
-
+        # Read and process the TSV file, stretching the too short segments, for the chunk files only: the TSV file itself stays as whisperx wrote it
+        updated_tsv_data = fix_short_tsv_segments(tsv_path_local)
+
+        # The list of the segments to export: (segment number, start (sec), end (sec), output file)
+        segments_to_export = []
+        for line_count, line in enumerate(updated_tsv_data[1:], start=1):
+            start_time_sec = int(line[0]) / 1000.0
+            end_time_sec = int(line[1]) / 1000.0
+            #Naah, let us save and recode all media to mp4:
+            segment_output_file = output_dir / f"{stem}_{stage_suffix}_segment_{line_count:03d}.mp4"
+            segments_to_export.append((line_count, start_time_sec, end_time_sec, str(segment_output_file)))
+
+        # Resuming: the segments exported by an earlier run that got killed halfway are kept, if the boundaries and the settings are still the same
+        chunk_tracker_key = f"chunk:{stage_suffix}"
+        chunk_fingerprint = segments_fingerprint([(start_sec, end_sec) for _, start_sec, end_sec, _ in segments_to_export], args.chunk_mode, source_path)
+        chunk_progress = read_segment_tracker(tracker_file, chunk_tracker_key)
+        done_segments = set(chunk_progress.get("done", [])) if chunk_progress.get("fingerprint") == chunk_fingerprint else set()
+        resumed_results = [(line_count, segment_output_file, 0.0, "resumed") for line_count, _, _, segment_output_file in segments_to_export
+                           if line_count in done_segments and os.path.exists(segment_output_file)]
+        done_segments = {line_count for line_count, _, _, _ in resumed_results}
+        if resumed_results:
+            print(f"\033[92mResuming the chunking: {len(resumed_results)} out of {len(segments_to_export)} segments had been exported already.\033[0m")
+        segments_to_export = [segment for segment in segments_to_export if segment[0] not in done_segments]
+
+        def record_exported_segments(new_results):
+            done_segments.update(line_count for line_count, _, _, _ in new_results)
+            update_segment_tracker(tracker_file, chunk_tracker_key, {"fingerprint": chunk_fingerprint, "total": tsv_line_count, "done": sorted(done_segments)})
+
+        export_workers = max(1, min(thread_budget.export_workers, len(segments_to_export)))
+        # libx264 threads per worker, so that all the workers together stay within the export threads of the CPU budget:
+        encoder_threads = thread_budget.encoder_threads(export_workers)
+
+        with measure_stage(f"chunk:{stage_suffix}/export") as export_metrics:
+            export_metrics["items"] = len(segments_to_export)
+            if export_workers == 1:
+                # Manual way to chunk TSV file, via loop, reusing the clip loaded above:
+                export_results = export_segments(str(source_path), segments_to_export, tsv_line_count, encoder_threads, "bar", clip, is_video, smartcut_info, record_exported_segments)
+            else:
+                # Contiguous shards, so each reader only seeks forwards; a few shards per worker, so a shard full of long segments does not leave the other workers idle at the end:
+                print(f"Exporting the segments in parallel, with \033[94m{export_workers}\033[0m worker processes, {encoder_threads} encoder thread(s) each...")
+                shard_size = max(1, -(-len(segments_to_export) // (export_workers * 4)))
+                shards = [segments_to_export[k:k + shard_size] for k in range(0, len(segments_to_export), shard_size)]
+                if clip is not None:
+                    clip.close()  # Each worker opens its own reader
+
+                export_results = []
+                # Spawned, not forked: a forked child would inherit the locks and the native thread pools (torch, BLAS) of this process in whatever state they are, and may deadlock
+                with concurrent.futures.ProcessPoolExecutor(max_workers=export_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    futures = [executor.submit(export_segment_shard, str(source_path), shard, tsv_line_count, encoder_threads, smartcut_info) for shard in shards]
+                    for future in concurrent.futures.as_completed(futures):
+                        export_results.extend(future.result())
+                        record_exported_segments(future.result())  # Per shard, as the worker processes do not write to the tracker
+
+            if clip is not None and export_workers == 1:
+                clip.close()
+        export_results = resumed_results + export_results
+
+        # Add each segment to the media_chunks.scp file in Kaldi format, in the TSV order, whatever order the workers finished in:
+        for line_count, segment_output_file, export_time, export_method in sorted(export_results):
+            media_chunks_scp.write(f"segment_{line_count:03d}\t{segment_output_file}\n")
 
-
-                # Determine the MIME type of the input file
-                mime_type, _ = mimetypes.guess_type(media_path)
-                    
-                # Extract the subclip
-                segment_clip = clip.subclipped(start_time_sec, end_time_sec)
-
-                # Write the segment to a file directly
-                
-                
-                if is_video:
-                    #This preview theoretically works, but : `AttributeError: 'FFPLAY_AudioPreviewer' object has no attribute 'logfile'`, so we skip it
-                    #segment_clip.preview(fps=20)
-                    segment_clip.write_videofile(
-                        str(segment_output_file),
-                        audio=True,
-                        #codec=video_codec,
-                        #audio_codec=audio_codec
-                    )
-                else:
-                    segment_clip.write_audiofile(
-                        str(segment_output_file),
-                        #,
-                        codec='aac'
-                    )  
-
-
-
-                export_time = time.time() - export_start_time  # Calculate export time
-                # Add each segment to the media_chunks.scp file in Kaldi format
-                media_chunks_scp.write(f"segment_{line_count:03d}\t{segment_output_file}\n")
-
-                print(f"Segment \033[94m{line_count:03d} out of {tsv_line_count} \033[0m, saved in (sec): \033[94m{export_time:.2f}.\033[0m to file: {segment_output_file}")  # Blue  # Print path and time
-
-                    
-                    
-                #""" 
-                
         '''
         #Or do  it elegantly (?) via a class
         # Process all chunks directly using the processor
@@ -788,6 +1665,7 @@ def extract_media_segments(stage_suffix):
     total_load_time = time.time() - start_time  # Calculate total load time
     print()
     print(f"Finished media chunking in \033[94m{total_load_time:.2f}\033[0m seconds.")   
+    print_export_summary(export_results, total_load_time, export_workers)
 
 
 
@@ -837,10 +1715,514 @@ def read_srt_file(srt_path_local):
     except Exception as e:
         print(f"An error occurred while reading the SRT file: {e}")
         return []
+
+
+
+def read_segment_boundaries(stage_suffix):
+    """Returns the (start_ms, end_ms) of each segment (sentence) of the stage, as whisperx wrote them in the TSV file. See normalize_segments for what the emotion model gets."""
+    tsv_path_local = output_dir / (stem + '_' + stage_suffix + '.tsv')
+    if not tsv_path_local.exists():
+        raise FileNotFoundError(f"TSV file not found: {tsv_path_local}. Please ensure it exists.")
+    with open(tsv_path_local, 'r') as tsv_file:
+        rows = list(csv.reader(tsv_file, delimiter='\t'))
+    return [(int(row[0]), int(row[1])) for row in rows[1:]]
+
+
+def normalize_segments(boundaries, min_ms, max_ms, overlap_ms):
+    """Bounds the length of the audio the emotion model gets, as its cost and memory grow fast with the length: a segment longer than max_ms becomes
+    overlapping windows of max_ms, and a segment shorter than min_ms is merged with the next one (or the previous one, if it is the last), up to max_ms.
+    An overlap_ms of max_ms or more would never move the window on, so the windows do not overlap then.
+    Returns the windows, as (start_ms, end_ms), and for each segment the indexes of its windows, whose scores pool_window_emotions averages back."""
+    windows, window_indexes, segment_windows = [], {}, []
+
+    def window_index(start_ms, end_ms):
+        if (start_ms, end_ms) not in window_indexes:
+            window_indexes[(start_ms, end_ms)] = len(windows)
+            windows.append((start_ms, end_ms))
+        return window_indexes[(start_ms, end_ms)]
+
+    for i, (start_ms, end_ms) in enumerate(boundaries):
+        if max_ms and end_ms - start_ms > max_ms:
+            step_ms = max_ms - overlap_ms if 0 <= overlap_ms < max_ms else max_ms
+            window_starts = list(range(start_ms, end_ms - max_ms, step_ms)) + [end_ms - max_ms]  # The last one ends with the segment
+            segment_windows.append([window_index(window_start, window_start + max_ms) for window_start in window_starts])
+        elif end_ms - start_ms < min_ms and len(boundaries) > 1:
+            if i + 1 < len(boundaries):
+                merged_end_ms = max(end_ms, boundaries[i + 1][1])
+                segment_windows.append([window_index(start_ms, min(merged_end_ms, start_ms + max_ms) if max_ms else merged_end_ms)])
+            else:
+                merged_start_ms = min(start_ms, boundaries[i - 1][0])
+                segment_windows.append([window_index(max(merged_start_ms, end_ms - max_ms) if max_ms else merged_start_ms, end_ms)])
+        else:
+            segment_windows.append([window_index(start_ms, end_ms)])
+    return windows, segment_windows
+
+
+def pool_window_emotions(window_results, segment_windows):
+    """One result per segment: the scores of its windows averaged, label by label."""
+    pooled_results = []
+    for indexes in segment_windows:
+        if len(indexes) == 1:
+            pooled_results.append(window_results[indexes[0]])
+            continue
+        first_result = window_results[indexes[0]]
+        score_sums = dict.fromkeys(first_result["labels"], 0.0)
+        for index in indexes:
+            for label, score in zip(window_results[index]["labels"], window_results[index]["scores"]):
+                score_sums[label] = score_sums.get(label, 0.0) + score
+        pooled_results.append({"key": first_result["key"], "labels": list(score_sums), "scores": [score_sum / len(indexes) for score_sum in score_sums.values()]})
+    return pooled_results
+
+
+def emotion_model_inputs(windows, boundaries, chunk_files, load_audio):
+    """What the emotion model gets for each window, all from the same source: the chunk files, if the windows are the segments unchanged and each one has its chunk file,
+    or else the slices of the decoded audio, for all the windows alike. load_audio is called only for the slices, as it decodes the audio on the first call."""
+    if chunk_files is not None and windows == boundaries and len(chunk_files) == len(windows):
+        return list(chunk_files)
+    audio = load_audio()
+    return [audio_segment_view(audio, start_ms, end_ms) for start_ms, end_ms in windows]
+
+
+def segment_files_needed():
+    """Whether the per-segment media files must be exported: for the emotion model input, or for the playback in the HTML report."""
+    return args.emotion_source == "chunks" or (args.previews and args.report_playback == "chunks")
+
+
+def fragment_source_url():
+    """The URL, relative to the HTML report, of the media that the time range fragments (#t=start,end) play from."""
+    source_path = preview_source_path()
+    if source_path != media_path:
+        return quote(source_path.name)  # The proxy sits next to the report
+    return "../" + quote(media_path.name)
+
+
+# In the fragments playback mode all the players point at the same media file: this script starts each one at its own segment and pauses it at the segment end,
+# as browsers honour the '#t=start,end' end only on the first play.
+fragment_playback_script = """<script>
+document.querySelectorAll('video.segment-fragment').forEach(function (video) {
+    var start = parseFloat(video.dataset.start), end = parseFloat(video.dataset.end);
+    video.addEventListener('play', function () {
+        if (video.currentTime < start - 0.05 || video.currentTime >= end) { video.currentTime = start; }
+    });
+    video.addEventListener('timeupdate', function () {
+        if (video.currentTime >= end) { video.pause(); }
+    });
+});
+</script>
+"""
+
+
+def segments_fingerprint(boundaries, *settings):
+    """A short hash of the segment boundaries and of the settings they were processed with: the per-segment progress of a crashed run is reused only if it matches."""
+    return hashlib.sha1(json.dumps([list(boundaries), [str(setting) for setting in settings]]).encode()).hexdigest()[:16]
+
+
+def slim_emotion_result(result):
+    """Only the parts of an emotion model result that we use: no numpy arrays, so it can be saved as JSON."""
+    return {"key": result.get("key"), "labels": list(result["labels"]), "scores": [float(score) for score in result["scores"]]}
+
+
+class SegmentEmotionCache:
+    """The emotions already detected for the segments of one audio, by one model, kept in a JSON lines file per audio content hash.
+
+    The transcription, alignment and diarization passes mostly cut the same sentences, so a segment whose start and end are both within the tolerance
+    of a cached one is served from here, and only the new boundaries are passed to the model."""
+
+    def __init__(self, cache_path, model_key, tolerance_ms):
+        self.cache_path = Path(cache_path)
+        self.model_key = model_key
+        self.tolerance_ms = tolerance_ms
+        self.start_times = []  # Sorted, for the bisect lookups
+        self.entries = []  # (start_ms, end_ms, result), in the start_times order
+        self.hits = 0
+        self.misses = 0
+        if self.cache_path.exists():
+            with open(self.cache_path, 'r', encoding='utf-8') as cache_file:
+                for line in cache_file:
+                    if not line.endswith('\n'):
+                        break  # A line cut short by a crash
+                    entry = json.loads(line)
+                    if entry["model"] == self.model_key:
+                        self.add(entry["start_ms"], entry["end_ms"], entry["result"])
+
+    def add(self, start_ms, end_ms, result):
+        position = bisect.bisect_left(self.start_times, start_ms)
+        self.start_times.insert(position, start_ms)
+        self.entries.insert(position, (start_ms, end_ms, result))
+
+    def get(self, start_ms, end_ms):
+        """Returns the cached result of the nearest matching segment, or None, and counts the hit or the miss."""
+        first = bisect.bisect_left(self.start_times, start_ms - self.tolerance_ms)
+        last = bisect.bisect_right(self.start_times, start_ms + self.tolerance_ms)
+        matches = [entry for entry in self.entries[first:last] if abs(entry[1] - end_ms) <= self.tolerance_ms]
+        if not matches:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return min(matches, key=lambda entry: abs(entry[0] - start_ms) + abs(entry[1] - end_ms))[2]
+
+    def put_many(self, new_entries):
+        """Adds the (start_ms, end_ms, result) entries and appends them to the cache file."""
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_path, 'a', encoding='utf-8') as cache_file:
+            for start_ms, end_ms, result in new_entries:
+                self.add(start_ms, end_ms, result)
+                cache_file.write(json.dumps({"model": self.model_key, "start_ms": start_ms, "end_ms": end_ms, "result": result}, ensure_ascii=False) + '\n')
+
+
+def open_segment_emotion_cache():
+    """The segment emotion cache of the current audio and emotion model, or None if disabled by --no_cache."""
+    if args.no_cache:
+        return None
+    cache_path = artifact_cache_dir.parent / "segment_emotions" / f"{audio_content_hash()}.jsonl"
+    return SegmentEmotionCache(cache_path, f"{funasr_model_name}|{args.emotion_source}", args.segment_cache_tolerance_ms)
+
+
+def emotion_partial_results_path(stage_suffix):
+    """The checkpoint file, where the emotions are appended batch by batch, one JSON line per segment."""
+    return output_dir / (stem + '_' + stage_suffix + '_emotion_results.partial.jsonl')
+
+
+#The emotion timeline, see --emotion_source timeline: the emotion model runs once over the whole decoded audio, in overlapping windows, and the scores of each
+#20 ms frame (the logits of its classification head, before the softmax) are kept in a memory-mapped .npy file next to the results. The head is linear, so the mean
+#of the frame logits over a segment is the head applied to the mean of its frame embeddings, as the model does for a whole utterance: the scores of any segmentation
+#(of any pass, or per speaker) are then pooled from the timeline with a cumulative sum, with no other model pass.
+emotion_frame_rate = 50  # Frames per second: emotion2vec has a stride of 320 samples at 16 kHz
+emotion_timeline_window_seconds = 30
+emotion_timeline_overlap_seconds = 4  # Only the middle of each window is kept, so each frame has some context on both sides
+emotion_timeline_lock = threading.Lock()  # The emotion steps of the passes may run at the same time, but the timeline is built once
+
+
+def emotion_timeline_paths():
+    """The frame scores (.npy, float32, frames x emotion classes) and their metadata (.json)."""
+    return output_dir / f"{stem}_emotion_timeline.npy", output_dir / f"{stem}_emotion_timeline.json"
+
+
+def emotion_timeline_signature():
+    """What the timeline was computed from: it is rebuilt if any of these change."""
+    return {"audio": audio_content_hash(), "model": funasr_model_name, "frame_rate": emotion_frame_rate,
+            "window_seconds": emotion_timeline_window_seconds, "overlap_seconds": emotion_timeline_overlap_seconds}
+
+
+def build_emotion_timeline(model):
+    """Runs the model over the decoded audio in overlapping windows and writes the frame scores, resuming from the last window written if an earlier run was killed."""
+    import numpy as np
+
+    frames_path, meta_path = emotion_timeline_paths()
+    signature = emotion_timeline_signature()
+    meta = read_json_or_empty(meta_path)
+    head = getattr(getattr(model, "model", None), "proj", None)
+    if head is None:
+        raise RuntimeError(f"The emotion model {funasr_model_name} has no classification head, so it gives no frame scores: use a finetuned one, e.g. iic/emotion2vec_base_finetuned, for --emotion_source timeline.")
+    head_weight = head.weight.detach().cpu().numpy().astype(np.float32)
+    head_bias = head.bias.detach().cpu().numpy().astype(np.float32) if head.bias is not None else 0.0
+
+    audio = get_decoded_audio()
+    samples_per_frame = decoded_audio_sample_rate // emotion_frame_rate
+    num_frames = max(1, -(-len(audio) // samples_per_frame))
+    hop_frames = (emotion_timeline_window_seconds - emotion_timeline_overlap_seconds) * emotion_frame_rate
+    window_frames = emotion_timeline_window_seconds * emotion_frame_rate
+    margin_frames = emotion_timeline_overlap_seconds * emotion_frame_rate // 2
+    window_starts = list(range(0, max(1, num_frames - window_frames + hop_frames), hop_frames))
+
+    if meta.get("signature") == signature and frames_path.exists():
+        frame_scores = np.lib.format.open_memmap(frames_path, mode="r+")
+        windows_done = meta.get("windows_done", 0)
+        print(f"\033[92mResuming the emotion timeline from window {windows_done + 1} out of {len(window_starts)}\033[0m")
+    else:
+        frame_scores = np.lib.format.open_memmap(frames_path, mode="w+", dtype=np.float32, shape=(num_frames, head_weight.shape[0]))
+        meta, windows_done = {"signature": signature, "num_frames": num_frames}, 0
+
+    print(f"Emotion timeline: \033[94m{len(window_starts)}\033[0m windows of {emotion_timeline_window_seconds} seconds, {num_frames} frames, to: {frames_path}")
+    with measure_stage("emotion:timeline/inference") as timeline_metrics:
+        timeline_metrics["items"] = len(window_starts) - windows_done
+        for window_number in range(windows_done, len(window_starts)):
+            start_frame = window_starts[window_number]
+            window_audio = audio[start_frame * samples_per_frame:(start_frame + window_frames) * samples_per_frame]
+            result = model.generate(input=window_audio, granularity="frame", extract_embedding=True, output_dir=None)[0]
+            window_scores = np.asarray(result["feats"], dtype=np.float32) @ head_weight.T + head_bias
+            # The feature encoder may give a frame or two fewer than the window has, so the frames are spread evenly over it:
+            expected_frames = -(-len(window_audio) // samples_per_frame)
+            if len(window_scores) != expected_frames:
+                window_scores = window_scores[np.minimum(np.arange(expected_frames) * len(window_scores) // expected_frames, len(window_scores) - 1)]
+            # The frames near the edges of the window are taken from the neighbouring windows, which see them with more context:
+            keep_from = 0 if window_number == 0 else margin_frames
+            keep_to = len(window_scores) if window_number == len(window_starts) - 1 else min(len(window_scores), window_frames - margin_frames)
+            keep_to = min(keep_to, num_frames - start_frame)
+            frame_scores[start_frame + keep_from:start_frame + keep_to] = window_scores[keep_from:keep_to]
+            meta["labels"] = list(result["labels"])
+            if (window_number + 1) % 10 == 0 or window_number == len(window_starts) - 1:
+                frame_scores.flush()
+                meta["windows_done"] = window_number + 1
+                write_json_atomically(meta_path, meta)
+                print(f"Emotion timeline windows done: \033[94m{window_number + 1} out of {len(window_starts)}\033[0m")
+    meta["complete"] = True
+    write_json_atomically(meta_path, meta)
+    del frame_scores
+
+
+def emotion_timeline_ready():
+    frames_path, meta_path = emotion_timeline_paths()
+    meta = read_json_or_empty(meta_path)
+    return frames_path.exists() and meta.get("complete") and meta.get("signature") == emotion_timeline_signature()
+
+
+def timeline_segment_emotions(boundaries):
+    """The emotions of the segments, pooled from the emotion timeline: the softmax of the mean frame scores over each segment, for all the segments at once."""
+    import numpy as np
+
+    frames_path, meta_path = emotion_timeline_paths()
+    labels = read_json_or_empty(meta_path)["labels"]
+    frame_scores = np.load(frames_path, mmap_mode="r")
+    num_frames = len(frame_scores)
+
+    bounds = np.asarray(boundaries, dtype=np.int64).reshape(-1, 2)
+    start_frames = np.clip(bounds[:, 0] * emotion_frame_rate // 1000, 0, num_frames - 1)
+    end_frames = np.clip(-(-bounds[:, 1] * emotion_frame_rate // 1000), start_frames + 1, num_frames)  # At least one frame each
+    cumulative_scores = np.zeros((num_frames + 1, frame_scores.shape[1]), dtype=np.float64)
+    np.cumsum(frame_scores, axis=0, dtype=np.float64, out=cumulative_scores[1:])
+    mean_scores = (cumulative_scores[end_frames] - cumulative_scores[start_frames]) / (end_frames - start_frames)[:, None]
+    probabilities = np.exp(mean_scores - mean_scores.max(axis=1, keepdims=True))
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+    return [{"key": f"segment_{i + 1:03d}", "labels": labels, "scores": [float(score) for score in row]} for i, row in enumerate(probabilities)]
+
+
+def infer_segment_emotions(stage_suffix, model):
+    """Runs the emotion model over the segments of the stage and returns its results, one per segment, in the segments order.
+
+    The model gets the windows of normalize_segments: the segments of a usual length whole, the too long ones split, the too short ones merged with a neighbour."""
+    boundaries = read_segment_boundaries(stage_suffix)
+    windows, segment_windows = normalize_segments(boundaries, args.min_segment_ms, args.max_segment_ms, args.segment_overlap_ms)
+    if len(windows) != len(boundaries) or windows != boundaries:
+        print(f"Segment normalization: the \033[94m{len(boundaries)}\033[0m segments make \033[94m{len(windows)}\033[0m windows for the emotion model, "
+              f"of {args.min_segment_ms} to {args.max_segment_ms} ms, overlapping by {args.segment_overlap_ms} ms where split.")
+
+    if args.emotion_source == "waveform":
+        # Chunk free: the segments are sliced straight out of the decoded audio, as numpy views, no media files in between.
+        print(f"Emotion detection of \033[94m{len(windows)}\033[0m segments, sliced in memory from the decoded audio, in batches of similar durations, of up to {emotion_batch_size} segments and {args.emotion_batch_seconds:g} seconds...")
+        chunk_files = None
+    else:
+        # Open media_chunks.scp for reading in the new output directory
+        media_chunks_scp_path = output_dir / (stem+"_"+ stage_suffix + '_media_chunks.scp')
+        print(f"Emotion detection of the chunks listed in: {media_chunks_scp_path}...")
+
+        # Check if the media_chunks.scp file exists
+        if not media_chunks_scp_path.exists():
+            raise FileNotFoundError(f"The chunks list file does not exist at: {media_chunks_scp_path}. Please ensure that it has been created correctly. You may need to reset the steps completed manually in the 'tracker.json' in the output folder, too.")
+
+        # The files listed in the Kaldi format list, passed to the model as a list, so that we can resume from any of them:
+        with open(media_chunks_scp_path, 'r') as media_chunks_scp:
+            chunk_files = [line.rstrip('\n').split('\t', 1)[1] for line in media_chunks_scp if '\t' in line]
+
+        # Not some windows from the chunk files and some from the decoded audio, as the two differ a little (the encoder, the keyframe cuts of --chunk_mode smartcut):
+        if windows != boundaries or len(chunk_files) != len(boundaries):
+            print("The windows of the emotion model are not the segments of the chunk files, so it gets all of them sliced out of the decoded audio instead.")
+
+    model_inputs = emotion_model_inputs(windows, boundaries, chunk_files, get_decoded_audio)
+    fingerprint = segments_fingerprint(windows, args.emotion_source, funasr_model_name)
+    window_results = generate_with_checkpoints(stage_suffix, model, model_inputs, fingerprint, windows)
+    return pool_window_emotions(window_results, segment_windows)
+
+
+def duration_buckets(durations_ms, max_batch_seconds, max_batch_size):
+    """Groups the segments into batches of similar durations: sorted by the duration, each batch as full as its padded length (its count times its longest segment)
+    stays within max_batch_seconds of audio and its count within max_batch_size. Returns the batches as lists of the indexes into durations_ms."""
+    batches, batch = [], []
+    for index in sorted(range(len(durations_ms)), key=lambda index: durations_ms[index]):
+        # The longest segment of the batch is the one added last, as they come sorted:
+        if batch and (len(batch) >= max_batch_size or (len(batch) + 1) * durations_ms[index] > max_batch_seconds * 1000):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def generate_with_checkpoints(stage_suffix, model, model_inputs, fingerprint, windows):
+    """Runs the model over the inputs in checkpoint batches, saving each batch and the progress in the tracker, so that a restarted run resumes from the first unfinished segment.
+    The windows are the (start_ms, end_ms) of the inputs, for their durations and for the segment emotion cache."""
+    partial_results_path = emotion_partial_results_path(stage_suffix)
+    tracker_key = f"emotion:{stage_suffix}"
+    rec_result = []
+
+    if read_segment_tracker(tracker_file, tracker_key).get("fingerprint") == fingerprint and partial_results_path.exists():
+        with open(partial_results_path, 'r', encoding='utf-8') as partial_file:
+            for line in partial_file:
+                if not line.endswith('\n'):
+                    break  # A line cut short by the crash
+                rec_result.append(json.loads(line))
+        rec_result = rec_result[:len(model_inputs)]
+        print(f"\033[92mResuming the emotion detection from segment {len(rec_result) + 1} out of {len(model_inputs)}\033[0m, the earlier ones are read back from: {partial_results_path}")
+    elif partial_results_path.exists():
+        partial_results_path.unlink()  # From other segments or settings
+
+    segment_cache = open_segment_emotion_cache()
+    tuner = BatchSizeTuner("emotion", [funasr_model_name, args.emotion_source, thread_budget.torch_threads], emotion_batch_size)
+    model_batches = [0]
+
+    def run_emotion_batch(indexes, max_batch_size):
+        """The emotions of the segments, in the order of the indexes, from the model run over the batches of the segments of similar durations, so with little padding."""
+        results = [None] * len(indexes)
+        for bucket in duration_buckets([windows[index][1] - windows[index][0] for index in indexes], args.emotion_batch_seconds, max_batch_size):
+            generated = model.generate(input=[model_inputs[indexes[k]] for k in bucket], batch_size=len(bucket), output_dir="./outputs", granularity="utterance", extract_embedding=False)
+            for k, result in zip(bucket, generated):
+                results[k] = slim_emotion_result(result)
+            model_batches[0] += 1
+        return results
+
+    with measure_stage(f"emotion:{stage_suffix}/inference") as inference_metrics:
+        inference_metrics["items"] = len(model_inputs) - len(rec_result)
+
+        for batch_start in range(len(rec_result), len(model_inputs), emotion_checkpoint_every):
+            batch_end = min(batch_start + emotion_checkpoint_every, len(model_inputs))
+            batch_result = [segment_cache.get(*windows[index]) if segment_cache else None for index in range(batch_start, batch_end)]
+
+            # Only the segments not found in the segment cache are passed to the model:
+            missing = [index for index, result in zip(range(batch_start, batch_end), batch_result) if result is None]
+            if missing:
+                generated = []
+                if tuner.needs_probe():
+                    probe_indexes = missing[:autotune_probe_segments]
+                    generated = tuner.probe(run_emotion_batch, probe_indexes, len(probe_indexes), len(probe_indexes), len(model_inputs) - len(rec_result)) or []
+                if len(generated) < len(missing):
+                    tuner.check_memory()
+                    generated += tuner.run(run_emotion_batch, missing[len(generated):])
+                for index, result in zip(missing, generated):
+                    batch_result[index - batch_start] = result
+                if segment_cache:
+                    segment_cache.put_many([(*windows[index], result) for index, result in zip(missing, generated)])
+
+            with open(partial_results_path, 'a', encoding='utf-8') as partial_file:
+                for result in batch_result:
+                    partial_file.write(json.dumps(result, ensure_ascii=False) + '\n')
+                partial_file.flush()
+                os.fsync(partial_file.fileno())
+            rec_result.extend(batch_result)
+            update_segment_tracker(tracker_file, tracker_key, {"fingerprint": fingerprint, "total": len(model_inputs), "done": len(rec_result)})
+            print(f"Emotions detected for segments: \033[94m{len(rec_result)} out of {len(model_inputs)}\033[0m")
+
+    inference_metrics["model_batches"] = model_batches[0]
+    if segment_cache:
+        inference_metrics.update({"cache_hits": segment_cache.hits, "cache_misses": segment_cache.misses})
+        print(f"Segment emotion cache: \033[92m{segment_cache.hits} hits\033[0m, {segment_cache.misses} misses, within {segment_cache.tolerance_ms} ms, see: {segment_cache.cache_path}")
+    return rec_result
+
+
+def emotion_model_location(model_name):
+    """The folder of the emotion model in the universal modelscope cache, to load it offline, or, if it is not there yet, its name, to download it."""
+    modelscope_hub_dir = Path.home() / ".cache" / "modelscope" / "hub"
+    for model_dir in (modelscope_hub_dir / model_name, modelscope_hub_dir / "models" / model_name):
+        if model_dir.is_dir():
+            return str(model_dir)
+    return model_name
+
+
+def emotion_results_path(stage_suffix):
+    """The JSON file with the emotions detected for the segments of the stage."""
+    return output_dir / (stem + '_' + stage_suffix + '_emotion_results.json')
+
+
+def load_segment_emotions(stage_suffix):
+    """Reads back the emotions detected for the stage, or returns None if they have not been detected yet."""
+    results_path = emotion_results_path(stage_suffix)
+    if not results_path.exists():
+        return None
+    with open(results_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def detect_segment_emotions(stage_suffix):
+    """Loads the emotion model, detects the emotions of all the segments of the stage and saves them. Returns the results, one per segment."""
+    print()
+    print(f"\033[92mStage: Detecting the emotions of the segments of: \033[0m{stage_suffix}")
+    print(f"\033[94mThe files for the emotion detection model (the 'electronic brain' behind it all) may be downloaded now, too. Go and take a coffee then.\033[0m")  # Blue
+
+    #Download of a models at first is needed, see https://github.com/ddlBoJack/emotion2vec
+    """
+from modelscope.pipelines import pipeline
+from modelscope.utils.constant import Tasks
+
+inference_pipeline = pipeline(
+    task=Tasks.emotion_recognition,
+    model="iic/emotion2vec_plus_large", # Alternatives: iic/emotion2vec_plus_seed, iic/emotion2vec_plus_base, iic/emotion2vec_plus_large and iic/emotion2vec_base_finetuned
+    model_revision="master")
+
+rec_result = inference_pipeline('https://isv-data.oss-cn-hangzhou.aliyuncs.com/ics/MaaS/ASR/test_audio/asr_example_zh.wav', output_dir="./outputs", granularity="utterance", extract_embedding=False)
+print(rec_result)
+
+"""
+
+    # Process the media_chunks.scp file with FunASR or any other model.
+    #If offline  - modify the filepath:
+    #model = AutoModel(model=str(Path.home() / ".cache" / "modelscope" / "hub" / "iic" / "emotion2vec_base_finetuned"), device=device)
+    #If online - it will be downloaded and checked each time, but requires Net connection always:
+    '''
+    
+from funasr import AutoModel
+
+model = AutoModel(model=funasr_model_name, disable_update=disable_update) # Alternative: iic/emotion2vec_plus_seed, iic/emotion2vec_plus_base, iic/emotion2vec_plus_large and iic/emotion2vec_base_finetuned
+
+wav_file = f"{model.model_path}/example/test.wav"
+rec_result = model.generate(wav_file, output_dir="./outputs", granularity="utterance", extract_embedding=False)
+print(rec_result)
+
+
+Or, in command line:
+funasr ++model='iic/emotion2vec_base_finetuned' ++vad_model="fsmn-vad" ++punc_model="ct-punc" ++input=""
+funasr ++model='iic/emotion2vec_base_finetuned' ++vad_model="fsmn-vad"   ++input=""
+
+'''
+    
+
+    #Either online, download once only, it throws an error if no Net:    
+    #model = AutoModel(model="iic/emotion2vec_base_finetuned", device=device, disable_update=False)
+    # Or offline - load the model using the universal cache directory in one line
+
+    emotion_model_path = emotion_model_location(funasr_model_name)
+    load_emotion_model = lambda: AutoModel(model=emotion_model_path, device=device, disable_update=True if emotion_model_path != funasr_model_name else disable_update)
+
+    #Download it, if needed:
+    #model = AutoModel(model=str(Path.home() / ".cache" / "modelscope" / "hub" / "iic" / "emotion2vec_plus_large"), device=device, disable_update=False)
+
         
-        
+    # Generate the results, from the chunk files or from the in-memory waveform slices, see --emotion_source; the same segments of the same audio are read from the artifact cache
+    emotion_cache_key = {"audio": audio_content_hash(), "segments": segments_fingerprint(read_segment_boundaries(stage_suffix)), "model": funasr_model_name, "emotion_source": args.emotion_source,
+                         "normalization": [args.min_segment_ms, args.max_segment_ms, args.segment_overlap_ms]}
+
+    def run_emotion_model():
+        # Loaded once for all the passes (and all the media, in one process), see ModelRegistry
+        emotion_model_estimate_mb = model_ram_estimate_mb.get(funasr_model_name, model_ram_estimate_mb["emotion2vec"])
+        if args.emotion_source == "timeline":
+            with emotion_timeline_lock:
+                if not emotion_timeline_ready():
+                    with get_model_registry().use(("emotion2vec", emotion_model_path), load_emotion_model, emotion_model_estimate_mb) as model:
+                        build_emotion_timeline(model)
+            return timeline_segment_emotions(read_segment_boundaries(stage_suffix))
+        with get_model_registry().use(("emotion2vec", emotion_model_path), load_emotion_model, emotion_model_estimate_mb) as model:
+            return infer_segment_emotions(stage_suffix, model)
+
+    rec_result = cached_artifact("emotions", emotion_cache_key, run_emotion_model)
+    
+    #print(rec_result)
+    
+    output_path = output_dir / (stem +  '_' + stage_suffix + '_recognized_emotions_dictionaries.txt')
+    
+    # Save the results to the specified output path without using a loop
+    with open(output_path, 'w') as f:
+        f.write(str(rec_result))  # Write the entire result as a string
+
+    # The emotion results in JSON too, to be read back by the report stage, also after a restart:
+    write_json_atomically(emotion_results_path(stage_suffix), [slim_emotion_result(result) for result in rec_result])
+    # All done, so the batch by batch checkpoint is not needed any more:
+    if emotion_partial_results_path(stage_suffix).exists():
+        emotion_partial_results_path(stage_suffix).unlink()
+
+    return rec_result
+
+
 
-def display_result_temp_html(stage_suffix, language_code, funasr_model_name):
+def display_result_temp_html(stage_suffix, language_code, funasr_model_name, rec_result=None):
 
 
     print()
@@ -901,79 +2283,14 @@ def display_result_temp_html(stage_suffix, language_code, funasr_model_name):
         '<unk>': '❓'
     }
 
-    # Open media_chunks.scp for reading in the new output directory
-    media_chunks_scp_path = output_dir / (stem+"_"+ stage_suffix + '_media_chunks.scp')
-
     print()
     
-    print(f"Emotion detection of the chunks listed in: {media_chunks_scp_path}...")
-    
-    #Download of a models at first is needed, see https://github.com/ddlBoJack/emotion2vec
-    """
-from modelscope.pipelines import pipeline
-from modelscope.utils.constant import Tasks
+    # The emotions detected at the emotion stage, or, if it has not run, detected now:
+    if rec_result is None:
+        rec_result = load_segment_emotions(stage_suffix)
+    if rec_result is None:
+        rec_result = detect_segment_emotions(stage_suffix)
 
-inference_pipeline = pipeline(
-    task=Tasks.emotion_recognition,
-    model="iic/emotion2vec_plus_large", # Alternatives: iic/emotion2vec_plus_seed, iic/emotion2vec_plus_base, iic/emotion2vec_plus_large and iic/emotion2vec_base_finetuned
-    model_revision="master")
-
-rec_result = inference_pipeline('https://isv-data.oss-cn-hangzhou.aliyuncs.com/ics/MaaS/ASR/test_audio/asr_example_zh.wav', output_dir="./outputs", granularity="utterance", extract_embedding=False)
-print(rec_result)
-
-"""
-
-    # Process the media_chunks.scp file with FunASR or any other model.
-    #If offline  - modify the filepath:
-    #model = AutoModel(model=str(Path.home() / ".cache" / "modelscope" / "hub" / "iic" / "emotion2vec_base_finetuned"), device=device)
-    #If online - it will be downloaded and checked each time, but requires Net connection always:
-    '''
-    
-from funasr import AutoModel
-
-model = AutoModel(model=funasr_model_name, disable_update=disable_update) # Alternative: iic/emotion2vec_plus_seed, iic/emotion2vec_plus_base, iic/emotion2vec_plus_large and iic/emotion2vec_base_finetuned
-
-wav_file = f"{model.model_path}/example/test.wav"
-rec_result = model.generate(wav_file, output_dir="./outputs", granularity="utterance", extract_embedding=False)
-print(rec_result)
-
-
-Or, in command line:
-funasr ++model='iic/emotion2vec_base_finetuned' ++vad_model="fsmn-vad" ++punc_model="ct-punc" ++input=""
-funasr ++model='iic/emotion2vec_base_finetuned' ++vad_model="fsmn-vad"   ++input=""
-
-'''
-    
-
-    # Check if the media_chunks.scp file exists
-    if not media_chunks_scp_path.exists():
-        raise FileNotFoundError(f"The chunks list file does not exist at: {media_chunks_scp_path}. Please ensure that it has been created correctly. You may need to reset the steps completed manually in the 'tracker.json' in the output folder, too.")
-
-    # If it exists, print out which files are being passed to the model
-    print(f"We are passing this list of files in the Kaldi format to the model: {media_chunks_scp_path}")
-    
-
-    #Either online, download once only, it throws an error if no Net:    
-    #model = AutoModel(model="iic/emotion2vec_base_finetuned", device=device, disable_update=False)
-    # Or offline - load the model using the universal cache directory in one line
-
-    model = AutoModel(model=str(Path.home() / ".cache" / "modelscope" / "hub" / "iic" / "emotion2vec_base_finetuned"), device=device, disable_update=True)
-
-    #Download it, if needed:
-    #model = AutoModel(model=str(Path.home() / ".cache" / "modelscope" / "hub" / "iic" / "emotion2vec_plus_large"), device=device, disable_update=False)
-
-        
-    # Load the model and generate results
-    rec_result = model.generate(input=str(media_chunks_scp_path), output_dir="./outputs", granularity="utterance", extract_embedding=False)
-    
-    #print(rec_result)
-    
-    output_path = output_dir / (stem +  '_' + stage_suffix + '_recognized_emotions_dictionaries.txt')
-    
-    # Save the results to the specified output path without using a loop
-    with open(output_path, 'w') as f:
-        f.write(str(rec_result))  # Write the entire result as a string
-    
 
     with open(output_html_path, 'w', encoding='utf-8') as output_file:
     # Write HTML content
@@ -1191,6 +2508,10 @@ funasr ++model='iic/emotion2vec_base_finetuned' ++vad_model="fsmn-vad"   ++input
                 #segment_filepath = f"{stem}_{stage_suffix}_segment_{i+1:03d}{original_extension}"  # Prepare segment filepath
                 #But we changed all to .mp4 so
                 segment_filepath = f"{stem}_{stage_suffix}_segment_{i+1:03d}.mp4"  # Prepare segment filepath
+                if args.report_playback == "fragments":
+                    # No chunk file: a time range of the original media, see https://www.w3.org/TR/media-frags/
+                    segment_start_s, segment_end_s = start_time_ms.total_seconds(), end_time_ms.total_seconds()
+                    segment_filepath = f"{fragment_source_url()}#t={segment_start_s:.3f},{segment_end_s:.3f}"
                 
                 output_file.write("<tr>\n")  # Start a new table row
                 output_file.write("<td>\n")  # Open left column
@@ -1243,7 +2564,12 @@ funasr ++model='iic/emotion2vec_base_finetuned' ++vad_model="fsmn-vad"   ++input
 
                 output_file.write("</td><td>\n")  # Close left column and open right column
                 
-                output_file.write(f"<video class='video-small' controls><source src='{segment_filepath}' type='video/mp4'>Your browser does not support the video tag.</video><br>\n")
+                if args.report_playback == "fragments":
+                    output_file.write(f"<video class='video-small segment-fragment' controls preload='metadata' data-start='{segment_start_s:.3f}' data-end='{segment_end_s:.3f}'><source src='{segment_filepath}'>Your browser does not support the video tag.</video><br>\n")
+                elif (output_dir / segment_filepath).exists():
+                    output_file.write(f"<video class='video-small' controls><source src='{segment_filepath}' type='video/mp4'>Your browser does not support the video tag.</video><br>\n")
+                else:
+                    output_file.write("(No playback preview exported for this segment, see: --previews)<br>\n")
 
                 output_file.write("</td></tr>\n")  # Close table row
 
@@ -1252,6 +2578,8 @@ funasr ++model='iic/emotion2vec_base_finetuned' ++vad_model="fsmn-vad"   ++input
                 break  # Exit the loop if index is out of range
 
         output_file.write("</table>\n")  # Close the table
+        if args.report_playback == "fragments":
+            output_file.write(fragment_playback_script)
         output_file.write("</body>\n</html>")
         print()
 
@@ -1288,14 +2616,15 @@ funasr ++model='iic/emotion2vec_base_finetuned' ++vad_model="fsmn-vad"   ++input
 
 
         #print(f"The output path of the resulting HTML is: {output_html_path}" )
-        print(f"Opening the result \033[94m{output_html_path}\033[0m in the default browser. It may also take some time and it may fail if there is no default browser or the filename has weird characters. ")
-        print()
-        print()
-        # Open the HTML file in the default web browser
-        # Encode the file path
-        encoded_path = quote(os.path.abspath(output_html_path))
+        if not args.no_open:
+            print(f"Opening the result \033[94m{output_html_path}\033[0m in the default browser. It may also take some time and it may fail if there is no default browser or the filename has weird characters. ")
+            print()
+            print()
+            # Open the HTML file in the default web browser
+            # Encode the file path
+            encoded_path = quote(os.path.abspath(output_html_path))
 
-        webbrowser.open(f'file://{os.path.abspath(encoded_path)}')
+            webbrowser.open(f'file://{os.path.abspath(encoded_path)}')
 
 
 
@@ -1392,14 +2721,24 @@ Present this analysis in a flowing narrative style, similar to how one might des
 '''
         
 
+def write_json_atomically(json_path, data):
+    """Writes the JSON file via a temporary file and a rename, so that a run killed halfway never leaves a truncated file behind."""
+    json_path = Path(json_path)
+    temp_path = json_path.with_name(json_path.name + ".tmp")
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, json_path)
+
+
 def initialize_tracker(tracker_file):
     # Initialize tracker with all stages set to "not started"
     output_dir.mkdir(exist_ok=True)  # Create the folder if it doesn't exist
 
     tracker_data = {
     }
-    with open(tracker_file, 'w') as f:
-        json.dump(tracker_data, f)
+    write_json_atomically(tracker_file, tracker_data)
 
 
 
@@ -1409,18 +2748,289 @@ def read_tracker(tracker_file):
             return json.load(f)
     return {}
 
+# The pipeline steps may run in parallel threads, and all of them write to the same tracker file:
+tracker_lock = threading.Lock()
+
 def update_tracker(tracker_file, stage):
-    statuses = read_tracker(tracker_file)
-    #statuses[stage] = ("completed", datetime.datetime.now().isoformat())
-    statuses[stage] = ("completed")
-    
-    with open(tracker_file, 'w') as f:
-        json.dump(statuses, f)
+    with tracker_lock:
+        statuses = read_tracker(tracker_file)
+        #statuses[stage] = ("completed", datetime.datetime.now().isoformat())
+        statuses[stage] = ("completed")
+        write_json_atomically(tracker_file, statuses)
     print(f"The Run Tracker status quo: \033[94m{statuses}\033[0m")
+
+
+def update_node_tracker(tracker_file, node_name, node_status):
+    """Records the status and the timings of one pipeline step (node) in the tracker, under "nodes"."""
+    with tracker_lock:
+        statuses = read_tracker(tracker_file)
+        statuses.setdefault("nodes", {})[node_name] = node_status
+        write_json_atomically(tracker_file, statuses)
+
+
+def read_segment_tracker(tracker_file, tracker_key):
+    """The per-segment progress of a chunk export or emotion detection step: its fingerprint, and which segments are done."""
+    with tracker_lock:
+        return read_tracker(tracker_file).get("segments", {}).get(tracker_key, {})
+
+
+def update_segment_tracker(tracker_file, tracker_key, segment_progress):
+    """Records the per-segment progress of a step in the tracker, under "segments"."""
+    with tracker_lock:
+        statuses = read_tracker(tracker_file)
+        statuses.setdefault("segments", {})[tracker_key] = segment_progress
+        write_json_atomically(tracker_file, statuses)
         
         
 
   	
+#The performance metrics of the pipeline steps and of their sub-steps, written to metrics.json next to tracker.json, see also --metrics_summary
+metrics_history_length = 20  # How many runs metrics.json keeps, to compare e.g. the whisperx or funasr versions
+metrics_library_names = ["whisperx", "faster-whisper", "ctranslate2", "torch", "funasr", "pyannote.audio", "moviepy"]
+pipeline_metrics = None  # The MetricsRecorder of the media file being processed, see configure_media
+
+
+class MetricsRecorder:
+    """Records the wall time, the CPU time, the peak RSS, the item counts and the real-time factor of the steps of one run.
+
+    The CPU times are those of the whole process (all its threads, so also of the steps running at the same time) and of its finished child processes, e.g. ffmpeg.
+    The peak RSS is of this process only, sampled by a background thread."""
+
+    def __init__(self, rss_sample_interval=0.05):
+        self.stages = {}
+        self.stage_order = []
+        self.lock = threading.Lock()
+        self.active_peaks = {}  # The steps being measured now: their peak RSS so far
+        self.rss_sample_interval = rss_sample_interval
+        self.sampler_thread = None
+        self.run_started_at = datetime.datetime.now().isoformat()
+        self.run_start_time = time.time()
+        self.autotune = {}  # The batch sizes used, by the model kind, see BatchSizeTuner
+
+    def sample_rss(self):
+        while True:
+            rss_bytes = process_rss_bytes()
+            with self.lock:
+                if not self.active_peaks:
+                    self.sampler_thread = None  # Started again by the next step measured
+                    return
+                for name in self.active_peaks:
+                    self.active_peaks[name] = max(self.active_peaks[name], rss_bytes)
+            time.sleep(self.rss_sample_interval)
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        """Measures the step. Yields a dict, where the step may put its "items" count."""
+        stage_metrics = {}
+        with self.lock:
+            self.active_peaks[name] = process_rss_bytes()
+            if self.sampler_thread is None:
+                self.sampler_thread = threading.Thread(target=self.sample_rss, daemon=True)
+                self.sampler_thread.start()
+        wall_start, cpu_start, children_start = time.time(), time.process_time(), resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield stage_metrics
+        finally:
+            children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+            with self.lock:
+                peak_rss_bytes = max(self.active_peaks.pop(name), process_rss_bytes())
+                stage_metrics.update({
+                    "wall_seconds": round(time.time() - wall_start, 3),
+                    "cpu_seconds": round(time.process_time() - cpu_start, 3),
+                    "children_cpu_seconds": round((children_end.ru_utime + children_end.ru_stime) - (children_start.ru_utime + children_start.ru_stime), 3),
+                    "peak_rss_mb": round(peak_rss_bytes / (1024 * 1024), 1),
+                })
+                if name not in self.stages:
+                    self.stage_order.append(name)
+                self.stages[name] = stage_metrics
+
+    def merge(self, other):
+        """Adds the steps measured by another recorder, e.g. the decoding ahead of the --batch mode."""
+        with self.lock:
+            for name in other.stage_order:
+                if name not in self.stages:
+                    self.stage_order.append(name)
+                self.stages[name] = other.stages[name]
+
+    def to_json(self, media_duration_seconds, node_group):
+        stages = {}
+        for name in self.stage_order:
+            stage_metrics = dict(self.stages[name])
+            if media_duration_seconds:
+                stage_metrics["real_time_factor"] = round(stage_metrics["wall_seconds"] / media_duration_seconds, 4)
+            stages[name] = stage_metrics
+        total_seconds = time.time() - self.run_start_time
+        return {
+            "run_started_at": self.run_started_at,
+            "node_group": node_group,
+            "media_duration_seconds": media_duration_seconds,
+            "wall_seconds": round(total_seconds, 3),
+            "real_time_factor": round(total_seconds / media_duration_seconds, 4) if media_duration_seconds else None,
+            "peak_rss_mb": round(process_rss_bytes("VmHWM") / (1024 * 1024), 1),
+            "settings": {"model": whisperx_model_size, "compute_type": compute_type, "emotion_model": funasr_model_name, "batch_size": batch_size, "emotion_batch_size": emotion_batch_size,
+                         "cpu_budget": args.cpu_budget, "emotion_source": args.emotion_source, "chunk_mode": args.chunk_mode},
+            "autotune": self.autotune,
+            "versions": library_versions(metrics_library_names),
+            "stages": stages,
+        }
+
+
+@contextlib.contextmanager
+def measure_stage(name):
+    """Measures a step with the metrics recorder of the media file being processed, if any. Yields a dict for its "items" count."""
+    if pipeline_metrics is None:
+        yield {}
+        return
+    with pipeline_metrics.measure(name) as stage_metrics:
+        yield stage_metrics
+
+
+def library_versions(package_names):
+    """The installed versions of the packages, from their metadata, without importing them."""
+    versions = {}
+    for package_name in package_names:
+        try:
+            versions[package_name] = importlib.metadata.version(package_name)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package_name] = None
+    return versions
+
+
+def media_duration_seconds():
+    """The duration of the media file, from the decoded audio if it is there already, as it is exact, or else from MediaInfo."""
+    decoded_meta = read_json_or_empty(decoded_audio_paths(media_path, output_dir)[1])
+    if decoded_meta.get("num_samples"):
+        return decoded_meta["num_samples"] / decoded_audio_sample_rate
+    duration_ms = MediaInfo.parse(media_path).tracks[0].duration
+    return float(duration_ms) / 1000 if duration_ms else None
+
+
+def write_pipeline_metrics(node_group):
+    """Adds the metrics of this run to metrics.json, next to tracker.json, keeping the last runs too."""
+    metrics_path = output_dir / "metrics.json"
+    run_metrics = pipeline_metrics.to_json(media_duration_seconds(), node_group)
+    with tracker_lock:
+        runs = read_json_or_empty(metrics_path).get("runs", [])
+        write_json_atomically(metrics_path, {"runs": (runs + [run_metrics])[-metrics_history_length:]})
+    print(f"Performance metrics saved to: {metrics_path}")
+    return run_metrics
+
+
+def print_metrics_summary(run_metrics):
+    """The compact table of the --metrics_summary option."""
+    print()
+    print(f"\033[92mPerformance metrics\033[0m of {run_metrics['media_duration_seconds'] or 0:.1f} seconds of media:")
+    print(f"{'Step':<32} {'Wall (s)':>9} {'CPU (s)':>9} {'Child CPU':>10} {'Peak RSS':>9} {'RTF':>7} {'Items':>6}")
+    for name, stage_metrics in run_metrics["stages"].items():
+        print(f"{name:<32} {stage_metrics['wall_seconds']:>9.2f} {stage_metrics['cpu_seconds']:>9.2f} {stage_metrics['children_cpu_seconds']:>10.2f} {stage_metrics['peak_rss_mb']:>7.0f}MB {stage_metrics.get('real_time_factor', 0):>7.3f} {stage_metrics.get('items', ''):>6}")
+    print(f"{'Total':<32} {run_metrics['wall_seconds']:>9.2f} {'':>9} {'':>10} {run_metrics['peak_rss_mb']:>7.0f}MB {run_metrics['real_time_factor'] or 0:>7.3f}")
+
+
+#The opt-in profiler of the pipeline steps, see --profile or the EMOTION_DETECTOR_PROFILE environment variable: "sampling" (low overhead) or "cprofile" (exact, slower).
+#Each step gets a collapsed stack file (for flamegraph.pl or speedscope) and a summary of its top hotspots, in the "profiles" subfolder of the output folder.
+profile_sample_interval = 0.005  # Seconds between the stack samples
+profile_top_count = 25  # How many hotspots the summaries list
+
+
+class StackSampler:
+    """Samples the Python stack of one thread at a fixed interval, counting the collapsed stacks. The native code (ctranslate2, torch, the ffmpeg subprocesses) shows up as the Python call waiting for it."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stack_counts = {}
+        self.stopped = threading.Event()
+        self.sampler_thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                collapsed_stack = ";".join(reversed(stack))
+                self.stack_counts[collapsed_stack] = self.stack_counts.get(collapsed_stack, 0) + 1
+
+    def __enter__(self):
+        self.sampler_thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.sampler_thread.join()
+
+
+def write_sampling_profile(profile_base_path, stack_counts, stage_name):
+    """Writes the collapsed stacks and the top hotspots: by the samples in the function itself (self) and in it or in what it calls (total)."""
+    with open(f"{profile_base_path}.collapsed", 'w', encoding='utf-8') as collapsed_file:
+        for collapsed_stack, count in sorted(stack_counts.items(), key=lambda item: -item[1]):
+            collapsed_file.write(f"{collapsed_stack} {count}\n")
+
+    self_counts, total_counts = {}, {}
+    for collapsed_stack, count in stack_counts.items():
+        frames = collapsed_stack.split(";")
+        self_counts[frames[-1]] = self_counts.get(frames[-1], 0) + count
+        for frame in set(frames):
+            total_counts[frame] = total_counts.get(frame, 0) + count
+    sample_count = sum(stack_counts.values()) or 1
+    with open(f"{profile_base_path}_top.txt", 'w', encoding='utf-8') as top_file:
+        top_file.write(f"Sampling profile of the pipeline step: {stage_name}, {sample_count} samples, every {profile_sample_interval * 1000:.0f} ms\n\n")
+        for title, counts in (("Self", self_counts), ("Total", total_counts)):
+            top_file.write(f"{title} samples:\n")
+            for frame, count in sorted(counts.items(), key=lambda item: -item[1])[:profile_top_count]:
+                top_file.write(f"{count / sample_count:>7.1%} {count:>8}  {frame}\n")
+            top_file.write("\n")
+
+
+def write_cprofile_profile(profile_base_path, profiler, stage_name):
+    """Writes the pstats file, the top hotspots and, as cProfile keeps no full stacks, the caller;callee pairs as collapsed stacks, weighted by the microseconds spent."""
+    import pstats
+    profiler.dump_stats(f"{profile_base_path}.prof")
+    stats = pstats.Stats(profiler)
+    with open(f"{profile_base_path}.collapsed", 'w', encoding='utf-8') as collapsed_file:
+        for (file_name, line_number, function_name), (_, _, own_time, _, callers) in stats.stats.items():
+            callee = f"{function_name} ({os.path.basename(file_name)}:{line_number})"
+            for (caller_file, caller_line, caller_function), caller_stats in callers.items():
+                collapsed_file.write(f"{caller_function} ({os.path.basename(caller_file)}:{caller_line});{callee} {int(caller_stats[2] * 1e6)}\n")
+            if not callers:
+                collapsed_file.write(f"{callee} {int(own_time * 1e6)}\n")
+    with open(f"{profile_base_path}_top.txt", 'w', encoding='utf-8') as top_file:
+        top_file.write(f"cProfile of the pipeline step: {stage_name}\n\n")
+        for sort_key in ("tottime", "cumulative"):
+            pstats.Stats(profiler, stream=top_file).sort_stats(sort_key).print_stats(profile_top_count)
+
+
+@contextlib.contextmanager
+def profile_stage(stage_name):
+    """Profiles the pipeline step in the calling thread, if asked to by --profile; the chunk export worker processes are not profiled, only their waiting."""
+    profile_mode = args.profile
+    if not profile_mode:
+        yield
+        return
+    profiles_dir = output_dir / "profiles"
+    profiles_dir.mkdir(exist_ok=True)
+    profile_base_path = profiles_dir / f"{stem}_{stage_name.replace(':', '_').replace('/', '_')}"
+    if profile_mode == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            write_cprofile_profile(profile_base_path, profiler, stage_name)
+    else:
+        sampler = StackSampler(threading.get_ident(), profile_sample_interval)
+        try:
+            with sampler:
+                yield
+        finally:
+            write_sampling_profile(profile_base_path, sampler.stack_counts, stage_name)
+    print(f"Profile of the pipeline step {stage_name} saved to: {profile_base_path}_top.txt")
+
+
 # Function to call ExifTool and print track information
 def print_exif_info(file_path):
     try:
@@ -1458,79 +3068,307 @@ def print_media_duration_info(file_path):
 
 
 
-def process_stage(pass_name):
-    print()
-    print(f"\033[92mWhisperx pass: {pass_name}\033[0m")  # Print the pass name
+#The passes which get an interim emotions report with --interim_previews, before the final one:
+interim_report_passes = ["transcription"]
 
-    # Check if the current stage has been completed
-    if statuses.get(f"whisperx_{pass_name}") != "completed":
-        # Dynamically call the corresponding function based on pass_name
-        if pass_name == "transcription":
-            language_code = whisperx_transcribe(args)  # Call transcription function
-            extract_media_segments(pass_name) # Do the media chunking for that stage
-            display_result_temp_html(pass_name, language_code, funasr_model_name)  # Display transcription results - optional, just to keep the users happy that they see smth interim
 
-        elif pass_name == "alignment":
-            
-            # Define the path to your JSON file
-            transcription_json_file_path = f"{output_dir}/{stem}_transcription.json"
-            #print(f"Reading the language code from: {transcription_json_file_path}")
+def whisperx_passes():
+    """The whisperx passes to run, in order. The diarization works on the alignment output, so it needs the alignment pass too."""
+    passes = ["transcription"]
+    if not args.no_align or not args.no_diarize:
+        passes.append("alignment")
+    if not args.no_diarize:
+        passes.append("diarization")
+    return passes
 
-            # Open and load the JSON file
-            with open(transcription_json_file_path, 'r', encoding='utf-8') as f:
-                result = json.load(f)  # Load the contents of the JSON file into a dictionary
 
-            # Safely get the language code from the loaded JSON data
-            language_code = result.get("language")  # This retrieves the value associated with 'language'
+def final_pass_name():
+    """The last whisperx pass: the chunking, the emotion detection and the report are done on its segmentation."""
+    return whisperx_passes()[-1]
 
-            # Print the language code (optional)
-            #print(f"Language Code from the whisperx transcription stage is: {language_code}")
-            print()
 
-            whisperx_align(args, language_code)
-            #extract_media_segments(pass_name) # Do the media chunking for that stage
-            #display_result_temp_html(pass_name, language_code, funasr_model_name)  # Display transcription results - optional, just to keep the users happy that they see smth interim
-            if args.no_diarize:
-                display_result_temp_html(pass_name, language_code, funasr_model_name)  # Display transcription results
-                
-        elif pass_name == "diarization":
-            #If an argument is `--no_diarize`, do skip it - add it some time ... 
+def read_language_code():
+    """Reads the language code detected (or given) at the transcription pass."""
+    # Define the path to your JSON file
+    transcription_json_file_path = f"{output_dir}/{stem}_transcription.json"
 
+    # Open and load the JSON file
+    with open(transcription_json_file_path, 'r', encoding='utf-8') as f:
+        result = json.load(f)  # Load the contents of the JSON file into a dictionary
 
-            # Define the path to your JSON file
-            transcription_json_file_path = f"{output_dir}/{stem}_transcription.json"
-            #print(f"Reading the language code from: {transcription_json_file_path}")
+    # Safely get the language code from the loaded JSON data
+    return result.get("language")  # This retrieves the value associated with 'language'
 
-            # Open and load the JSON file
-            with open(transcription_json_file_path, 'r', encoding='utf-8') as f:
-                result = json.load(f)  # Load the contents of the JSON file into a dictionary
 
-            # Safely get the language code from the loaded JSON data
-            language_code = result.get("language")  # This retrieves the value associated with 'language'
+#The CPU thread budget: one number of cores (--cpu_budget, by default those this process may actually use, see available_cpu_count) shared out among
+#ctranslate2 (whisper), torch (the alignment, pyannote and emotion2vec), the BLAS libraries, the ffmpeg subprocesses and the chunk export workers,
+#so that the steps the scheduler runs at the same time do not oversubscribe the cores, which about doubles the wall time on a shared machine.
+blas_thread_variables = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS"]
 
-            
-            whisperx_diarize(args, language_code) # Uses alignment file, hard coded
-            extract_media_segments(pass_name) # Do the media chunking for that stage
- 
-            display_result_temp_html(pass_name, language_code, funasr_model_name)  # Display diarization results
-            
-        update_tracker(tracker_file, "whisperx_" + pass_name)
 
-    else:
-        print(f"We have skipped the whisperx {pass_name} as per the Run Tracker.")
+def cgroup_cpu_quota():
+    """The CPU quota of the container, in cores rounded up (cgroup v2 cpu.max, or the v1 CFS quota), or None if there is none."""
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()[:2]
+        return None if quota == "max" else max(1, -(-int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    try:
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+        return max(1, -(-quota // period)) if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
 
 
+def available_cpu_count():
+    """The cores this process may use: those of its CPU affinity (e.g. taskset), within the cgroup quota. os.cpu_count() counts all the cores of the machine instead."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:  # Not on Linux
+        cores = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    return min(cores, quota) if quota else cores
+
+
+class ThreadBudget:
+    """The threads of each kind of work, out of the CPU budget.
+
+    The whisper (ctranslate2) threads are also the torch intra-op and the BLAS threads: a share of the budget (see num_cores_divisor), as two such steps
+    may run at the same time, e.g. the pyannote diarization alongside the transcription. The torch inter-op pool is kept at one thread, as the steps
+    run their ops one after another. The ffmpeg decoding of a media runs before its other steps, so it gets the whole budget; with --batch, the decoding ahead
+    of the next media runs alongside them on a thread of its own, which run_batch leaves out of the budget of the runs.
+    The chunk export workers share the export threads, which are the whisper share, or one per worker if more workers are asked for (see --export_workers),
+    up to the budget: the workers and their threads never go over it."""
+
+    torch_interop_set = False  # torch allows setting its inter-op threads only once per process
+
+    def __init__(self, cpu_budget, export_workers=0):
+        self.cpu_budget = max(1, cpu_budget)
+        self.whisper_threads = max(1, self.cpu_budget // num_cores_divisor)
+        self.torch_threads = self.whisper_threads
+        self.blas_threads = self.whisper_threads
+        self.ffmpeg_threads = self.cpu_budget
+        self.export_workers = min(export_workers, self.cpu_budget) if export_workers > 0 else self.whisper_threads
+        self.export_threads = min(max(self.whisper_threads, self.export_workers), self.cpu_budget)
+
+    def encoder_threads(self, export_workers):
+        """The libx264 threads of each of the export workers running, so that together they stay within the export threads."""
+        return max(1, self.export_threads // max(1, export_workers))
+
+    def limit_blas_threads(self):
+        """Sets the BLAS and OpenMP thread counts, unless set in the environment already. They are read when numpy or torch is loaded, so call it before the heavy imports."""
+        for variable in blas_thread_variables:
+            os.environ.setdefault(variable, str(self.blas_threads))
+
+    def configure_torch(self):
+        """Sets the torch threads, importing torch, for the steps that run torch models: the alignment, pyannote and emotion2vec ones."""
+        import torch
+
+        torch.set_num_threads(self.torch_threads)
+        if not ThreadBudget.torch_interop_set:
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                pass  # Some torch op has run in parallel already, so it is too late for this process
+            ThreadBudget.torch_interop_set = True
 
+    def describe(self):
+        return (f"CPU budget: \033[94m{self.cpu_budget}\033[0m threads (available here: {available_cpu_count()}, in the machine: {os.cpu_count()}); "
+                f"whisper and torch: {self.whisper_threads}, ffmpeg: {self.ffmpeg_threads}, chunk export: {self.export_workers} worker(s) within {self.export_threads} threads.")
 
-if __name__ == "__main__":
 
-    
+thread_budget = ThreadBudget(available_cpu_count())  # Set for each media file by configure_media, from --cpu_budget
+
+
+#The pipeline as a graph of steps (nodes): each one runs as soon as the steps it needs are done, in parallel with the other ready ones, as long as their CPU threads fit into the CPU budget.
+#E.g. the pyannote diarization needs the audio only, so it runs alongside the transcription, and the interim emotions run alongside the alignment.
+@dataclass
+class PipelineNode:
+    name: str
+    action: object            # The function to call, with the results of its input_deps as the arguments, if any
+    deps: list                # The names of the nodes that must be done first
+    cpu_threads: int = 1      # How many cores it keeps busy, counted against the CPU budget
+    resumable: bool = True    # Whether it may be skipped when the tracker says it completed in an earlier run
+    pass_name: str = ""       # The whisperx pass it belongs to, for the older trackers with the pass flags only
+    uses_torch: bool = False  # Whether it runs torch models, so the torch threads are set first, see ThreadBudget
+    input_deps: list = field(default_factory=list)  # The deps whose results (None if skipped as completed before) are passed to the action
+    settings: tuple = ()      # The options its results depend on: when they change, it runs again
+
+    def settings_key(self):
+        """A short hash of the settings, recorded in the tracker when the node completes; None if it has none."""
+        if not self.settings:
+            return None
+        return hashlib.sha1(json.dumps([str(setting) for setting in self.settings]).encode()).hexdigest()[:16]
+
+
+class StageScheduler:
+    """Runs the pipeline nodes in dependency order, the independent ones at the same time, within a CPU budget, recording each node in the tracker."""
+
+    def __init__(self, nodes, cpu_budget, tracker_file):
+        self.nodes = {node.name: node for node in nodes}
+        self.cpu_budget = max(1, cpu_budget)
+        self.tracker_file = tracker_file
+        self.results = {}  # What each node returned, for the nodes downstream
+
+    def completed_before(self, node, statuses, rerun_nodes):
+        """A node is skipped only if it completed in an earlier run with the same settings, and none of the nodes it depends on has to run again.
+        The whisperx pass flags of the older trackers count only for the nodes with no record of their own and no settings, as the options they ran with are unknown."""
+        if not node.resumable or any(dep in rerun_nodes for dep in node.deps):
+            return False
+        node_statuses = statuses.get("nodes", {})
+        if node.name in node_statuses:
+            node_status = node_statuses[node.name]
+            return node_status.get("status") == "completed" and node_status.get("settings") == node.settings_key()
+        return node.pass_name != "" and not node.settings and statuses.get("whisperx_" + node.pass_name) == "completed"
+
+    def run_node(self, node):
+        started_at = datetime.datetime.now().isoformat()
+        node_start_time = time.time()
+        update_node_tracker(self.tracker_file, node.name, {"status": "running", "started_at": started_at})
+        try:
+            if node.uses_torch:
+                thread_budget.configure_torch()
+            with measure_stage(node.name), profile_stage(node.name):
+                result = node.action(*(self.results.get(dep) for dep in node.input_deps))
+        except BaseException:
+            update_node_tracker(self.tracker_file, node.name, {"status": "failed", "started_at": started_at, "seconds": round(time.time() - node_start_time, 3)})
+            raise
+        node_seconds = time.time() - node_start_time
+        update_node_tracker(self.tracker_file, node.name, {"status": "completed", "started_at": started_at, "seconds": round(node_seconds, 3), "settings": node.settings_key()})
+        print(f"\033[92mPipeline step done: {node.name}\033[0m in \033[94m{node_seconds:.2f}\033[0m seconds.")
+        return result
+
+    def run(self, rerun_before=()):
+        """Runs the graph. The nodes it depends on outside of it (see run_pipeline node groups) count as done, those of them in rerun_before as run again."""
+        statuses = read_tracker(self.tracker_file)
+        pending = list(self.nodes)  # Kept in the insertion order, which is also a sensible order to start the ready nodes in
+        done = {dep for node in self.nodes.values() for dep in node.deps if dep not in self.nodes}
+        rerun_nodes, running = set(rerun_before), {}
+        self.rerun_nodes = rerun_nodes
+        busy_threads = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.nodes) or 1) as executor:
+            while pending or running:
+                skipped_any = False
+                for name in list(pending):
+                    node = self.nodes[name]
+                    if not all(dep in done for dep in node.deps):
+                        continue
+                    if self.completed_before(node, statuses, rerun_nodes):
+                        print(f"We have skipped the pipeline step: {name}, as per the Run Tracker.")
+                        pending.remove(name)
+                        done.add(name)
+                        skipped_any = True
+                        continue
+                    # A node bigger than the whole budget still runs, but alone:
+                    if running and busy_threads + node.cpu_threads > self.cpu_budget:
+                        continue
+                    print(f"\033[92mPipeline step started: {name}\033[0m (CPU threads: {node.cpu_threads}, busy: {busy_threads} of the budget of {self.cpu_budget})")
+                    pending.remove(name)
+                    if node.resumable:
+                        rerun_nodes.add(name)  # So the nodes downstream of it run again too
+                    running[executor.submit(self.run_node, node)] = name
+                    busy_threads += node.cpu_threads
+
+                if not running:
+                    if skipped_any:
+                        continue  # The skipped nodes may have made some more nodes ready
+                    if pending:
+                        raise RuntimeError(f"The pipeline steps {pending} can never start, check their dependencies.")
+                    break
+
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    busy_threads -= self.nodes[name].cpu_threads
+                    self.results[name] = future.result()  # Re-raises the exception of a failed node; the running ones are waited for on the way out
+                    done.add(name)
+        return self.results
+
+
+def build_pipeline_nodes():
+    """The pipeline graph: decode, transcribe, align, diarize, and the chunk, emotion and report steps of the final pass (and of the interim ones, if asked for)."""
+    passes = whisperx_passes()
+    whisperx_threads = thread_budget.whisper_threads
+
+    # The decoding is cached on disk, so it just checks the cache when it has been done before
+    nodes = [PipelineNode("decode", get_decoded_audio, [], thread_budget.ffmpeg_threads, resumable=False)]
+    nodes.append(PipelineNode("transcribe", lambda: whisperx_transcribe(args), ["decode"], whisperx_threads, pass_name="transcription", uses_torch=True,
+                              settings=(whisperx_model_size, compute_type, args.language)))
+    pass_nodes = {"transcription": "transcribe"}
+
+    if "alignment" in passes:
+        nodes.append(PipelineNode("align", lambda: whisperx_align(args, read_language_code()), ["transcribe"], whisperx_threads, pass_name="alignment", uses_torch=True))
+        pass_nodes["alignment"] = "align"
+    if "diarization" in passes:
+        # The pyannote part needs the audio only, the speakers are assigned to the words once the alignment is done too
+        nodes.append(PipelineNode("diarize_audio", whisperx_diarize_audio, ["decode"], whisperx_threads, pass_name="diarization", uses_torch=True,
+                                  settings=(args.min_speakers, args.max_speakers)))
+        nodes.append(PipelineNode("diarize", lambda diarize_segments: whisperx_diarize(args, read_language_code(), diarize_segments), ["align", "diarize_audio"], 1, pass_name="diarization",
+                                  input_deps=["diarize_audio"]))
+        pass_nodes["diarization"] = "diarize"
+
+    report_passes = [pass_name for pass_name in passes if pass_name == final_pass_name() or (args.interim_previews and pass_name in interim_report_passes)]
+    for pass_name in passes:
+        if pass_name not in report_passes:
+            print(f"No interim emotions report after the {pass_name} pass, the emotions shall be detected once, after the {final_pass_name()} pass (see: --interim_previews).")
+
+    for pass_name in report_passes:
+        emotion_deps = [pass_nodes[pass_name], "decode"]
+        if segment_files_needed():
+            nodes.append(PipelineNode(f"chunk:{pass_name}", lambda pass_name=pass_name: extract_media_segments(pass_name), [pass_nodes[pass_name]], thread_budget.export_threads, pass_name=pass_name,
+                                      settings=(args.chunk_mode, args.preview_proxy, args.proxy_height)))
+            emotion_deps = [f"chunk:{pass_name}"] + emotion_deps
+        nodes.append(PipelineNode(f"emotion:{pass_name}", lambda pass_name=pass_name: detect_segment_emotions(pass_name), emotion_deps, whisperx_threads, pass_name=pass_name, uses_torch=True,
+                                  settings=(funasr_model_name, args.emotion_source, args.min_segment_ms, args.max_segment_ms, args.segment_overlap_ms)))
+        nodes.append(PipelineNode(f"report:{pass_name}", lambda pass_name=pass_name: display_result_temp_html(pass_name, read_language_code(), funasr_model_name), [f"emotion:{pass_name}"], 1, pass_name=pass_name,
+                                  settings=(args.report_playback, args.previews, args.preview_proxy)))
+
+    return nodes
+
+
+def run_pipeline(node_group="all", rerun_before=()):
+    """Runs the pipeline graph, then marks the whisperx passes as completed in the tracker, as the older versions did. Returns the names of the nodes that ran.
+
+    The node group "asr" is the decoding and the whisperx steps, "media" the chunk, emotion and report steps: the --batch mode runs them in two processes, one file apart."""
+    nodes = build_pipeline_nodes()
+    if node_group != "all":
+        nodes = [node for node in nodes if (":" in node.name) == (node_group == "media")]
+    scheduler = StageScheduler(nodes, args.cpu_budget, tracker_file)
+    try:
+        scheduler.run(rerun_before)
+    finally:
+        run_metrics = write_pipeline_metrics(node_group)
+        if args.metrics_summary:
+            print_metrics_summary(run_metrics)
+    if node_group != "asr":
+        # Only once the whole pass is done, as the scheduler also reads these flags
+        for pass_name in whisperx_passes():
+            update_tracker(tracker_file, "whisperx_" + pass_name)
+    return sorted(scheduler.rerun_nodes)
+
+
+
+
+#The daemon mode, see --serve and emotion_detector_client.py: the jobs (the command line options of one media file each) come over a Unix socket, as one JSON line,
+#and the progress (the lines printed while processing) and the result paths go back as JSON lines.
+default_daemon_socket_path = Path(os.getenv("EMOTION_DETECTOR_SOCKET", str(Path.home() / ".cache" / "emotion_detector" / "daemon.sock")))
 
-    #rainbow_text(tool_name_and_version)
-    # See also https://github.com/ddlBoJack/emotion2vec
+
+class MediaDownloadError(RuntimeError):
+    """yt-dlp could not download the media URL."""
+
+
+#The defaults of the options, from the settings at the top of this file, captured once, as configure_media changes those globals for each media file:
+default_settings = {"model": "medium", "compute_type": compute_type, "emotion_model": funasr_model_name, "batch_size": batch_size, "emotion_batch_size": emotion_batch_size}
+
+
+def build_argument_parser():
+    """The command line options: of a single run, or of one job sent to the --serve daemon."""
 
     parser = argparse.ArgumentParser(description="Process a media file to detect emotions there")
-    parser.add_argument("media_path", type=str, help="Path to the media file analyzed")
+    parser.add_argument("media_path", type=str, nargs="?", help="Path to the media file analyzed")
     
     parser.add_argument("--language", type=str, default="", help="Specify the language code (default: '{none}')")
     parser.add_argument("--no_align", action="store_true", help="Do not perform word alignment (default: False)")
@@ -1540,26 +3378,137 @@ if __name__ == "__main__":
     parser.add_argument("--min_speakers", type=int, help="Minimum number of speakers ")
     parser.add_argument("--max_speakers", type=int, help="Maximum number of speakers")
 
-    parser.add_argument("--model", type=str, default="medium", help="Size of the recognition model: small, medium (default), large-v3 ...")
+    parser.add_argument("--model", type=str, default=default_settings["model"], help="Size of the recognition model: small, medium (default), large-v3 ...")
+    parser.add_argument("--compute_type", choices=["float32", "float16", "int8", "int8_float32"], default=default_settings["compute_type"], help=f"The whisper (ctranslate2) compute type: int8 is faster and smaller on the CPU, float32 the most exact (default: {default_settings['compute_type']})")
+    parser.add_argument("--emotion_model", type=str, default=default_settings["emotion_model"], help=f"The emotion2vec model: iic/emotion2vec_base_finetuned, iic/emotion2vec_plus_seed, iic/emotion2vec_plus_base or iic/emotion2vec_plus_large; loaded offline from ~/.cache/modelscope/hub if it is there (default: {default_settings['emotion_model']}). See emotion_model_matrix.py to compare them")
+    parser.add_argument("--batch_size", type=int, default=default_settings["batch_size"], help=f"How many segments whisper transcribes at once; more is faster, but takes more RAM (default: {default_settings['batch_size']})")
+    parser.add_argument("--emotion_batch_size", type=int, default=default_settings["emotion_batch_size"], help=f"How many segments are passed to the emotion model at once (default: {default_settings['emotion_batch_size']})")
+    parser.add_argument("--min_segment_ms", type=int, default=500, help="The segments shorter than this are merged with the next one (the previous one, if last) for the emotion model; the TSV files are not changed (default: 500)")
+    parser.add_argument("--max_segment_ms", type=int, default=20000, help="The segments longer than this are split into overlapping windows for the emotion model, their scores averaged back to one result per sentence (default: 20000; 0 for no limit)")
+    parser.add_argument("--segment_overlap_ms", type=int, default=2000, help="The overlap of the windows of the split segments (default: 2000)")
+    parser.add_argument("--emotion_batch_seconds", type=float, default=60, help="The audio in one batch of the emotion model, as its count of segments times its longest one, that is with the padding; the segments are batched with the ones of similar durations (default: 60)")
+    parser.add_argument("--autotune", action="store_true", help="Try a few batch sizes of whisper and of the emotion model on the first segments and keep the fastest that fits in the RAM, instead of --batch_size and --emotion_batch_size; remembered per machine and model in autotune.json in the cache folder (default: False)")
+    parser.add_argument("--auto_plan", action="store_true", help="Pick the whisper size and compute type, the emotion model and the batch sizes that fit in the free RAM (and the --deadline_minutes), for the options not given; prints the plan and its estimated real-time factor (default: False)")
+    parser.add_argument("--deadline_minutes", type=float, default=0, help="The time the run should take at most, for the planner; implies --auto_plan (default: 0, meaning no deadline)")
+    parser.add_argument("--cpu_budget", type=int, default=available_cpu_count(), help="How many CPU threads the pipeline steps running at the same time may use together, shared out among whisper, torch, BLAS, ffmpeg and the export workers (default: all the cores this process may use, within the cgroup CPU quota of a container)")
+    parser.add_argument("--no_cache", action="store_true", help="Do not read nor write the artifact cache of the results, keyed by the audio content (default: False)")
+    parser.add_argument("--cache_max_mb", type=int, default=2048, help="Size limit of the artifact cache, the least recently used results are evicted over it (default: 2048). Its folder: $EMOTION_DETECTOR_CACHE or ~/.cache/emotion_detector")
+    parser.add_argument("--segment_cache_tolerance_ms", type=int, default=40, help="Segments whose start and end differ by up to this many milliseconds from the ones already analyzed reuse their emotions, e.g. across the transcription, alignment and diarization passes (default: 40)")
+    parser.add_argument("--model_ram_budget_mb", type=int, default=0, help="RAM for the models kept loaded (whisper, alignment, pyannote, emotion2vec); the least recently used ones are unloaded to stay within it (default: 0, meaning half of the RAM of the machine)")
+    parser.add_argument("--interim_previews", action="store_true", help="Also chunk, detect the emotions and show a report after the transcription pass, not only after the final pass (default: False)")
+    parser.add_argument("--emotion_source", choices=["chunks", "waveform", "timeline"], default="chunks", help="What the emotion model gets: the exported media chunk files (default), or the segments sliced in memory from the decoded audio, with no chunk files needed, "
+                        "or the whole decoded audio once, in overlapping windows, the frame scores of which are then pooled for the segments of each pass (timeline)")
+    parser.add_argument("--export_workers", type=int, default=0, help="How many processes export the media chunks in parallel (default: 0, meaning half of the CPU budget, see num_cores_divisor)")
+    parser.add_argument("--chunk_mode", choices=["moviepy", "smartcut"], default="moviepy", help="How the media chunks are cut: fully re-encoded by MoviePy (default), or smart-cut: the whole GOPs stream-copied, only the edges re-encoded; it falls back to the re-encode where the container or codec does not allow it")
+    parser.add_argument("--report_playback", choices=["chunks", "fragments"], default="chunks", help="What the players in the HTML report play: the exported chunk files (default), or time ranges (#t=start,end) of the original media file, with no chunk files needed for that")
+    parser.add_argument("--preview_proxy", action="store_true", help="Transcode a video once to a low resolution proxy and cut all the segment previews from it, not from the full resolution source (default: False)")
+    parser.add_argument("--proxy_height", type=int, default=360, help="Height in pixels of the --preview_proxy video (default: 360)")
+    parser.add_argument("--previews", action="store_true", help="With --emotion_source waveform or timeline: still export the media chunks, for the playback previews in the HTML report (default: False)")
+    parser.add_argument("--profile", choices=["sampling", "cprofile"], default=os.getenv("EMOTION_DETECTOR_PROFILE") or None, help="Profile each pipeline step: with a low overhead stack sampler, or with cProfile; saves a collapsed stack file and the top hotspots of each step to the 'profiles' subfolder (default: off, or $EMOTION_DETECTOR_PROFILE)")
+    parser.add_argument("--metrics_summary", action="store_true", help="Print a table of the performance metrics of the steps at the end; they are saved to metrics.json in the output folder anyway (default: False)")
+    parser.add_argument("--profile_startup", "--profile-startup", action="store_true", help="Print how long the start took, and each of the slow imports, at their first use (default: False). For all the modules, use: python -X importtime")
+    parser.add_argument("--batch", type=str, help="Process many media files instead of one media_path: a folder (its audio and video files), a list file (.txt or .lst, one path or URL per line) or a glob pattern; the whisperx steps of each file overlap with the emotion steps of the previous one and the decoding of the next one")
+    parser.add_argument("--no_open", action="store_true", help="Do not show the diarization plot nor open the HTML reports in the browser (default: False; always so for the jobs of the --serve daemon, which sends the report paths to the client instead)")
+    parser.add_argument("--serve", action="store_true", help="Run as a daemon: import the libraries and keep the models loaded once, then process the jobs sent by emotion_detector_client.py over a Unix socket, one at a time (default: False)")
+    parser.add_argument("--socket", type=str, default=str(default_daemon_socket_path), help="The Unix socket of the --serve daemon (default: $EMOTION_DETECTOR_SOCKET or ~/.cache/emotion_detector/daemon.sock)")
+    parser.add_argument("--queue_size", type=int, default=16, help="How many jobs the --serve daemon accepts to wait in its queue, the next ones are refused (default: 16)")
+    return parser
+
+
+def parse_options(parser, argv=None):
+    """Parses argv (default: the command line) with parser, a build_argument_parser one. Also records in given_options which options argv gives, as --auto_plan changes
+    only the others (see plan_run): from a second parse with all the defaults suppressed, as an option given with its default value is given all the same."""
+    options = parser.parse_args(argv)
+    given_parser = build_argument_parser()
+    for action in given_parser._actions:
+        action.default = argparse.SUPPRESS
+    options.given_options = set(vars(given_parser.parse_args(argv)))
+    return options
+
+
+def import_heavy_modules():
+    """Imports all the slow libraries at once, ahead of their first use: for the --serve daemon and the --batch processes, which pay for them once, not for each job."""
+    print()
+    print("\033[94mImporting Python libraries... This may take some time; you might see some warnings during this process; most can be safely ignored, but if later processing fails, review these too to ensure all these libraries are up to date to avoid compatibility issues.... \033[0m")  # Blue
 
-    args = parser.parse_args()
+    for lazy_import in lazy_imports.values():
+        lazy_import.load()
+    ''' 
     
-        
-    # Get the number of CPU cores
-    num_cores = os.cpu_count()  # or use multiprocessing.cpu_count()
+    from moviepy.editor import VideoFileClip, AudioFileClip
+    from moviepy.audio.AudioClip import CompositeAudioClip
+    '''
+    from moviepy.config import check
+    check()
+    print_library_versions()
 
-    if num_cores is not None:
-        # Calculate the number of threads to use (half the number of cores)
-        faster_whisper_threads = num_cores // num_cores_divisor
-    else:
-        # Fallback if unable to determine the number of cores
-        faster_whisper_threads = 1  # Default to 1 thread if undetermined
 
-    print(f"Using \033[94m{faster_whisper_threads} threads\033[0m for whisperx processing. You may increase them to {num_cores}.")
+def print_library_versions():
+    """The versions of the main libraries, from their package metadata, so without importing them."""
+   # Get and print the version of whisperx
+    whisperx_version = importlib.metadata.version("whisperx")
+    funasr_version=importlib.metadata.version("funasr")
+    moviepy_version=importlib.metadata.version("moviepy")
+    numpy_version=importlib.metadata.version("numpy")
+    
+    
+    #print(f"WhisperX version: {whisperx_version}") 
+    #print()
+    #print()
+    print(f"We are using this Whisperx version: \033[94m{whisperx_version}\033[0m")  # Blue)
+    print(f"Note, if whisperx version is larger than 3.1.5 and you see errors about some 'asr arguments' missing or wrong, the easiest ugly and temporary fix is to downgrade to 3.1.5 : 'pip install whisperx==3.1.5' "  )
 
+    print(f"We are using this Funasr version: \033[94m{funasr_version}\033[0m")  # Blue)
+    print(f"We are using this MoviePy version: \033[94m{moviepy_version}\033[0m")  # Blue)
+    print(f"We are using this Numpy version: \033[94m{numpy_version}\033[0m")  # Blue)
 
-        
+    '''
+    # Command to execute to run translation 
+    print("We are using this translate-shell version:\033[94m")
+    command = f"trans -U"
 
+    try:
+        # Execute the command that requires Internet access
+        subprocess.run(command, shell=True, check=True)
+    except subprocess.CalledProcessError as e:
+        # Handle the error if the command fails
+        print(f"\033[91m") # Red color for error message
+        print(f"Error occurred while executing the translation command: {e}")
+        print("Check your Internet connection and try again.")
+        print(f"\033[0m") # Reset text color
+
+    print(f"\033[0m") # Reset text color to default
+    '''
+
+
+def print_startup_profile():
+    """The --profile_startup breakdown: the time to parse the arguments, then the import time of each of the slow libraries imported so far."""
+    print()
+    print(f"\033[92mStartup profile:\033[0m the script was ready to parse the arguments after \033[94m{startup_seconds:.3f}\033[0m seconds.")
+    for module_name, seconds in sorted(lazy_import_seconds.items(), key=lambda item: -item[1]):
+        print(f"{seconds:>9.3f} s  import {module_name}")
+    if not lazy_import_seconds:
+        print("No slow library has been imported.")
+
+
+def configure_media(job_args):
+    """Sets the module globals that the pipeline functions read, for one media file and its options: the paths, the tracker and the model settings."""
+    global args, start_time, faster_whisper_threads, thread_budget, media_path, stem, original_extension, min_speakers, max_speakers, whisperx_model_size, output_dir, tracker_file, statuses, preview_proxy_path, pipeline_metrics, funasr_model_name, compute_type, batch_size, emotion_batch_size
+    args = job_args
+    start_time = time.time()
+    pipeline_metrics = MetricsRecorder()
+    preview_proxy_path = None
+    decoded_audio_views.clear()  # From the previous media file of the daemon
+
+    # The threads of whisperx, torch, ffmpeg and the export workers, out of the CPU budget:
+    thread_budget = ThreadBudget(args.cpu_budget, args.export_workers)
+    thread_budget.limit_blas_threads()  # In case the heavy libraries have not been imported yet
+    faster_whisper_threads = thread_budget.whisper_threads
+
+    print(f"Using \033[94m{faster_whisper_threads} threads\033[0m for whisperx processing. {thread_budget.describe()} You may change it with --cpu_budget.")
+
+
+        
     print(f"Current date and time: \033[94m{datetime.datetime.now()}\033[0m")
 
     
@@ -1591,7 +3540,7 @@ if __name__ == "__main__":
             print(f"❌ Error downloading URL: {e}", file=sys.stderr)
             if hasattr(e, 'stderr'):
                 print(f"yt-dlp stderr: {e.stderr}", file=sys.stderr)
-            sys.exit(1)
+            raise MediaDownloadError(f"Could not download: {args.media_path}") from e
     else:
         media_path = Path(args.media_path)  # Convert to Path object
 
@@ -1601,7 +3550,6 @@ if __name__ == "__main__":
     # Use the min and max speakers from command line arguments
     min_speakers = args.min_speakers
     max_speakers = args.max_speakers
-    whisperx_model_size = args.model
    
     '''
 We also have: 
@@ -1638,7 +3586,7 @@ print(media_path.resolve())
 
 '''
 
-    output_dir = media_path.parent / (media_path.name + "_emotions_detected")  # Create output directory
+    output_dir = media_output_dir(media_path)  # Create output directory
     output_dir.mkdir(exist_ok=True)  # Create directory if it doesn't exist
 
     tracker_file = output_dir / "tracker.json"
@@ -1651,85 +3599,25 @@ print(media_path.resolve())
     statuses = read_tracker(tracker_file)
     print(f"The Run Tracker status quo: \033[94m{statuses}\033[0m")
     print_media_duration_info(media_path)
-     
-        
-     # Parse the media file
-    media_info = MediaInfo.parse(media_path)
-    
-    
-    print()
-    print("\033[94mImporting Python libraries... This may take some time; you might see some warnings during this process; most can be safely ignored, but if later processing fails, review these too to ensure all these libraries are up to date to avoid compatibility issues.... \033[0m")  # Blue
-
-    #These imports take time. They  are here so as to let the user measure in output how much time they take to import: 
-        
-
-    #Changed imports with MoviePy update > 2.0:
-    from moviepy import VideoFileClip, AudioFileClip
-        
-    import webbrowser
-    import plotly.graph_objects as go
-    import plotly.express as px
-
-    from playsound import playsound
-            
-    import srt
 
+    if args.auto_plan or args.deadline_minutes:
+        plan_run(args)  # Changes the model and batch size options not given, to fit this machine and this media
+    whisperx_model_size = args.model
+    compute_type = args.compute_type
+    funasr_model_name = args.emotion_model
+    batch_size = args.batch_size
+    emotion_batch_size = args.emotion_batch_size
 
-    import pandas as pd
 
-    import whisperx
-    from funasr import AutoModel
-    #For emotions model downloading, needed once:
-    import modelscope
-    ''' 
-    
-    from moviepy.editor import VideoFileClip, AudioFileClip
-    from moviepy.audio.AudioClip import CompositeAudioClip
-    '''
 
+def media_output_dir(media_path):
+    """The folder of all the results of the media file, next to it."""
+    return media_path.parent / (media_path.name + "_emotions_detected")
 
-    #print_media_duration_info(media_path)
-    print()
-    #from pydub import AudioSegment
 
-
-    
-   # Get and print the version of whisperx
-    whisperx_version = importlib.metadata.version("whisperx")
-    funasr_version=importlib.metadata.version("funasr")
-    moviepy_version=importlib.metadata.version("moviepy")
-    numpy_version=importlib.metadata.version("numpy")
-    
-    
-    #print(f"WhisperX version: {whisperx_version}") 
-    #print()
-    #print()
-    print(f"We are using this Whisperx version: \033[94m{whisperx_version}\033[0m")  # Blue)
-    print(f"Note, if whisperx version is larger than 3.1.5 and you see errors about some 'asr arguments' missing or wrong, the easiest ugly and temporary fix is to downgrade to 3.1.5 : 'pip install whisperx==3.1.5' "  )
-
-    print(f"We are using this Funasr version: \033[94m{funasr_version}\033[0m")  # Blue)
-    print(f"We are using this MoviePy version: \033[94m{moviepy_version}\033[0m")  # Blue)
-    print(f"We are using this Numpy version: \033[94m{numpy_version}\033[0m")  # Blue)
-
-    '''
-    # Command to execute to run translation 
-    print("We are using this translate-shell version:\033[94m")
-    command = f"trans -U"
-
-    try:
-        # Execute the command that requires Internet access
-        subprocess.run(command, shell=True, check=True)
-    except subprocess.CalledProcessError as e:
-        # Handle the error if the command fails
-        print(f"\033[91m") # Red color for error message
-        print(f"Error occurred while executing the translation command: {e}")
-        print("Check your Internet connection and try again.")
-        print(f"\033[0m") # Reset text color
-
-    print(f"\033[0m") # Reset text color to default
-    '''
-    from moviepy.config import check
-    check()
+def process_media(job_args):
+    """Runs the whole pipeline for one media file. Returns the paths of its HTML reports."""
+    configure_media(job_args)
 
     # Construct output file path for the converted MP4 file
     output_file = output_dir / (media_path.name + ".mp4")
@@ -1780,6 +3668,7 @@ print(media_path.resolve())
         
         ffmpeg_command = [
             'ffmpeg',
+            '-threads', str(thread_budget.ffmpeg_threads),
             '-i', str(media_path),
             '-y',                          # Overwrite output files without asking
             str(output_file)              # Output file path (should have .mp4 extension)
@@ -1817,9 +3706,6 @@ print(media_path.resolve())
 
 
     
-      
-     # Parse the media file
-    media_info = MediaInfo.parse(media_path)
 
     	
 
@@ -1827,7 +3713,7 @@ print(media_path.resolve())
     print()
 
     print("\033[94mThe next steps will take some time. There will be three processing runs (passes):\n"
-          "A. WhisperX initial Transcription: the fastest run, which shall show you the first crude level emotions analysis.\n"
+          "A. WhisperX initial Transcription: the fastest run" + (", which shall show you the first crude level emotions analysis.\n" if args.interim_previews else ". No interim emotions analysis after it, unless you use --interim_previews.\n") +
           "B. WhisperX Alignment: a run which takes more time.\n"
           "C. Speaker Diarization (identifying speakers in the transcript): the run which usually takes the most time.\033[0m")  
 
@@ -1837,9 +3723,7 @@ print(media_path.resolve())
           "During these steps, the files for the Speech To Text (Automatic Speech Recognition, ASR) and emotion detection (FunASR) models ('the electronic brains' behind it all) may be downloaded as needed.\n"
           "Please be patient as on a regular, CPU-only computer these processes may take about five times as long as the duration of the source video.\033[0m")  # Blue
 
-    process_stage("transcription")
-    process_stage("alignment")
-    process_stage("diarization")
+    run_pipeline()
 
     '''    
 #   If diarization got broken for some reason mid-stream, so the interim chunked media files are there but no HTML yet, do run these by hand, removing the comments:
@@ -1873,11 +3757,291 @@ print(media_path.resolve())
     print_media_duration_info(media_path)
         
 
-    print(f"Total CPU processing time: \033[94m{elapsed_time:.2f} seconds\033[0m")  # Blue 
-        
-  
+    print(f"Total CPU processing time: \033[94m{elapsed_time:.2f} seconds\033[0m")  # Blue
 
- 
- 
- 
- 
+    # The reports of this media file, for the daemon clients:
+    return sorted(str(report_path) for report_path in output_dir.glob(f"{stem}_*_emotions.html"))
+
+
+
+#The --batch mode: many media files through the pipeline, one file apart. The decoding of file N+1 (in a thread) and the emotions of file N-1
+#(in a worker process, with its own emotion model loaded once) overlap with the whisperx steps of file N, with the whisperx models reused across the files.
+batch_list_suffixes = {".txt", ".lst", ".list"}
+media_tail_worker_ready = False  # Whether the worker process has imported the libraries, see run_batch_media_tail
+
+
+def batch_media_paths(batch_spec):
+    """The media files of a --batch: all the audio and video files in a folder, the lines of a list file (.txt, .lst), or the files matching a glob pattern."""
+    batch_path = Path(batch_spec).expanduser()
+    if batch_path.is_dir():
+        candidates = sorted(path for path in batch_path.iterdir() if path.is_file())
+        return [str(path) for path in candidates if (mimetypes.guess_type(path)[0] or "").startswith(("audio", "video"))]
+    if batch_path.is_file() and batch_path.suffix in batch_list_suffixes:
+        with open(batch_path, 'r', encoding='utf-8') as list_file:
+            return [line.strip() for line in list_file if line.strip() and not line.lstrip().startswith("#")]
+    return sorted(glob.glob(str(batch_path), recursive=True))
+
+
+def prefetch_decoded_audio(media_path_str, ffmpeg_threads):
+    """Decodes a media file of the batch ahead of its turn, into its decoded audio cache; the URLs are downloaded in their turn only.
+    It runs in a thread alongside the steps of the file before, so it reads none of the globals that configure_media sets: its ffmpeg threads are given,
+    and it measures the decoding with a metrics recorder of its own, which it returns, for run_batch to add to the metrics of its file."""
+    prefetch_metrics = MetricsRecorder()
+    if media_path_str.startswith("http"):
+        return prefetch_metrics
+    prefetch_path = Path(media_path_str)
+    media_output_dir(prefetch_path).mkdir(exist_ok=True)
+    load_decoded_audio(prefetch_path, media_output_dir(prefetch_path), ffmpeg_threads, prefetch_metrics.measure)
+    return prefetch_metrics
+
+
+def run_batch_media_tail(job_args, rerun_before):
+    """In the worker process: the chunk, emotion and report steps of one media file, whose whisperx steps are done. Returns its reports and how long it took."""
+    global media_tail_worker_ready
+    if not media_tail_worker_ready:
+        # Before the heavy imports, as the BLAS and OpenMP libraries read their thread counts when loaded; configure_media comes too late for that
+        ThreadBudget(job_args.cpu_budget, job_args.export_workers).limit_blas_threads()
+        import_heavy_modules()
+        media_tail_worker_ready = True
+    tail_start_time = time.time()
+    configure_media(job_args)
+    run_pipeline("media", rerun_before)
+    return sorted(str(report_path) for report_path in output_dir.glob(f"{stem}_*_emotions.html")), time.time() - tail_start_time
+
+
+def print_batch_summary(batch_rows):
+    """The table of the files of the batch: their status and the time of their whisperx and emotion steps."""
+    print()
+    print("\033[92mBatch summary:\033[0m")
+    print(f"{'Status':<8} {'ASR (s)':>9} {'Emotions (s)':>13} {'Reports':>8}  Media file")
+    for row in batch_rows:
+        print(f"{row['status']:<8} {row['asr_seconds']:>9.2f} {row['emotion_seconds']:>13.2f} {len(row['reports']):>8}  {row['media_path']}")
+        if row["error"]:
+            print(f"         \033[91m{row['error']}\033[0m")
+    failed = sum(row["status"] != "done" for row in batch_rows)
+    print(f"Files done: \033[94m{len(batch_rows) - failed}\033[0m, failed: \033[94m{failed}\033[0m, in \033[94m{time.time() - start_time:.2f}\033[0m seconds.")
+
+
+def run_batch(batch_args):
+    """The --batch mode: the whisperx steps of the files in turn in this process, the emotion steps of the previous file in a worker process, the decoding of the next file in a thread."""
+    media_paths = batch_media_paths(batch_args.batch)
+    if not media_paths:
+        raise FileNotFoundError(f"No media files found for the batch: {batch_args.batch}")
+    print(f"Batch of \033[94m{len(media_paths)}\033[0m media files: {batch_args.batch}")
+
+    # The two processes run at the same time, so the worker process gets half of the CPU budget, and this process the rest, less the ffmpeg thread
+    # of the decoding ahead, which runs alongside its whisperx steps:
+    prefetch_ffmpeg_threads = 1
+    tail_cpu_budget = max(1, batch_args.cpu_budget // 2)
+    asr_cpu_budget = max(1, batch_args.cpu_budget - tail_cpu_budget - prefetch_ffmpeg_threads)
+    batch_rows = [{"media_path": path, "status": "pending", "asr_seconds": 0.0, "emotion_seconds": 0.0, "reports": [], "error": ""} for path in media_paths]
+    tail_futures = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetch_executor, \
+         concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as tail_executor:
+        prefetch_futures = {0: prefetch_executor.submit(prefetch_decoded_audio, media_paths[0], prefetch_ffmpeg_threads)}
+        for index, (media_path_str, row) in enumerate(zip(media_paths, batch_rows)):
+            if index + 1 < len(media_paths):
+                prefetch_futures[index + 1] = prefetch_executor.submit(prefetch_decoded_audio, media_paths[index + 1], prefetch_ffmpeg_threads)
+            prefetch_metrics = None
+            try:
+                prefetch_metrics = prefetch_futures.pop(index).result()
+            except Exception as e:
+                print(f"Decoding ahead failed, it shall be tried again in the pipeline: {e}")
+
+            file_args = copy.copy(batch_args)
+            file_args.media_path = media_path_str
+            file_args.cpu_budget = asr_cpu_budget
+            tail_args = copy.copy(file_args)
+            tail_args.cpu_budget = tail_cpu_budget
+            print()
+            print(f"\033[92mBatch file {index + 1} out of {len(media_paths)}:\033[0m {media_path_str}")
+            asr_start_time = time.time()
+            try:
+                configure_media(file_args)
+                if prefetch_metrics:
+                    pipeline_metrics.merge(prefetch_metrics)
+                asr_reruns = run_pipeline("asr")
+                row["status"] = "asr done"
+                tail_futures[index] = tail_executor.submit(run_batch_media_tail, tail_args, asr_reruns)
+            except Exception as e:
+                traceback.print_exc()
+                row["status"], row["error"] = "failed", f"{type(e).__name__}: {e}"
+            row["asr_seconds"] = time.time() - asr_start_time
+
+        for index, tail_future in tail_futures.items():
+            row = batch_rows[index]
+            try:
+                row["reports"], row["emotion_seconds"] = tail_future.result()
+                row["status"] = "done"
+            except Exception as e:
+                row["status"], row["error"] = "failed", f"{type(e).__name__}: {e}"
+
+    print_batch_summary(batch_rows)
+    return batch_rows
+
+
+class JobProgressWriter(io.TextIOBase):
+    """The stdout of the daemon: each line printed for the job being processed, by the daemon main thread or by the threads of its pipeline steps, is sent
+    to the job client as a progress event. All is shown in the daemon console, too, and what the socket server threads print goes there only."""
+
+    def __init__(self, console):
+        self.console = console
+        self.events = None  # Of the job being processed, if any
+        self.pending = ""
+        self.lock = threading.Lock()
+        self.server_threads = threading.local()  # Marked by the socket server threads, see mark_server_thread
+
+    def mark_server_thread(self):
+        self.server_threads.marked = True
+
+    def start_job(self, events):
+        with self.lock:
+            self.events, self.pending = events, ""
+
+    def end_job(self):
+        with self.lock:
+            self.events, self.pending = None, ""
+
+    def write(self, text):
+        self.console.write(text)
+        if getattr(self.server_threads, "marked", False):
+            return len(text)
+        with self.lock:
+            if self.events is not None:
+                self.pending += text
+                *lines, self.pending = self.pending.split("\n")
+                for line in lines:
+                    self.events.put({"event": "progress", "line": line})
+        return len(text)
+
+    def flush(self):
+        self.console.flush()
+
+
+def serve_jobs(socket_path, queue_size, parser):
+    """The --serve daemon: accepts the jobs on the Unix socket into a bounded queue and processes them one at a time, with the libraries imported and the models loaded once."""
+    socket_path = Path(socket_path)
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    if socket_path.exists():
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(str(socket_path))
+            except ConnectionRefusedError:
+                socket_path.unlink()  # Left by a daemon that was killed
+            else:
+                print(f"\033[91mA daemon is already running on: {socket_path}\033[0m Send it the jobs with emotion_detector_client.py, or use another --socket.", file=sys.stderr)
+                sys.exit(1)
+    job_queue = queue.Queue(maxsize=queue_size)
+    progress_writer = JobProgressWriter(sys.__stdout__)
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def send(self, event):
+            self.wfile.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+        def handle(self):
+            progress_writer.mark_server_thread()
+            try:
+                self.handle_job()
+            except (BrokenPipeError, ConnectionResetError):
+                print("A job client disconnected; its job, if queued, is still processed, and its results are in its output folder.")
+
+        def handle_job(self):
+            try:
+                request = json.loads(self.rfile.readline())
+                argv = request["argv"]
+                if not isinstance(argv, list) or not all(isinstance(arg, str) for arg in argv):
+                    raise TypeError("argv must be a list of strings")
+            except (ValueError, KeyError, TypeError) as e:
+                self.send({"event": "error", "message": f"Invalid job request, it must be one JSON line with the argv list: {type(e).__name__}: {e}"})
+                return
+            try:
+                job_args = parse_options(parser, argv)
+            except SystemExit:
+                self.send({"event": "error", "message": f"Invalid options: {argv}, see: --help"})
+                return
+            if job_args.serve or job_args.batch or not job_args.media_path:
+                self.send({"event": "error", "message": "A job needs a media_path, and no --serve nor --batch"})
+                return
+            job_args.no_open = True  # Not on the daemon host: the client gets the report paths
+            job = {"args": job_args, "events": queue.Queue()}
+            try:
+                job_queue.put_nowait(job)
+            except queue.Full:
+                self.send({"event": "rejected", "message": f"The daemon queue is full ({queue_size} jobs), try again later"})
+                return
+            self.send({"event": "queued", "position": job_queue.qsize()})
+            while True:
+                event = job["events"].get()
+                self.send(event)
+                if event["event"] in ("done", "error"):
+                    break
+
+    def serve_forever():
+        progress_writer.mark_server_thread()
+        server.serve_forever()
+
+    server = socketserver.ThreadingUnixStreamServer(str(socket_path), JobHandler)
+    server.daemon_threads = True
+    threading.Thread(target=serve_forever, daemon=True).start()
+    print(f"\033[92mThe daemon is ready\033[0m, listening on: {socket_path}, queue size: {queue_size}. Send the jobs with: emotion_detector_client.py")
+
+    try:
+        # Not contextlib.redirect_stdout per job: the writer stays, and it tells the lines of the job from those of the socket server threads
+        sys.stdout = progress_writer
+        while True:
+            job = job_queue.get()
+            job["events"].put({"event": "started", "media_path": job["args"].media_path})
+            progress_writer.start_job(job["events"])
+            try:
+                report_paths = process_media(job["args"])
+                job["events"].put({"event": "done", "output_dir": str(output_dir), "reports": report_paths})
+            except (Exception, SystemExit) as e:
+                traceback.print_exc(file=sys.__stderr__)
+                job["events"].put({"event": "error", "message": f"{type(e).__name__}: {e}"})
+            finally:
+                progress_writer.end_job()
+    except KeyboardInterrupt:
+        print("The daemon is stopping.")
+    finally:
+        sys.stdout = sys.__stdout__
+        server.shutdown()
+        socket_path.unlink(missing_ok=True)
+
+
+
+
+if __name__ == "__main__":
+
+    
+
+    #rainbow_text(tool_name_and_version)
+    # See also https://github.com/ddlBoJack/emotion2vec
+
+    startup_seconds = time.time() - start_time
+    parser = build_argument_parser()
+    args = parse_options(parser)
+    if args.profile_startup:
+        atexit.register(print_startup_profile)
+    # Before any heavy import, as the BLAS libraries read their thread counts when loaded; the --batch processes get about half of the budget each, see run_batch:
+    ThreadBudget(args.cpu_budget // 2 if args.batch else args.cpu_budget).limit_blas_threads()
+
+    if args.serve:
+        import_heavy_modules()
+        serve_jobs(args.socket, args.queue_size, parser)
+        sys.exit(0)
+
+    if args.batch:
+        import_heavy_modules()
+        run_batch(args)
+        sys.exit(0)
+
+    if not args.media_path:
+        parser.error("the media_path is needed, unless with --batch or --serve")
+
+    print_library_versions()
+    try:
+        process_media(args)
+    except MediaDownloadError:
+        sys.exit(1)
@@ -0,0 +1,200 @@
+#Accuracy versus speed of the model choices of emotion_detector_funasr_whisperx_plotly.py, on a local set of labeled clips:
+#the emotion2vec variants (--emotion_model) and the whisper sizes and compute types (--model, --compute_type).
+#Each configuration runs in its own process, so that its load time and peak memory are its own. Reported per configuration:
+#the load and inference time, the clips per second, the real-time factor, the peak RSS, the accuracy against the labels (emotions),
+#and the agreement with a reference configuration (the same top emotion; for whisper, the transcript similarity).
+#
+#The clip set: a folder with one subfolder per emotion label (e.g. happy/, sad/, neutral/), or a labels.tsv file with: file<TAB>label
+#Example: python emotion_model_matrix.py ~/clips --emotion_models base plus_large --whisper_models tiny medium --compute_types float32 int8
+import os
+import sys
+import json
+import time
+import difflib
+import argparse
+import datetime
+import subprocess
+from pathlib import Path
+
+
+emotion_model_names = {
+    "base": "iic/emotion2vec_base_finetuned",
+    "plus_seed": "iic/emotion2vec_plus_seed",
+    "plus_base": "iic/emotion2vec_plus_base",
+    "plus_large": "iic/emotion2vec_plus_large",
+}
+whisper_model_sizes = ["tiny", "base", "small", "medium", "large-v2", "large-v3"]
+clip_suffixes = {".wav", ".mp3", ".m4a", ".flac", ".ogg", ".opus", ".webm", ".mp4", ".mkv"}
+
+
+def read_clip_set(clips_path):
+    """The labeled clips: [{"path": ..., "label": ...}], from labels.tsv if there is one, or else from the names of the subfolders."""
+    clips_path = Path(clips_path).expanduser()
+    labels_path = clips_path / "labels.tsv"
+    clips = []
+    if labels_path.exists():
+        with open(labels_path, 'r', encoding='utf-8') as labels_file:
+            for line in labels_file:
+                if line.strip() and not line.startswith("#") and '\t' in line:
+                    file_name, label = line.rstrip('\n').split('\t', 1)
+                    clips.append({"path": str((clips_path / file_name).resolve()), "label": label.strip().lower()})
+    else:
+        for label_dir in sorted(path for path in clips_path.iterdir() if path.is_dir()):
+            for clip_path in sorted(label_dir.iterdir()):
+                if clip_path.suffix.lower() in clip_suffixes:
+                    clips.append({"path": str(clip_path.resolve()), "label": label_dir.name.lower()})
+    if not clips:
+        raise FileNotFoundError(f"No labeled clips in: {clips_path}. Use one subfolder per emotion label, or a labels.tsv file.")
+    return clips
+
+
+def clip_duration_seconds(clip_path):
+    """The duration of the clip, from ffprobe."""
+    probe = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", clip_path],
+                           capture_output=True, text=True, check=True)
+    return float(probe.stdout.strip() or 0)
+
+
+def english_label(label):
+    """'开心/happy' -> 'happy', as the emotion2vec labels are in Chinese and English."""
+    return label.split("/")[-1].strip("<>").lower()
+
+
+def run_emotion_worker(config, clips, batch_size):
+    """In the worker process: one emotion2vec model over all the clips. Returns the timings and the top emotion of each clip."""
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    from funasr import AutoModel
+    from emotion_detector_funasr_whisperx_plotly import emotion_model_location
+
+    load_start_time = time.perf_counter()
+    model_location = emotion_model_location(config["model"])
+    model = AutoModel(model=model_location, device="cpu", disable_update=model_location != config["model"])
+    load_seconds = time.perf_counter() - load_start_time
+
+    infer_start_time = time.perf_counter()
+    results = model.generate(input=[clip["path"] for clip in clips], batch_size=batch_size, granularity="utterance", extract_embedding=False)
+    infer_seconds = time.perf_counter() - infer_start_time
+    predictions = [english_label(result["labels"][max(range(len(result["scores"])), key=lambda i: result["scores"][i])]) for result in results]
+    return {"load_seconds": load_seconds, "infer_seconds": infer_seconds, "predictions": predictions}
+
+
+def run_whisper_worker(config, clips, batch_size):
+    """In the worker process: one whisper model and compute type over all the clips. Returns the timings and the transcript of each clip."""
+    import whisperx
+
+    load_start_time = time.perf_counter()
+    model = whisperx.load_model(config["model"], "cpu", compute_type=config["compute_type"])
+    load_seconds = time.perf_counter() - load_start_time
+
+    infer_start_time = time.perf_counter()
+    predictions = []
+    for clip in clips:
+        result = model.transcribe(whisperx.load_audio(clip["path"]), batch_size=batch_size)
+        predictions.append(" ".join(segment["text"].strip() for segment in result["segments"]))
+    infer_seconds = time.perf_counter() - infer_start_time
+    return {"load_seconds": load_seconds, "infer_seconds": infer_seconds, "predictions": predictions}
+
+
+def run_configuration(config, clips_file, batch_size, work_dir):
+    """Runs the configuration in a child process. Returns its results, with the peak RSS of that process only (from os.wait4)."""
+    result_path = work_dir / f"{config['name'].replace('/', '_')}.json"
+    command = [sys.executable, __file__, "--worker", json.dumps(config), "--clips_file", str(clips_file), "--result_file", str(result_path), "--batch_size", str(batch_size)]
+    worker = subprocess.Popen(command)
+    _, exit_status, usage = os.wait4(worker.pid, 0)
+    worker.returncode = os.waitstatus_to_exitcode(exit_status)
+    if worker.returncode != 0 or not result_path.exists():
+        return {**config, "error": f"The worker process failed, exit code: {worker.returncode}"}
+    with open(result_path, 'r', encoding='utf-8') as result_file:
+        result = json.load(result_file)
+    # ru_maxrss is in kilobytes on Linux
+    return {**config, **result, "peak_rss_mb": round(usage.ru_maxrss / 1024, 1), "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 2)}
+
+
+def score_configurations(results, clips, total_audio_seconds, reference_names):
+    """Adds the throughput, the real-time factor, the accuracy and the agreement with the reference of the same kind."""
+    references = {result["kind"]: result for result in results if result["name"] in reference_names and "error" not in result}
+    for result in results:
+        if "error" in result:
+            continue
+        result["clips_per_second"] = round(len(clips) / result["infer_seconds"], 3) if result["infer_seconds"] else None
+        result["real_time_factor"] = round(result["infer_seconds"] / total_audio_seconds, 4) if total_audio_seconds else None
+        if result["kind"] == "emotion":
+            result["accuracy"] = round(sum(prediction == clip["label"] for prediction, clip in zip(result["predictions"], clips)) / len(clips), 4)
+        reference = references.get(result["kind"])
+        if reference is not None:
+            if result["kind"] == "emotion":
+                result["agreement"] = round(sum(a == b for a, b in zip(result["predictions"], reference["predictions"])) / len(clips), 4)
+            else:
+                similarities = [difflib.SequenceMatcher(None, a.lower().split(), b.lower().split()).ratio() for a, b in zip(result["predictions"], reference["predictions"])]
+                result["agreement"] = round(sum(similarities) / len(similarities), 4)
+            result["reference"] = reference["name"]
+
+
+def print_matrix(results):
+    print()
+    print(f"{'Configuration':<34} {'Load (s)':>9} {'Infer (s)':>10} {'Clips/s':>8} {'RTF':>7} {'Peak RSS':>9} {'Accuracy':>9} {'Agreement':>10}")
+    for result in results:
+        if "error" in result:
+            print(f"{result['name']:<34} \033[91m{result['error']}\033[0m")
+            continue
+        accuracy = f"{result['accuracy']:.1%}" if "accuracy" in result else "-"
+        agreement = f"{result['agreement']:.1%}" if "agreement" in result else "-"
+        print(f"{result['name']:<34} {result['load_seconds']:>9.2f} {result['infer_seconds']:>10.2f} {result['clips_per_second'] or 0:>8.2f} {result['real_time_factor'] or 0:>7.3f} {result['peak_rss_mb']:>7.0f}MB {accuracy:>9} {agreement:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy versus speed of the emotion2vec variants and of the whisper sizes and compute types, on labeled clips")
+    parser.add_argument("clips", type=str, nargs="?", help="The folder of the labeled clips: one subfolder per emotion label, or a labels.tsv file (file<TAB>label)")
+    parser.add_argument("--emotion_models", nargs="*", default=list(emotion_model_names), help=f"The emotion2vec variants: {', '.join(emotion_model_names)}, or model names (default: all)")
+    parser.add_argument("--whisper_models", nargs="*", default=["tiny", "small", "medium", "large-v3"], help=f"The whisper sizes: {', '.join(whisper_model_sizes)} (default: tiny small medium large-v3; none to skip)")
+    parser.add_argument("--compute_types", nargs="+", default=["float32", "int8"], help="The whisper compute types (default: float32 int8)")
+    parser.add_argument("--emotion_reference", type=str, default="plus_large", help="The emotion configuration the others are compared with (default: plus_large)")
+    parser.add_argument("--whisper_reference", type=str, default="large-v3/float32", help="The whisper configuration the others are compared with (default: large-v3/float32)")
+    parser.add_argument("--batch_size", type=int, default=8, help="The batch size of the models (default: 8)")
+    parser.add_argument("--output", type=str, help="The JSON file of the results (default: model_matrix_<date>.json in the clips folder)")
+    # The worker process mode, used by run_configuration:
+    parser.add_argument("--worker", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--clips_file", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--result_file", type=str, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.worker:
+        config = json.loads(options.worker)
+        with open(options.clips_file, 'r', encoding='utf-8') as clips_file:
+            clips = json.load(clips_file)
+        run_worker = run_emotion_worker if config["kind"] == "emotion" else run_whisper_worker
+        with open(options.result_file, 'w', encoding='utf-8') as result_file:
+            json.dump(run_worker(config, clips, options.batch_size), result_file, ensure_ascii=False)
+        return 0
+
+    if not options.clips:
+        parser.error("the clips folder is needed")
+    clips = read_clip_set(options.clips)
+    total_audio_seconds = sum(clip_duration_seconds(clip["path"]) for clip in clips)
+    print(f"Clip set: \033[94m{len(clips)}\033[0m clips, {total_audio_seconds:.1f} seconds, labels: {sorted({clip['label'] for clip in clips})}")
+
+    configs = [{"kind": "emotion", "name": variant, "model": emotion_model_names.get(variant, variant)} for variant in options.emotion_models]
+    configs += [{"kind": "whisper", "name": f"{size}/{compute_type}", "model": size, "compute_type": compute_type}
+                for size in options.whisper_models for compute_type in options.compute_types]
+
+    work_dir = Path(options.clips).expanduser() / "model_matrix_work"
+    work_dir.mkdir(exist_ok=True)
+    clips_file = work_dir / "clips.json"
+    clips_file.write_text(json.dumps(clips, ensure_ascii=False), encoding="utf-8")
+
+    results = []
+    for config in configs:
+        print(f"\033[92mConfiguration:\033[0m {config['kind']} {config['name']}")
+        results.append(run_configuration(config, clips_file, options.batch_size, work_dir))
+
+    score_configurations(results, clips, total_audio_seconds, {options.emotion_reference, options.whisper_reference})
+    print_matrix(results)
+
+    output_path = Path(options.output) if options.output else Path(options.clips).expanduser() / f"model_matrix_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    output_path.write_text(json.dumps({"clips": len(clips), "audio_seconds": total_audio_seconds, "results": results}, ensure_ascii=False, indent=4), encoding="utf-8")
+    print(f"Results saved to: {output_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
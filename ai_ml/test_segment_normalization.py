@@ -0,0 +1,76 @@
+#The segment normalization of emotion_detector_funasr_whisperx_plotly.py (--min_segment_ms, --max_segment_ms, --segment_overlap_ms): the windows the emotion model gets,
+#what it gets for them in the waveform and in the chunks mode, and the pooling of the window scores back to one result per segment. No models are needed.
+#Run with: python -m pytest -q test_segment_normalization.py
+from emotion_detector_funasr_whisperx_plotly import decoded_audio_sample_rate, emotion_model_inputs, normalize_segments, pool_window_emotions
+
+
+def window_result(key, happy_score):
+    return {"key": key, "labels": ["neutral", "happy"], "scores": [1.0 - happy_score, happy_score]}
+
+
+def test_no_segments():
+    assert normalize_segments([], 500, 20000, 2000) == ([], [])
+    assert pool_window_emotions([], []) == []
+
+
+def test_segments_of_a_usual_length_are_kept_whole():
+    boundaries = [(0, 3000), (3000, 8000)]
+    assert normalize_segments(boundaries, 500, 20000, 2000) == (boundaries, [[0], [1]])
+
+
+def test_one_short_segment_alone_is_kept():
+    assert normalize_segments([(1000, 1200)], 500, 20000, 2000) == ([(1000, 1200)], [[0]])
+
+
+def test_short_segments_are_merged_with_a_neighbour():
+    windows, segment_windows = normalize_segments([(0, 200), (200, 5000), (5000, 5300)], 500, 20000, 2000)
+    assert windows == [(0, 5000), (200, 5000), (200, 5300)]  # The first one with the next one, the last one with the previous one
+    assert segment_windows == [[0], [1], [2]]
+
+
+def test_long_segment_is_split_into_overlapping_windows():
+    windows, segment_windows = normalize_segments([(0, 45000)], 500, 20000, 2000)
+    assert windows == [(0, 20000), (18000, 38000), (25000, 45000)]
+    assert segment_windows == [[0, 1, 2]]
+
+
+def test_overlap_of_the_whole_window_does_not_stall():
+    for overlap_ms in (20000, 30000):
+        windows, segment_windows = normalize_segments([(0, 45000)], 500, 20000, overlap_ms)
+        assert windows == [(0, 20000), (20000, 40000), (25000, 45000)]
+        assert segment_windows == [[0, 1, 2]]
+
+
+def test_pooling_gives_one_result_per_segment():
+    windows, segment_windows = normalize_segments([(0, 300), (300, 45300)], 500, 20000, 2000)
+    window_results = [window_result(f"window_{index}", 0.25 * index) for index in range(len(windows))]
+    pooled_results = pool_window_emotions(window_results, segment_windows)
+    assert len(pooled_results) == 2
+    assert pooled_results[0] is window_results[0]
+    assert pooled_results[1]["key"] == "window_1"
+    assert pooled_results[1]["scores"] == [1.0 - 0.5, 0.5]  # The mean of 0.25, 0.5 and 0.75
+
+
+def test_waveform_mode_slices_the_windows():
+    boundaries = [(0, 300), (300, 45300)]
+    windows, _ = normalize_segments(boundaries, 500, 20000, 2000)
+    audio = range(46 * decoded_audio_sample_rate)  # Sliced like the decoded audio, a sample per item
+    model_inputs = emotion_model_inputs(windows, boundaries, None, lambda: audio)
+    samples_per_ms = decoded_audio_sample_rate // 1000
+    assert [(view.start, view.stop) for view in model_inputs] == [(start_ms * samples_per_ms, end_ms * samples_per_ms) for start_ms, end_ms in windows]
+
+
+def test_chunks_mode_uses_the_chunk_files_only_for_unchanged_segments():
+    def no_audio():
+        raise AssertionError("The audio is not decoded when the chunk files are used")
+
+    boundaries = [(0, 3000), (3000, 8000)]
+    windows, _ = normalize_segments(boundaries, 500, 20000, 2000)
+    assert emotion_model_inputs(windows, boundaries, ["chunk_001.mp4", "chunk_002.mp4"], no_audio) == ["chunk_001.mp4", "chunk_002.mp4"]
+
+    # One segment split: all the windows come from the decoded audio, none from the chunk files
+    boundaries = [(0, 3000), (3000, 45000)]
+    windows, _ = normalize_segments(boundaries, 500, 20000, 2000)
+    model_inputs = emotion_model_inputs(windows, boundaries, ["chunk_001.mp4", "chunk_002.mp4"], lambda: range(46 * decoded_audio_sample_rate))
+    assert len(model_inputs) == len(windows)
+    assert all(isinstance(model_input, range) for model_input in model_inputs)